@@ -0,0 +1,291 @@
+from bisect import bisect_left, bisect_right, insort_right
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from operator import attrgetter
+from typing import Iterable
+
+
+# region Aggregates
+
+
+@dataclass
+class UsageStats:
+    """Сводка по ключу или сотруднику: сколько раз брали, кто/что последним, среднее время на руках"""
+    count: int = 0
+    returned_count: int = 0
+    total_holding: float = 0.0  # в секундах, только по возвращенным записям
+    last_entry: object = field(default=None, compare=False)  # последняя запись журнала (sheets.Entry)
+
+    @property
+    def last_user(self) -> str | None:
+        if self.last_entry is None:
+            return None
+        return f"{self.last_entry.emp_firstname} {self.last_entry.emp_lastname}"
+
+    @property
+    def last_key(self) -> str | None:
+        return self.last_entry.key_name if self.last_entry is not None else None
+
+    @property
+    def last_taken(self) -> datetime | None:
+        return self.last_entry.time_received if self.last_entry is not None else None
+
+    @property
+    def last_returned(self) -> datetime | None:
+        return self.last_entry.time_returned if self.last_entry is not None else None
+
+    @property
+    def average_holding(self) -> timedelta | None:
+        if not self.returned_count:
+            return None
+        return timedelta(seconds=self.total_holding / self.returned_count)
+
+    def summary(self) -> tuple:
+        last = self.last_entry
+        return (
+            self.count, self.returned_count, round(self.total_holding, 3),
+            None if last is None else (last.key_name, last.emp_firstname, last.emp_lastname,
+                                       last.time_received, last.time_returned),
+        )
+
+
+def _same_entry(a, b) -> bool:
+    return (
+        a is not None and b is not None and
+        a.key_name == b.key_name and
+        a.emp_firstname == b.emp_firstname and
+        a.emp_lastname == b.emp_lastname and
+        a.time_received == b.time_received
+    )
+
+
+def _recount(table: dict, item, entries: list | None):
+    """Сводка по записям одного ключа или сотрудника (по времени получения) вместо прежней"""
+    if not entries:
+        table.pop(item, None)
+        return
+    stats = UsageStats()
+    for entry in entries:
+        stats.count += 1
+        stats.last_entry = entry
+        if entry.time_returned is not None:
+            stats.returned_count += 1
+            stats.total_holding += (entry.time_returned - entry.time_received).total_seconds()
+    table[item] = stats
+
+
+class JournalAggregates:
+    """
+    Сводки по ключам и сотрудникам, обновляемые при каждой выдаче и возврате.
+    rebuild() пересчитывает их по журналу целиком, check() сравнивает с полным пересчетом
+    """
+
+    def __init__(self):
+        self.keys: dict[str, UsageStats] = {}
+        self.employees: dict[tuple[str, str], UsageStats] = {}
+
+    @classmethod
+    def from_entries(cls, entries: Iterable) -> "JournalAggregates":
+        aggregates = cls()
+        aggregates.rebuild(entries)
+        return aggregates
+
+    def rebuild(self, entries: Iterable):
+        self.keys = {}
+        self.employees = {}
+        for entry in entries:
+            self.issued(entry)
+            if entry.time_returned is not None:
+                self._add_holding(entry)
+
+    def key(self, key_name: str) -> UsageStats:
+        return self.keys.get(key_name) or UsageStats()
+
+    def employee(self, first_name: str, last_name: str) -> UsageStats:
+        return self.employees.get((first_name, last_name)) or UsageStats()
+
+    def _stats(self, entry) -> tuple[UsageStats, UsageStats]:
+        key_stats = self.keys.get(entry.key_name)
+        if key_stats is None:
+            key_stats = self.keys[entry.key_name] = UsageStats()
+        emp_key = (entry.emp_firstname, entry.emp_lastname)
+        emp_stats = self.employees.get(emp_key)
+        if emp_stats is None:
+            emp_stats = self.employees[emp_key] = UsageStats()
+        return key_stats, emp_stats
+
+    def _add_holding(self, entry):
+        holding = (entry.time_returned - entry.time_received).total_seconds()
+        for stats in self._stats(entry):
+            stats.returned_count += 1
+            stats.total_holding += holding
+
+    def issued(self, entry):
+        """Учитывает новую запись журнала"""
+        for stats in self._stats(entry):
+            stats.count += 1
+            stats.last_entry = entry
+
+    def returned(self, entry):
+        """Учитывает возврат по записи (entry уже содержит time_returned)"""
+        if entry.time_returned is None:
+            return
+        self._add_holding(entry)
+        for stats in self._stats(entry):
+            if _same_entry(stats.last_entry, entry):
+                stats.last_entry = entry
+
+    def updated(self, history: "JournalHistory", removed: Iterable, added: Iterable) -> "JournalAggregates":
+        """
+        Копия сводок после изменения записей removed и added (правка журнала в обход бота):
+        пересчитываются только их ключи и сотрудники, по спискам history, где изменения уже учтены.
+        Остальные сводки общие с исходными, сами исходные не меняются
+        """
+        changed = [*removed, *added]
+        aggregates = JournalAggregates()
+        aggregates.keys, aggregates.employees = dict(self.keys), dict(self.employees)
+        for key_name in {entry.key_name for entry in changed}:
+            _recount(aggregates.keys, key_name, history.keys.get(key_name))
+        for emp_key in {(entry.emp_firstname, entry.emp_lastname) for entry in changed}:
+            _recount(aggregates.employees, emp_key, history.employees.get(emp_key))
+        return aggregates
+
+    def check(self, entries: Iterable) -> list[str]:
+        """Сравнивает сводки с пересчетом по журналу, возвращает список расхождений"""
+        expected = JournalAggregates.from_entries(entries)
+        problems = []
+        for name, table, other in (("key", self.keys, expected.keys), ("employee", self.employees, expected.employees)):
+            for item in table.keys() | other.keys():
+                actual = table.get(item, UsageStats()).summary()
+                wanted = other.get(item, UsageStats()).summary()
+                if actual != wanted:
+                    problems.append(f"{name} {item}: {actual} != {wanted}")
+        return problems
+
+
+# endregion
+
+# region History
+
+
+_received = attrgetter("time_received")
+
+
+class JournalHistory:
+    """
+    Записи журнала по ключам и сотрудникам, отсортированные по времени получения.
+    Выборка за период - два бинарных поиска и срез: O(log n + k) без просмотра журнала
+    """
+
+    def __init__(self):
+        self.keys: dict[str, list] = {}
+        self.employees: dict[tuple[str, str], list] = {}
+
+    @classmethod
+    def from_entries(cls, entries: Iterable) -> "JournalHistory":
+        history = cls()
+        history.rebuild(entries)
+        return history
+
+    def rebuild(self, entries: Iterable):
+        self.keys = {}
+        self.employees = {}
+        for entry in entries:
+            for entries_list in self._lists(entry):
+                entries_list.append(entry)
+        for entries_list in (*self.keys.values(), *self.employees.values()):
+            entries_list.sort(key=_received)  # устойчивая сортировка: порядок строк журнала внутри секунды сохраняется
+
+    @classmethod
+    def merged(cls, parts: Iterable["JournalHistory"], keys: Iterable = (), employees: Iterable = ()) -> "JournalHistory":
+        """
+        История только по ключам keys и сотрудникам employees, собранная из частей журнала
+        (архивные месяцы по порядку, затем лист): порядок тот же, что у from_entries по всем их записям
+        """
+        parts = list(parts)
+        history = cls()
+        for table, items, name in ((history.keys, keys, "keys"), (history.employees, employees, "employees")):
+            for item in items:
+                entries = [entry for part in parts for entry in getattr(part, name).get(item, ())]
+                if entries:
+                    entries.sort(key=_received)
+                    table[item] = entries
+        return history
+
+    def _lists(self, entry) -> tuple[list, list]:
+        key_list = self.keys.get(entry.key_name)
+        if key_list is None:
+            key_list = self.keys[entry.key_name] = []
+        emp_key = (entry.emp_firstname, entry.emp_lastname)
+        emp_list = self.employees.get(emp_key)
+        if emp_list is None:
+            emp_list = self.employees[emp_key] = []
+        return key_list, emp_list
+
+    @staticmethod
+    def _range(entries: list, since: datetime | None, until: datetime | None) -> list:
+        start = bisect_left(entries, since, key=_received) if since is not None else 0
+        stop = bisect_left(entries, until, key=_received) if until is not None else len(entries)
+        return entries[start:stop]
+
+    def key(self, key_name: str, since: datetime = None, until: datetime = None) -> list:
+        """Записи по ключу, время получения в [since, until)"""
+        return self._range(self.keys.get(key_name, []), since, until)
+
+    def employee(self, first_name: str, last_name: str, since: datetime = None, until: datetime = None) -> list:
+        """Записи по сотруднику, время получения в [since, until)"""
+        return self._range(self.employees.get((first_name, last_name), []), since, until)
+
+    def issued(self, entry):
+        """Добавляет новую запись; обычно она самая поздняя, и вставка сводится к append"""
+        for entries_list in self._lists(entry):
+            insort_right(entries_list, entry, key=_received)
+
+    def updated(self, removed: Iterable, added: Iterable) -> "JournalHistory":
+        """
+        Копия истории без записей removed (сравнение по объекту) и с записями added.
+        Копируются только затронутые списки, остальные общие с исходной, сама исходная не меняется
+        """
+        history = JournalHistory()
+        history.keys, history.employees = dict(self.keys), dict(self.employees)
+        copied = set()  # id списков, уже скопированных в history
+
+        def lists(entry) -> list[list]:
+            """Списки ключа и сотрудника записи, скопированные при первом обращении"""
+            found = []
+            for table, item in ((history.keys, entry.key_name), (history.employees, (entry.emp_firstname, entry.emp_lastname))):
+                entries = table.get(item)
+                if entries is None or id(entries) not in copied:
+                    entries = table[item] = list(entries or ())
+                    copied.add(id(entries))
+                found.append(entries)
+            return found
+
+        for entry in removed:
+            for entries in lists(entry):
+                start = bisect_left(entries, entry.time_received, key=_received)
+                stop = bisect_right(entries, entry.time_received, key=_received)
+                for position in range(start, stop):
+                    if entries[position] is entry:
+                        del entries[position]
+                        break
+        for entry in added:
+            for entries in lists(entry):
+                insort_right(entries, entry, key=_received)
+        for table in (history.keys, history.employees):
+            for item in [item for item, entries in table.items() if not entries]:
+                del table[item]
+        return history
+
+    def returned(self, entry):
+        """Заменяет запись на ее версию с временем сдачи (правка строки дает новый объект Entry)"""
+        for entries_list in self._lists(entry):
+            start = bisect_left(entries_list, entry.time_received, key=_received)
+            stop = bisect_right(entries_list, entry.time_received, key=_received)
+            for position in range(start, stop):
+                if _same_entry(entries_list[position], entry):
+                    entries_list[position] = entry
+                    break
+
+
+# endregion
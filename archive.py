@@ -0,0 +1,29 @@
+import argparse
+import logger
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def main():
+    """One-shot migration: moves old returned entries of existing workbooks into monthly archive files"""
+    parser = argparse.ArgumentParser(description="Archive returned entries of the keys journal by month")
+    parser.add_argument("--site", action="append", help="site to archive (default: all configured sites)")
+    parser.add_argument("--days", type=float, help="archive entries returned more than DAYS days ago "
+                                                   "(default: archive_after_days from excel_tables.json, "
+                                                   "nothing is archived if it is not set)")
+    args = parser.parse_args()
+
+    logger.setup_logging()
+    import sheets
+
+    registries = sheets.RegistryPool.from_config()
+    for site_name in args.site or registries.sites:
+        site = registries.get(site_name)
+        count = site.keys_accounting.archive_closed_entries(args.days)
+        log.info("Site '%s': %s entries archived to %s", site_name, count, site.keys_accounting.archive.directory)
+    logger.shutdown_logging()
+
+
+if __name__ == "__main__":
+    main()
@@ -3,18 +3,31 @@ from aiogram.enums import ContentType
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.types import (
     ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup,
-    InlineKeyboardButton, Message, ErrorEvent)
+    InlineKeyboardButton, Message, ErrorEvent, BufferedInputFile, FSInputFile,
+    InlineQuery, InlineQueryResultArticle, InlineQueryResultsButton, InputTextMessageContent)
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.filters import Command
+from aiogram.filters import Command, CommandObject
+from aiogram.filters.callback_data import CallbackData
 from aiogram.types import CallbackQuery
 from aiogram.dispatcher.middlewares.base import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
 from aiogram.exceptions import TelegramAPIError, TelegramForbiddenError
 from datetime import datetime, timedelta
 from requests.exceptions import ConnectionError
 import asyncio
+import logging
 import sheets
+from aggregates import UsageStats
+import report
+import export
+import render
+import profiles
+from payloads import PayloadStore
+from pending import PendingRequests
+from throttle import IdempotencyCache, RateLimiter
+import runtime
 import logger
 import os
 import sys
@@ -27,6 +40,16 @@ class Config:
     REQUEST_DELAY = 60 * 60  # 1 hour
     REMINDER_DELAY = 60 * 60 * 24  # 24 hours
     MESSAGE_CHUNK_SIZE = 2000  # Telegram message length limit
+    PROFILE_TTL = 60 * 60 * 24  # 24 hours
+    PROFILE_FLUSH_INTERVAL = 60  # seconds between writes of changed profiles to disk
+    INLINE_PAGE_SIZE = 50  # Telegram limit for inline results per answer
+    INLINE_CACHE_TIME = 10  # seconds; availability in results goes stale quickly
+    BOOKING_CHECK_INTERVAL = 60  # seconds between checks for bookings that are due
+    BOOKING_MAX_DAYS = 60  # how far ahead a key can be booked
+    THROTTLE_RATE = 1  # messages and button presses per second per user, after the burst
+    THROTTLE_BURST = 8
+    IDEMPOTENCY_TTL = 60  # seconds a repeated press of the same button gets the first press's result
+    POLLING_CONCURRENCY = 16  # updates in flight at once without the cluster; sizes the Bot API connection pool
 
 
 def resource_path(relative_path):
@@ -39,24 +62,60 @@ def resource_path(relative_path):
 
 # region Initialization
 
-logger = logger.Logger()
-print("Setting bot token")
+log = logging.getLogger(__name__)
+log.info("Setting bot token")
 with open(resource_path(os.path.join("credentials", "telegram_bot.json")), "r") as f:
     API_TOKEN = json.load(f)["telegram_apikey"]
-dp = Dispatcher(storage=MemoryStorage())
-bot: Bot = Bot(API_TOKEN)
-print("Bot connected")
 
-print("Connecting to worksheets")
-keys_accounting_table = sheets.KeysAccountingTable()
-keys_table = sheets.KeysTable()
-emp_table = sheets.EmployeesTable()
-print("Worksheets connected")
+cluster = None
+cluster_config_path = resource_path(os.path.join("credentials", "cluster.json"))
+if os.path.exists(cluster_config_path):
+    from cluster import Cluster  # требует пакет redis, нужен только в кластерном режиме
+    cluster = Cluster.from_config(cluster_config_path)
+    log.info("Cluster mode: worker %s, %s", cluster.worker_id, cluster.url)
+
+runtime_profile = runtime.RuntimeProfile.from_config(resource_path(os.path.join("credentials", "runtime.json")))
+session = None
+if runtime_profile:
+    session = runtime.TunedSession(runtime_profile, runtime.connection_limit(
+        runtime_profile, cluster.concurrency if cluster else Config.POLLING_CONCURRENCY))
+    log.info("Performance runtime: %s", runtime_profile)
+
+dp = Dispatcher(storage=cluster.storage() if cluster else MemoryStorage())
+bot: Bot = Bot(API_TOKEN, session=session)
+log.info("Bot connected")
+
+log.info("Connecting to worksheets")
+registries = sheets.RegistryPool.from_config()
+log.info("Worksheets connected, sites: %s", ", ".join(registries.sites))
+if cluster:
+    cluster.attach(registries)
+    payloads = cluster.payload_store()
+    pending = cluster.pending_requests()
+    idempotency = cluster.idempotency_cache()
+else:
+    payloads = PayloadStore(os.path.join(os.path.dirname(registries.user_sites_path), "callbacks.jsonl"))
+    pending = PendingRequests()
+    idempotency = IdempotencyCache()
+rate_limiter = RateLimiter(Config.THROTTLE_RATE, Config.THROTTLE_BURST)
+profile_cache = profiles.ProfileCache(
+    os.path.join(os.path.dirname(registries.user_sites_path), "profiles.json"), Config.PROFILE_TTL)
 
 
 async def main():
     dp.errors.register(callback=on_error)
-    await dp.start_polling(bot)
+    try:
+        if cluster:
+            await cluster.run(dp, bot, leader_jobs=[time_reminder, booking_scheduler])
+        else:
+            await dp.start_polling(bot)
+    finally:
+        if cluster:
+            await cluster.close()
+        else:
+            payloads.close()
+        await asyncio.to_thread(profile_cache.flush)
+        await asyncio.to_thread(registries.close)
 
 
 # endregion
@@ -68,49 +127,185 @@ class UserNotFoundError(Exception):
     pass
 
 
+_profile_refreshes: set[str] = set()  # профили, которые сейчас обновляются через get_chat
+
+
 class BotUtils:
     @staticmethod
     def escape_markdown(text: str) -> str:
-        escape_chars = ['_', '*', '[', '`']
-        for char in escape_chars:
-            text = text.replace(char, f'\\{char}')
-        return text
+        return render.escape_markdown(text)
 
     @staticmethod
     def phone_format(phone: Union[str, int]) -> str:
-        phone = str(phone)
-        digits = ''.join(filter(str.isdigit, phone))
-        if digits.startswith('8'):
-            digits = '7' + digits[1:]
-        elif not digits.startswith('7'):
-            digits = '7' + digits
-        digits = digits[:11]
-        return f'+{digits}'
+        return render.phone_format(phone)
+
+    @staticmethod
+    def format_average_holding(stats: UsageStats) -> str:
+        average = stats.average_holding
+        if average is None:
+            return ""
+        hours, rest = divmod(int(average.total_seconds()), 3600)
+        return f"*Среднее время на руках*: {hours} ч {rest // 60} мин\n"
+
+    @staticmethod
+    def parse_period(args: str | None) -> tuple[datetime | None, datetime | None]:
+        """
+        Период истории из аргументов команды: "ДД.ММ.ГГГГ [ДД.ММ.ГГГГ]" (обе даты включительно)
+        или "7д" - последние 7 дней. Возвращает [since, until), ValueError - аргументы не разобраны
+        """
+        args = (args or "").split()
+        if len(args) == 1 and args[0][:-1].isdigit() and args[0][-1] in "дd":
+            return datetime.now() - timedelta(days=int(args[0][:-1])), None
+        if len(args) > 2:
+            raise ValueError(f"Too many period arguments: {args}")
+        dates = [datetime.strptime(arg, "%d.%m.%Y") for arg in args]
+        since = dates[0] if dates else None
+        until = dates[1] + timedelta(days=1) if len(dates) > 1 else None
+        return since, until
+
+    @staticmethod
+    def parse_booking_period(text: str) -> tuple[datetime, datetime]:
+        """Время брони: "ДД.ММ.ГГГГ ЧЧ:ММ ЧЧ:ММ" (в пределах дня) или "ДД.ММ.ГГГГ ЧЧ:ММ ДД.ММ.ГГГГ ЧЧ:ММ" (на несколько дней)"""
+        parts = (text or "").replace("-", " ").split()
+        if len(parts) == 3:
+            start = datetime.strptime(f"{parts[0]} {parts[1]}", "%d.%m.%Y %H:%M")
+            end = datetime.strptime(f"{parts[0]} {parts[2]}", "%d.%m.%Y %H:%M")
+        elif len(parts) == 4:
+            start = datetime.strptime(f"{parts[0]} {parts[1]}", "%d.%m.%Y %H:%M")
+            end = datetime.strptime(f"{parts[2]} {parts[3]}", "%d.%m.%Y %H:%M")
+        else:
+            raise ValueError(f"Can not parse booking period: {text!r}")
+        return start, end
+
+    @staticmethod
+    async def export_markup(kind: str, name: str, since: datetime = None, until: datetime = None) -> InlineKeyboardMarkup:
+        token = await payloads.put({
+            "kind": kind,
+            "name": name,
+            "since": since.isoformat() if since else None,
+            "until": until.isoformat() if until else None,
+        })
+        return BotUtils.make_keyboard([[
+            {"text": "Excel", "callback_data": ExportCallback(token=token, file_format="xlsx").pack()},
+            {"text": "CSV", "callback_data": ExportCallback(token=token, file_format="csv").pack()},
+        ]], inline=True)
+
+    @staticmethod
+    async def return_markup(key_name: str, user_id) -> InlineKeyboardMarkup:
+        token = await payloads.put({"key_name": key_name, "user_id": str(user_id)})
+        return BotUtils.make_keyboard([[
+            {"text": "Подтвердить возврат", "callback_data": ReturnKeyCallback(token=token).pack()}
+        ]], inline=True)
+
+    @staticmethod
+    def cached_username(user_id) -> str | None:
+        """Username из кэша профилей; устаревший профиль обновляется в фоне, без ожидания Bot API"""
+        if profile_cache.is_stale(user_id) and str(user_id) not in _profile_refreshes:
+            _profile_refreshes.add(str(user_id))
+            asyncio.create_task(BotUtils.refresh_profile(user_id))
+        return profile_cache.username(user_id)
+
+    @staticmethod
+    async def refresh_profile(user_id) -> None:
+        try:
+            chat = await bot.get_chat(user_id)
+            profile_cache.update(user_id, chat.username, chat.first_name, chat.last_name)
+        except (TelegramAPIError, ValueError) as e:
+            log.warning("Не удалось обновить профиль %s: %s", user_id, e)
+        finally:
+            _profile_refreshes.discard(str(user_id))
+
+    @staticmethod
+    async def close_approval(token: str, note: str, answered: types.Message = None) -> None:
+        """Дописывает note в сообщения запроса у всех охранников, кроме ответившего, и убирает у них кнопки"""
+        approval = await pending.pop_approval(token)
+        if approval is None:
+            return
+        text, messages = approval
+        skip = (answered.chat.id, answered.message_id) if answered else None
+        targets = [(chat_id, message_id) for chat_id, message_id in messages if (chat_id, message_id) != skip]
+        results = await asyncio.gather(*(
+            bot.edit_message_text(text=f"{text}\n\n{note}", chat_id=chat_id, message_id=message_id)
+            for chat_id, message_id in targets
+        ), return_exceptions=True)
+        for (chat_id, _), result in zip(targets, results):
+            if isinstance(result, Exception):
+                log.warning("Не удалось обновить запрос у охранника %s: %s", chat_id, result)
+
+    @staticmethod
+    async def send_key_request(
+            site: sheets.Registry, user_id: int, username: str | None, emp: sheets.Employee, key_name: str, comment: str
+    ) -> bool:
+        """Рассылает запрос на выдачу ключа охранникам площадки. False, если ни один охранник его не получил"""
+        guards = site.employees.get_security_employees()
+        token = await payloads.put({"user_id": user_id, "key_name": key_name, "comment": comment}, ttl=Config.REQUEST_DELAY)
+        markup = BotUtils.make_keyboard([
+            [{"text": "Подтвердить выдачу ключей", "callback_data": ApproveKeyCallback(token=token).pack()}],
+            [{"text": "Отклонить", "callback_data": DenyKeyCallback(token=token).pack()}]
+        ], inline=True)
+
+        response_text = (
+            f"{f'Запрос на выдачу ключей от пользователя @{username}\n' if username else 'Запрос на выдачу ключей\n'}"
+            f"Ключ: {key_name}\n"
+            f"Имя: {emp.first_name} {emp.last_name}\n"
+            f"{f'Комментарий: {comment}\n\n' if comment else ''}"
+            "Подтвердите действие:"
+        )
+
+        # Запрос получают все охранники сразу, подтверждает первый ответивший
+        sent = await asyncio.gather(*(
+            bot.send_message(chat_id=guard.telegram, text=response_text, reply_markup=markup)
+            for guard in guards
+        ), return_exceptions=True)
+        delivered = []
+        for guard, result in zip(guards, sent):
+            if isinstance(result, Exception):
+                log.warning("Не удалось отправить запрос охраннику %s: %s", guard.telegram, result)
+            else:
+                delivered.append((result.chat.id, result.message_id))
+        if not delivered:
+            await payloads.pop(token)
+            return False
+        await pending.add_approval(token, response_text, delivered, Config.REQUEST_DELAY)
+        await pending.add_request(site.name, key_name, user_id, Config.REQUEST_DELAY)
+        asyncio.create_task(BotUtils.remove_key_after_delay(site.name, key_name, Config.REQUEST_DELAY))
+        asyncio.create_task(BotUtils.close_approval_after_delay(token, Config.REQUEST_DELAY))
+        return True
+
+    @staticmethod
+    async def close_approval_after_delay(token: str, delay: int) -> None:
+        await asyncio.sleep(delay)
+        await BotUtils.close_approval(token, "Время запроса истекло")
+
+    @staticmethod
+    def guard_name(site: sheets.Registry, user: types.User) -> str:
+        guard = site.employees.get_by_telegram(user.id)
+        return f"{guard.first_name} {guard.last_name}" if guard else user.full_name
 
     @staticmethod
-    async def remove_key_after_delay(key: str, dictionary: Dict[str, int], delay: int = 600) -> None:
+    async def remove_key_after_delay(site_name: str, key: str, delay: int = 600) -> None:
         await asyncio.sleep(delay)
-        if key in dictionary:
+        user_id = await pending.pop_request(site_name, key)
+        if user_id is not None:
             try:
-                await bot.send_message(chat_id=dictionary[key],
+                await bot.send_message(chat_id=user_id,
                                        text=f"Время запроса на ключ {key} истекло.")
             except Exception as e:
-                print("Не удалось отправить сообщение пользователю:\n", e)
-            del dictionary[key]
+                log.warning("Не удалось отправить сообщение пользователю: %s", e)
 
     @staticmethod
-    async def check_permission(user_id: str, required_role: str) -> bool:
+    async def check_permission(site: sheets.Registry, user_id: str, required_role: str) -> bool:
         user_id = str(user_id)
-        employees = emp_table.get_all_employees()
+        employees = site.employees.get_all_employees()
         emp = next((emp for emp in employees if emp.telegram == user_id), None)
         if not emp:
             raise UserNotFoundError("User not found")
         return emp is not None and required_role in emp.roles or "admin" in emp.roles
 
     @staticmethod
-    async def is_registered(user_id: str) -> bool:
+    async def is_registered(site: sheets.Registry, user_id: str) -> bool:
         user_id = str(user_id)
-        employees = emp_table.get_all_employees()
+        employees = site.employees.get_all_employees()
         return any(emp.telegram == user_id for emp in employees)
 
     @staticmethod
@@ -154,14 +349,14 @@ class KeyCommandMixin:
     """Mixin for commands that work with keys"""
 
     @staticmethod
-    async def find_similar_keys(search_term: str) -> List[str]:
-        key_names = {key.key_name for key in keys_table.get_all_keys()}
+    async def find_similar_keys(site: sheets.Registry, search_term: str) -> List[str]:
+        key_names = {key.key_name for key in site.keys.get_all_keys()}
         return sheets.find_similar(search_term, key_names)
 
     @staticmethod
-    async def find_similar_employees(search_term: str) -> List[str]:
-        entries = keys_accounting_table.get_all_entries()
-        emp_obj = emp_table.get_all_employees()
+    async def find_similar_employees(site: sheets.Registry, search_term: str) -> List[str]:
+        entries = site.keys_accounting.get_entries()
+        emp_obj = site.employees.get_all_employees()
         emp_names = (
                 {f"{entry.emp_firstname} {entry.emp_lastname}" for entry in entries} |
                 {f"{emp.first_name} {emp.last_name}" for emp in emp_obj}
@@ -172,12 +367,10 @@ class KeyCommandMixin:
         return list(similarities)
 
     @staticmethod
-    async def get_key_state(key_name: str) -> str:
-        entries = keys_accounting_table.get_all_entries()
-        key_entries = [entry for entry in entries if entry.key_name == key_name]
-
-        if not key_entries:
-            key = keys_table.get_by_name(key_name)
+    async def get_key_state(site: sheets.Registry, key_name: str) -> str:
+        stats = site.keys_accounting.aggregates.key(key_name)
+        if not stats.count:
+            key = site.keys.get_by_name(key_name)
             if not key:
                 return "По этому ключу нет записей в истории и в таблице ключей"
             return (
@@ -189,50 +382,19 @@ class KeyCommandMixin:
                 f"Нет информации по последнему пользователю\n"
             )
 
-        last_entry = key_entries[-1]
-        return await KeyCommandMixin.format_key_entry(last_entry)
+        return await KeyCommandMixin.format_key_entry(site, stats.last_entry)
 
     @staticmethod
-    async def format_key_entry(entry: sheets.Entry, include_key_info: bool = True) -> str:
-        key = keys_table.get_by_name(entry.key_name) if include_key_info else None
-        base_info = (
-            f"*Ключ*: `{entry.key_name}`\n"
-            f"*  Состояние*: {'Не на месте' if entry.time_returned is None else 'Этот ключ сейчас на месте'}\n"
-        )
-
-        if key and include_key_info:
-            base_info += (
-                f"*  Количество ключей*: `{key.count}`\n"
-                f"*  Тип ключа*: `{key.key_type}`\n"
-                f"*  Тип аппаратный*: `{key.hardware_type}`\n\n"
-            )
-
-        if entry.time_returned is None:
-            status_info = (
-                f"*Ключ выдан:*\n"
-                f"  *Имя*: `{entry.emp_firstname} {entry.emp_lastname}`\n"
-                f"  *Выдан в*: `{entry.time_received.strftime('%H:%M (%d.%m.%Y)')}`\n"
-            )
-        else:
-            status_info = (
-                f"*Последний пользователь:*\n"
-                f"  *Имя*: `{entry.emp_firstname} {entry.emp_lastname}`\n"
-                f"  *Взял в*: `{entry.time_received.strftime('%H:%M (%d.%m.%Y)')}`\n"
-                f"  *Вернул в*: `{entry.time_returned.strftime('%H:%M (%d.%m.%Y)')}`\n"
-            )
-
-        additional_info = (
-            f"{f'  *Комментарии*: \"{BotUtils.escape_markdown(entry.comment)}\"\n' if entry.comment else ''}"
-            f"  *Контакт*: {BotUtils.phone_format(entry.emp_phone)}\n"
-        )
-
-        return base_info + status_info + additional_info
+    async def format_key_entry(site: sheets.Registry, entry: sheets.Entry, include_key_info: bool = True) -> str:
+        key = site.keys.get_by_name(entry.key_name) if include_key_info else None
+        return render.key_card(entry, key)
 
     @staticmethod
-    async def get_key_history(key_name: str):
-        key = keys_table.get_by_name(key_name)
-        entries = keys_accounting_table.get_all_entries()
-        key_entries = [entry for entry in entries if entry.key_name == key_name]
+    async def get_key_history(site: sheets.Registry, key_name: str, since: datetime = None, until: datetime = None):
+        key = site.keys.get_by_name(key_name)
+        # Архивные месяцы читаются с диска: вне цикла событий
+        key_entries = await asyncio.to_thread(site.keys_accounting.key_history, key_name, since, until)
+        stats = (await asyncio.to_thread(lambda: site.keys_accounting.aggregates)).key(key_name)
         response_strs = [""]
         if key:
             response_strs[-1] = (
@@ -240,135 +402,205 @@ class KeyCommandMixin:
                 f"*Количество ключей*: `{key.count}`\n"
                 f"*Тип ключа*: `{key.key_type}`\n"
                 f"*Тип аппаратный*: `{key.hardware_type}`\n"
-                f"*Этот ключ брали*: {len(key_entries)} раз(а)\n\n"
+                f"*Этот ключ брали*: {stats.count} раз(а)\n"
             )
         else:
             response_strs[-1] = (
                 f"*Ключ*: `{key_name}`\n"
-                f"*Этот ключ брали*: {len(key_entries)} раз(а)\n\n"
+                f"*Этот ключ брали*: {stats.count} раз(а)\n"
             )
+        response_strs[-1] += BotUtils.format_average_holding(stats)
+        if since or until:
+            response_strs[-1] += render.history_period(since, until, len(key_entries))
+        response_strs[-1] += "\n"
         if not key_entries:
-            response_strs[-1] += "По этому ключу нет записей"
+            response_strs[-1] += "За этот период по ключу нет записей" if since or until else "По этому ключу нет записей"
             return response_strs
-        for entry in key_entries:
-            if len(response_strs[-1]) > 2000:
-                response_strs.append("")
-            response_strs[-1] += (
-                f"*Имя*: `{entry.emp_firstname} {entry.emp_lastname}`\n"
-                f"| *Взял в*: `{entry.time_received.strftime('%H:%M (%d.%m.%Y)')}`\n"
-                f"{f"| *Вернул в*: `{entry.time_returned.strftime('%H:%M (%d.%m.%Y)')}`\n" if entry.time_returned else ""}"
-                f"| *Контакт*: {BotUtils.phone_format(entry.emp_phone)}\n"
-                f"{f"| *Комментарии*: \"{BotUtils.escape_markdown(entry.comment)}\"\n" if entry.comment else ""}"
-            )
-            response_strs[-1] += "\n"
-
-        return response_strs
+        return render.chunks(response_strs[-1], map(render.key_history_entry, key_entries))
 
     @staticmethod
-    async def get_emp_history(emp_name: str):
+    async def get_emp_history(site: sheets.Registry, emp_name: str, since: datetime = None, until: datetime = None):
         first_name, last_name = emp_name.split(" ", 1)
-        emp = emp_table.get_by_name(first_name, last_name)
-        entries = keys_accounting_table.get_all_entries()
-        emp_entries = []
-        for entry in entries:
-            if entry.emp_firstname == first_name and entry.emp_lastname == last_name:
-                emp_entries.append(entry)
+        emp = site.employees.get_by_name(first_name, last_name)
+        emp_entries = await asyncio.to_thread(site.keys_accounting.emp_history, first_name, last_name, since, until)
+        stats = (await asyncio.to_thread(lambda: site.keys_accounting.aggregates)).employee(first_name, last_name)
         response_strs = [""]
         if emp:
-            tg = await bot.get_chat(emp.telegram)
+            username = BotUtils.cached_username(emp.telegram)
             response_strs[-1] = (
                 f"*Имя*: `{emp.first_name} {emp.last_name}`\n"
                 f"*Телефон*: {BotUtils.phone_format(emp.phone_number)}\n"
-                f"{f"*Телеграм*: @{tg.username}\n" if tg.username else ""}"
+                f"{f"*Телеграм*: @{username}\n" if username else ""}"
                 f"*Роли*: {', '.join(emp.roles) if emp.roles else 'Нет'}\n"
-                f"*Этот сотрудник брал ключи*: {len(emp_entries)} раз(а)\n\n"
+                f"*Этот сотрудник брал ключи*: {stats.count} раз(а)\n"
             )
         else:
             response_strs[-1] = (
                 f"*Имя*: `{first_name} {last_name}`\n"
-                f"*Этот сотрудник брал ключи*: {len(emp_entries)} раз(а)\n\n"
+                f"*Этот сотрудник брал ключи*: {stats.count} раз(а)\n"
             )
+        response_strs[-1] += BotUtils.format_average_holding(stats)
+        if since or until:
+            response_strs[-1] += render.history_period(since, until, len(emp_entries))
+        response_strs[-1] += "\n"
         if not emp_entries:
-            response_strs[-1] += "По этому сотруднику нет записей"
+            response_strs[-1] += "За этот период по сотруднику нет записей" if since or until else "По этому сотруднику нет записей"
             return response_strs
-        for entry in emp_entries:
-            if len(response_strs[-1]) > 2000:
-                response_strs.append("")
-            response_strs[-1] += (
-                f"*Ключ*: `{entry.key_name}`\n"
-                f"| *Взял в*: `{entry.time_received.strftime('%H:%M (%d.%m.%Y)')}`\n"
-                f"{f"| *Вернул в*: `{entry.time_returned.strftime('%H:%M (%d.%m.%Y)')}`\n" if entry.time_returned else ""}"
-                f"{f"| *Комментарии*: \"{BotUtils.escape_markdown(entry.comment)}\"\n" if entry.comment else ""}"
-            )
-            response_strs[-1] += "\n"
-
-        return response_strs
+        return render.chunks(response_strs[-1], map(render.emp_history_entry, emp_entries))
 
     @staticmethod
-    async def get_my_keys(telegram_id: int) -> list[str]:
-        user = emp_table.get_by_telegram(telegram_id)
+    async def get_my_keys(site: sheets.Registry, telegram_id: int) -> list[str]:
+        user = site.employees.get_by_telegram(telegram_id)
         if not user:
             return []
 
-        not_returned_entries = keys_accounting_table.get_not_returned_keys()
+        not_returned_entries = site.keys_accounting.get_not_returned_keys()
         messages = []
         for entry in not_returned_entries:
             if entry.emp_firstname != user.first_name or entry.emp_lastname != user.last_name:
                 continue
-            key_data = keys_table.get_by_name(entry.key_name)
-            msg = (
-                f"*Ключ*: `{entry.key_name}`\n"
-                f"| *Взял в*: `{entry.time_received.strftime('%H:%M (%d.%m.%Y)')}`\n"
-            )
-            if key_data:
-                msg += (
-                    f"| *Количество ключей*: `{key_data.count}`\n"
-                    f"| *Тип ключа*: `{key_data.key_type}`\n"
-                    f"| *Тип аппаратный*: `{key_data.hardware_type}`\n"
-                )
-            if entry.comment:
-                msg += f"| *Комментарии*: \"{BotUtils.escape_markdown(entry.comment)}\"\n"
-            messages.append(msg)
+            key_data = site.keys.get_by_name(entry.key_name)
+            messages.append(render.my_key(entry, key_data))
         if messages: messages.insert(0, f"Ваши активные ключи ({len(messages)})")
         return messages
 
 # endregion
 
+# region Callback Data
+
+
+class ApproveKeyCallback(CallbackData, prefix="approve"):
+    token: str  # -> {"user_id", "key_name", "comment"}
+
+
+class DenyKeyCallback(CallbackData, prefix="deny"):
+    token: str  # тот же токен, что у кнопки подтверждения
+
+
+class ReturnKeyCallback(CallbackData, prefix="return"):
+    token: str  # -> {"key_name", "user_id"}
+
+
+class ExportCallback(CallbackData, prefix="export"):
+    token: str  # -> {"kind", "name", "since", "until"}
+    file_format: str
+
+
+class CancelBookingCallback(CallbackData, prefix="unbook"):
+    token: str  # -> {"key_name", "start", "end"}
+
+
+# endregion
+
 # region Middleware and Error Handling
 
 
 class LogCommandsMiddleware(BaseMiddleware):
     async def __call__(self, handler, event: Message, data: dict):
-        print(
-            f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] INFO: Message from {event.from_user.username} ({event.from_user.id}): {event.text}")
+        log.info(
+            "Message from %s (%s): %s", event.from_user.username, event.from_user.id, event.text,
+            extra={"user_id": event.from_user.id})
         return await handler(event, data)
 
 
+class SiteMiddleware(BaseMiddleware):
+    """Passes the registry of the user's site to handlers as `site`"""
+
+    async def __call__(self, handler, event: types.TelegramObject, data: dict):
+        user = data.get("event_from_user")
+        data["site"] = await registries.for_user(user.id) if user else await registries.open()
+        return await handler(event, data)
+
+
+class ProfileMiddleware(BaseMiddleware):
+    """Keeps the profile cache fresh from the sender of every incoming update"""
+
+    async def __call__(self, handler, event: types.TelegramObject, data: dict):
+        user = data.get("event_from_user")
+        if user:
+            profile_cache.update(user.id, user.username, user.first_name, user.last_name)
+        return await handler(event, data)
+
+
+class ThrottleMiddleware(BaseMiddleware):
+    """Drops messages and button presses of users over the rate limit before any handler or registry is touched"""
+
+    async def __call__(self, handler, event: types.Update, data: dict):
+        user = data.get("event_from_user")
+        if user is None or event.event_type not in ("message", "callback_query") or rate_limiter.take(user.id):
+            return await handler(event, data)
+        log.info("Throttled %s from %s (%s)", event.event_type, user.username, user.id)
+        warn = rate_limiter.should_warn(user.id)
+        if event.callback_query:
+            # На нажатие нужно ответить в любом случае, иначе кнопка так и будет показывать загрузку
+            await event.callback_query.answer("Слишком много нажатий, подождите немного" if warn else None)
+        elif warn:
+            await event.message.answer("Слишком много сообщений, подождите немного")
+
+
+class IdempotencyMiddleware(BaseMiddleware):
+    """
+    Handlers flagged `idempotent` run once per button: a repeated press of the same button is answered
+    with the result of the first press (or "in progress") and never reaches the handler or the registry.
+    A handler marks its result by returning a string; returning None lets the next press run again
+    """
+
+    async def __call__(self, handler, event: CallbackQuery, data: dict):
+        if not get_flag(data, "idempotent"):
+            return await handler(event, data)
+        message = event.message
+        key = f"{message.chat.id}:{message.message_id}:{event.data}" if message else f"{event.from_user.id}:{event.data}"
+        is_first, result = await idempotency.begin(key, Config.IDEMPOTENCY_TTL)
+        if not is_first:
+            log.info("Repeated press of %s by %s", event.data, event.from_user.id)
+            await event.answer(result or "Запрос уже обрабатывается")
+            return None
+        try:
+            result = await handler(event, data)
+        except Exception:
+            await idempotency.discard(key)
+            raise
+        if isinstance(result, str):
+            await idempotency.finish(key, result, Config.IDEMPOTENCY_TTL)
+        else:
+            await idempotency.discard(key)
+        return result
+
+
+dp.update.outer_middleware(ThrottleMiddleware())
+dp.update.outer_middleware(SiteMiddleware())
+dp.update.outer_middleware(ProfileMiddleware())
+dp.callback_query.middleware(IdempotencyMiddleware())
+
+
 async def on_error(event: ErrorEvent):
     exc = event.exception
     if isinstance(exc, TelegramForbiddenError):
-        print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] ERR: TelegramForbiddenError: {exc}")
+        log.warning("TelegramForbiddenError: %s", exc)
     elif isinstance(exc, TelegramAPIError):
-        print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] ERR: TelegramAPIError: {exc}")
+        log.warning("TelegramAPIError: %s", exc)
     elif isinstance(exc, ConnectionError):
-        print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] ERR: Connection error")
+        log.warning("Connection error")
     elif isinstance(exc, UserNotFoundError):
         await event.update.message.answer("Чтобы использовать бота, нужно зарегистрироваться в системе (/start)")
     else:
-        logger.err(exc, additional_text="Error while handling command")
+        log.error("Error while handling command", exc_info=exc)
         if hasattr(event, "update") and hasattr(event.update, "message"):
             await event.update.message.answer("Произошла ошибка, попробуйте еще раз")
 
 
 @dp.startup()
 async def on_startup(dispatcher: Dispatcher):  # noqa
-    asyncio.create_task(time_reminder())
-    print(f"Bot '{(await bot.get_me()).username}' started")
+    if cluster is None:
+        asyncio.create_task(time_reminder())  # в кластере задачи запускает лидер
+        asyncio.create_task(booking_scheduler())
+    asyncio.create_task(profile_flusher())  # у каждого процесса свой кэш профилей
+    log.info("Bot '%s' started", (await bot.get_me()).username)
 
 
 @dp.shutdown()
 async def on_shutdown(*args, **kwargs):  # noqa
-    print(f"Bot '{(await bot.get_me()).username}' stopped")
+    log.info("Bot '%s' stopped", (await bot.get_me()).username)
 
 
 # endregion
@@ -378,53 +610,145 @@ async def on_shutdown(*args, **kwargs):  # noqa
 
 async def time_reminder():
     while True:
-        try:
-            print("Checking for time reminders...")
-            not_returned_entries = keys_accounting_table.get_not_returned_keys()
-
-            for entry in not_returned_entries:
-                print(f"Checking {entry.emp_firstname} {entry.emp_lastname} for key {entry.key_name}")
-                if entry.time_received + timedelta(days=3) < datetime.now():
-                    emp = emp_table.get_by_name(entry.emp_firstname, entry.emp_lastname)
-                    if not emp:
-                        print(f"Employee {entry.emp_firstname} {entry.emp_lastname} not found for notification")
+        log.info("Checking for time reminders...")
+        for site_name in registries.sites:
+            try:
+                site = registries.peek(site_name)
+                if site is None:
+                    # Выгруженная площадка открывается, только если по сводке есть кому напомнить или что архивировать
+                    summary = await asyncio.to_thread(registries.summary, site_name)
+                    if summary is not None and not summary.needs_attention(
+                            datetime.now(), timedelta(days=3), registries.sites[site_name].get("archive_after_days")):
                         continue
-                    print("Sending notification message")
-                    await bot.send_message(
-                        chat_id=emp.telegram,
-                        text=f"Вы взяли ключ {entry.key_name} 3+ дня назад, но не вернули его. Пожалуйста, верните его в ближайшее время."
-                    )
-        except ConnectionError:
-            print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] ERR: Connection error")
-        except TelegramForbiddenError:
-            print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] ERR: TelegramForbiddenError, bot blocked by user")
-        except Exception as e:
-            logger.err(e, "Error in time_reminder")
+                    site = await registries.open(site_name)
+                not_returned_entries = site.keys_accounting.get_not_returned_keys()
+
+                for entry in not_returned_entries:
+                    log.debug("Checking %s %s for key %s", entry.emp_firstname, entry.emp_lastname, entry.key_name)
+                    if entry.time_received + timedelta(days=3) < datetime.now():
+                        emp = site.employees.get_by_name(entry.emp_firstname, entry.emp_lastname)
+                        if not emp:
+                            log.warning("Employee %s %s not found for notification", entry.emp_firstname, entry.emp_lastname)
+                            continue
+                        log.debug("Sending notification message")
+                        await bot.send_message(
+                            chat_id=emp.telegram,
+                            text=f"Вы взяли ключ {entry.key_name} 3+ дня назад, но не вернули его. Пожалуйста, верните его в ближайшее время."
+                        )
+                await site.submit(site.keys_accounting.archive_closed_entries)
+                await asyncio.to_thread(site.keys_accounting.rebuild_aggregates)
+            except ConnectionError:
+                log.warning("Connection error")
+            except TelegramForbiddenError:
+                log.warning("TelegramForbiddenError, bot blocked by user")
+            except Exception as e:
+                log.error("Error in time_reminder for site '%s'", site_name, exc_info=e)
+        await asyncio.to_thread(registries.evict_idle)
         await asyncio.sleep(Config.REMINDER_DELAY)
 
 
+async def start_booking(site: sheets.Registry, booking: sheets.Booking, now: datetime):
+    """Наступившая бронь превращается в обычный запрос охране, как после /get_key"""
+    period = render.booking_period(booking.start, booking.end)
+    if booking.end <= now:
+        await site.submit(site.bookings.set_status, booking, sheets.BOOKING_EXPIRED)
+        await bot.send_message(chat_id=booking.telegram, text=f"Бронь ключа {booking.key_name} ({period}) истекла.")
+        return
+    # Статус меняется до рассылки: при сбое отправки запрос не уйдет охране повторно каждую минуту
+    await site.submit(site.bookings.set_status, booking, sheets.BOOKING_REQUESTED)
+    emp = site.employees.get_by_telegram(booking.telegram)
+    if emp is None:
+        log.warning("Employee %s of booking for key %s not found", booking.telegram, booking.key_name)
+        return
+    if await pending.is_requested(site.name, booking.key_name):
+        await bot.send_message(
+            chat_id=booking.telegram,
+            text=f"Наступило время брони ключа {booking.key_name}, но ключ уже запрошен. Запросите его позже через /get_key")
+        return
+    sent = await BotUtils.send_key_request(
+        site, int(booking.telegram), BotUtils.cached_username(booking.telegram), emp, booking.key_name, f"Бронь {period}")
+    await bot.send_message(
+        chat_id=booking.telegram,
+        text=f"Наступило время брони ключа {booking.key_name}. Запрос отправлен охране, ожидайте подтверждения."
+        if sent else
+        f"Наступило время брони ключа {booking.key_name}, но отправить запрос охране не удалось. Запросите ключ через /get_key"
+    )
+
+
+async def booking_scheduler():
+    """
+    Раз в BOOKING_CHECK_INTERVAL превращает наступившие брони в запросы охране.
+    Выгруженная площадка открывается только к началу своей ближайшей брони по ее сводке (sheets.SiteSummary)
+    """
+    while True:
+        now = datetime.now()
+        for site_name in registries.sites:
+            try:
+                site = registries.peek(site_name)
+                if site is None:
+                    summary = await asyncio.to_thread(registries.summary, site_name)
+                    if summary is not None and (summary.next_booking is None or summary.next_booking > now):
+                        continue
+                    site = await registries.open(site_name)
+                for booking in site.bookings.due(now):
+                    try:
+                        await start_booking(site, booking, now)
+                    except TelegramAPIError as e:
+                        log.warning("Failed to notify %s about booking of key %s: %s", booking.telegram, booking.key_name, e)
+            except Exception as e:
+                log.error("Error in booking_scheduler for site '%s'", site_name, exc_info=e)
+        await asyncio.sleep(Config.BOOKING_CHECK_INTERVAL)
+
+
+async def profile_flusher():
+    """Пишет изменившиеся профили на диск вне цикла событий, чтобы апдейты не ждали файловую систему"""
+    while True:
+        await asyncio.sleep(Config.PROFILE_FLUSH_INTERVAL)
+        try:
+            await asyncio.to_thread(profile_cache.flush)
+        except OSError as e:
+            log.warning("Failed to save profile cache: %s", e)
+
+
 # endregion
 
 # region Registration
 
 class RegistrationState(StatesGroup):
+    waiting_for_site = State()
     waiting_for_name = State()
     waiting_for_surname = State()
     waiting_for_phone = State()
 
 
 @dp.message(Command("start"))
-async def send_welcome(message: types.Message, state: FSMContext):
-    if await BotUtils.is_registered(message.from_user.id):
+async def send_welcome(message: types.Message, state: FSMContext, site: sheets.Registry):
+    if await BotUtils.is_registered(site, message.from_user.id):
         await message.answer("Вы уже зарегистрированы и можете пользоваться ботом!",
                              reply_markup=types.ReplyKeyboardRemove())
         return
 
+    if len(registries.sites) > 1:
+        markup = BotUtils.make_keyboard([[name] for name in registries.sites])
+        await message.answer("Чтобы зарегистрироваться в системе, выберите вашу площадку:", reply_markup=markup)
+        await state.set_state(RegistrationState.waiting_for_site)
+        return
+
     await message.answer("Чтобы зарегистрироваться в системе, введите ваше имя:",
                          reply_markup=types.ReplyKeyboardRemove())
     await state.set_state(RegistrationState.waiting_for_name)
 
 
+@dp.message(RegistrationState.waiting_for_site)
+async def get_site(message: types.Message, state: FSMContext):
+    if message.text not in registries.sites:
+        await message.reply("Пожалуйста, выберите площадку из списка.")
+        return
+    await state.update_data(site=message.text)
+    await message.answer("Теперь введите ваше имя:", reply_markup=types.ReplyKeyboardRemove())
+    await state.set_state(RegistrationState.waiting_for_name)
+
+
 @dp.message(RegistrationState.waiting_for_name)
 async def get_name(message: types.Message, state: FSMContext):
     name = message.text.replace(" ", "")
@@ -484,20 +808,24 @@ async def process_phone_number(phone: str, message: Message, state: FSMContext):
     await message.reply(response_text, reply_markup=markup)
 
 
-@dp.callback_query(F.data == "confirm")
-async def confirm_data(callback: CallbackQuery, state: FSMContext):
+@dp.callback_query(F.data == "confirm", flags={"idempotent": True})
+async def confirm_data(callback: CallbackQuery, state: FSMContext, site: sheets.Registry):
     try:
         user_data = await state.get_data()
-        emp_table.new_employee(
+        site = await registries.open(user_data.get("site", site.name))
+        await site.submit(
+            site.employees.new_employee,
             user_data["name"],
             user_data["surname"],
             BotUtils.phone_format(user_data["phone"]),
             callback.from_user.id,
         )
+        await registries.assign(callback.from_user.id, site.name)
         await callback.message.edit_reply_markup(reply_markup=None)
         await callback.answer("Данные сохранены, свяжитесь с администратором для получения ролей")
+        return "Данные уже сохранены"
     except Exception as e:
-        logger.err(e, "Error in confirm registration data")
+        log.error("Error in confirm registration data", exc_info=e)
         await callback.answer("Произошла ошибка при сохранении данных.")
     finally:
         await state.clear()
@@ -513,23 +841,20 @@ class GetKeyState(StatesGroup):
     waiting_for_confirmation = State()
 
 
-requested_keys = {}
-
-
 @dp.message(Command("get_key"))
-async def get_key(message: types.Message, state: FSMContext):
-    if not await BotUtils.check_permission(message.from_user.id, "user"):
+async def get_key(message: types.Message, state: FSMContext, site: sheets.Registry):
+    if not await BotUtils.check_permission(site, message.from_user.id, "user"):
         await message.answer("Вы не имеете доступа к этой команде.")
         return
 
-    emp = emp_table.get_by_telegram(message.from_user.id)
+    emp = site.employees.get_by_telegram(message.from_user.id)
     await state.update_data(emp=emp)
     await message.answer("Введите название ключа или номер базовой станции\n\n(/cancel для отмены)")
     await state.set_state(GetKeyState.waiting_for_input)
 
 
 @dp.message(GetKeyState.waiting_for_input)
-async def get_key_name(message: types.Message, state: FSMContext):
+async def get_key_name(message: types.Message, state: FSMContext, site: sheets.Registry):
     if message.text == "/cancel":
         await state.clear()
         await message.answer("Отменено.", reply_markup=types.ReplyKeyboardRemove())
@@ -537,9 +862,9 @@ async def get_key_name(message: types.Message, state: FSMContext):
 
     msg = await message.answer("Поиск ключа...", reply_markup=types.ReplyKeyboardRemove())
 
-    exact_key = keys_table.get_by_name(message.text)
-    similarities = await KeyCommandMixin.find_similar_keys(message.text)
-    not_returned_keys = {key.key_name for key in keys_accounting_table.get_not_returned_keys()}
+    exact_key = site.keys.get_by_name(message.text)
+    similarities = await KeyCommandMixin.find_similar_keys(site, message.text)
+    not_returned_keys = {key.key_name for key in site.keys_accounting.get_not_returned_keys()}
 
     if exact_key:
         key_name = exact_key.key_name
@@ -569,14 +894,14 @@ async def get_key_name(message: types.Message, state: FSMContext):
     if key_name in not_returned_keys:
         await msg.delete()
         await message.answer(
-            await KeyCommandMixin.get_key_state(key_name),
+            await KeyCommandMixin.get_key_state(site, key_name),
             reply_markup=types.ReplyKeyboardRemove(),
             parse_mode="Markdown"
         )
         await state.clear()
         return
 
-    if key_name in requested_keys:
+    if await pending.is_requested(site.name, key_name):
         await msg.delete()
         await message.answer("Этот ключ уже запрошен.")
         await state.clear()
@@ -592,7 +917,7 @@ async def get_key_name(message: types.Message, state: FSMContext):
 
 
 @dp.message(GetKeyState.waiting_for_comment)
-async def get_key_comment(message: types.Message, state: FSMContext):
+async def get_key_comment(message: types.Message, state: FSMContext, site: sheets.Registry):
     if message.text == "/cancel":
         await state.clear()
         await message.answer("Отменено.", reply_markup=types.ReplyKeyboardRemove())
@@ -601,8 +926,8 @@ async def get_key_comment(message: types.Message, state: FSMContext):
     comment = "" if message.text == "/empty" else message.text
     await state.update_data(comment=comment)
 
-    security_emp = emp_table.get_security_employee()
-    if not security_emp:
+    guards = site.employees.get_security_employees()
+    if not guards:
         await message.reply("Охранник не зарегистрирован.")
         await state.clear()
         return
@@ -611,61 +936,203 @@ async def get_key_comment(message: types.Message, state: FSMContext):
     key_name = data["key"]
     emp_from = data["emp"]
 
-    callback_approve = f"approve_key:{message.from_user.id}:{key_name}:{comment}"
-    callback_deny = f"deny_key:{message.from_user.id}:{key_name}"
+    await state.clear()
+    if not await BotUtils.send_key_request(
+            site, message.from_user.id, message.from_user.username, emp_from, key_name, comment):
+        await message.answer("Не удалось отправить запрос охране. Попробуйте позже.")
+        return
+    await message.answer("Запрос отправлен охраннику. Ожидайте подтверждения.")
+
 
-    markup = BotUtils.make_keyboard([
-        [{"text": "Подтвердить выдачу ключей", "callback_data": callback_approve}],
-        [{"text": "Отклонить", "callback_data": callback_deny}]
-    ], inline=True)
+@dp.callback_query(ApproveKeyCallback.filter(), flags={"idempotent": True})
+async def approve_key(callback: CallbackQuery, callback_data: ApproveKeyCallback, site: sheets.Registry):
+    payload = await payloads.pop(callback_data.token)  # pop атомарен: запрос достается только первому ответившему
+    if payload is None and await pending.has_approval(callback_data.token):
+        await callback.answer("Запрос уже обрабатывает другой охранник")
+        return
+    if payload is None or not await pending.is_requested(site.name, payload["key_name"]):
+        await callback.message.edit_text(callback.message.text + "\n\nВремя запроса истекло")
+        await BotUtils.close_approval(callback_data.token, "Время запроса истекло", callback.message)
+        return
+    user_id, key_name, comment = payload["user_id"], payload["key_name"], payload["comment"]
+
+    emp = site.employees.get_by_telegram(int(user_id))
+    if emp is None:
+        log.warning("Employee %s requesting key %s not found, request closed", user_id, key_name)
+        await callback.message.edit_text(callback.message.text + "\n\n❌ Сотрудник не найден, выдача невозможна")
+        await pending.pop_request(site.name, key_name)
+        await BotUtils.close_approval(callback_data.token, "❌ Сотрудник не найден, запрос закрыт", callback.message)
+        return "❌ Сотрудник не найден"
+    try:
+        await site.submit(
+            site.keys_accounting.new_entry,
+            key_name,
+            emp.first_name,
+            emp.last_name,
+            emp.phone_number,
+            comment=comment,
+        )
+    except Exception as e:
+        # Выдача не записана: кнопка снова действует у всех охранников, иначе запрос висел бы до истечения
+        await payloads.restore(callback_data.token, payload, Config.REQUEST_DELAY)
+        log.error("Failed to record issue of key %s on site '%s'", key_name, site.name, exc_info=e)
+        await callback.answer("Не удалось записать выдачу ключа, попробуйте еще раз", show_alert=True)
+        return None
 
-    response_text = (
-        f"{f'Запрос на выдачу ключей от пользователя @{message.from_user.username}\n' if message.from_user.username else 'Запрос на выдачу ключей\n'}"
-        f"Ключ: {key_name}\n"
-        f"Имя: {emp_from.first_name} {emp_from.last_name}\n"
-        f"{f'Комментарий: {comment}\n\n' if comment else ''}"
-        "Подтвердите действие:"
-    )
+    await bot.send_message(chat_id=user_id, text="✔ Охранник подтвердил ваш запрос на выдачу ключей")
+    await callback.message.edit_text(callback.message.text + "\n\n✔ Выдача ключа подтверждена")
+    await pending.pop_request(site.name, key_name)
+    await BotUtils.close_approval(
+        callback_data.token, f"✔ Выдачу подтвердил(а) {BotUtils.guard_name(site, callback.from_user)}", callback.message)
+    return "✔ Выдача ключа подтверждена"
 
-    await bot.send_message(
-        chat_id=security_emp.telegram,
-        text=response_text,
-        reply_markup=markup,
+
+@dp.callback_query(DenyKeyCallback.filter(), flags={"idempotent": True})
+async def deny_key(callback: CallbackQuery, callback_data: DenyKeyCallback, site: sheets.Registry):
+    payload = await payloads.pop(callback_data.token)
+    if payload is None and await pending.has_approval(callback_data.token):
+        await callback.answer("Запрос уже обрабатывает другой охранник")
+        return
+    if payload is None:
+        await callback.message.edit_text(callback.message.text + "\n\nВремя запроса истекло")
+        return
+    user_id, key_name = payload["user_id"], payload["key_name"]
+    await bot.send_message(chat_id=user_id, text="❌ Охранник отклонил ваш запрос на выдачу ключей.")
+    await callback.message.edit_text(callback.message.text + "\n\n❌ Вы отклонили запрос на выдачу ключей.")
+    await pending.pop_request(site.name, key_name)
+    await BotUtils.close_approval(
+        callback_data.token, f"❌ Запрос отклонил(а) {BotUtils.guard_name(site, callback.from_user)}", callback.message)
+    return "❌ Запрос отклонен"
+
+# endregion
+
+# region Booking Commands
+
+
+class BookKeyState(StatesGroup):
+    waiting_for_key = State()
+    waiting_for_period = State()
+
+
+@dp.message(Command("book"))
+async def book_key(message: types.Message, state: FSMContext, site: sheets.Registry):
+    if not await BotUtils.check_permission(site, message.from_user.id, "user"):
+        await message.answer("Вы не имеете доступа к этой команде.")
+        return
+    await message.answer("Введите название ключа или номер базовой станции для брони\n\n(/cancel для отмены)")
+    await state.set_state(BookKeyState.waiting_for_key)
+
+
+@dp.message(BookKeyState.waiting_for_key)
+async def book_key_name(message: types.Message, state: FSMContext, site: sheets.Registry):
+    if message.text == "/cancel":
+        await state.clear()
+        await message.answer("Отменено.", reply_markup=types.ReplyKeyboardRemove())
+        return
+
+    exact_key = site.keys.get_by_name(message.text)
+    similarities = [exact_key.key_name] if exact_key else await KeyCommandMixin.find_similar_keys(site, message.text)
+    if not similarities:
+        await message.answer(
+            f"Ключ '{message.text}' не найден. Проверьте правильность ввода.", reply_markup=types.ReplyKeyboardRemove())
+        await state.clear()
+        return
+
+    if len(similarities) > 1:
+        markup = BotUtils.make_keyboard([[sim] for sim in similarities])
+        await message.answer("Выберите ключ из найденных:", reply_markup=markup)
+        return
+
+    await state.update_data(key=similarities[0])
+    await message.answer(
+        f"Ключ: {similarities[0]}\n"
+        f"Введите время брони:\n"
+        f"ДД.ММ.ГГГГ ЧЧ:ММ ЧЧ:ММ - в пределах дня\n"
+        f"ДД.ММ.ГГГГ ЧЧ:ММ ДД.ММ.ГГГГ ЧЧ:ММ - на несколько дней\n\n(/cancel для отмены)",
+        reply_markup=types.ReplyKeyboardRemove()
     )
+    await state.set_state(BookKeyState.waiting_for_period)
 
-    await message.answer("Запрос отправлен охраннику. Ожидайте подтверждения.")
-    await state.clear()
-    requested_keys[key_name] = message.from_user.id
-    asyncio.create_task(BotUtils.remove_key_after_delay(key_name, requested_keys, Config.REQUEST_DELAY))
 
+@dp.message(BookKeyState.waiting_for_period)
+async def book_key_period(message: types.Message, state: FSMContext, site: sheets.Registry):
+    if message.text == "/cancel":
+        await state.clear()
+        await message.answer("Отменено.", reply_markup=types.ReplyKeyboardRemove())
+        return
 
-@dp.callback_query(F.data.startswith("approve_key"))
-async def approve_key(callback: CallbackQuery):
-    _, user_id, key_name, comment = callback.data.split(":")
-    if key_name not in requested_keys:
-        await callback.message.edit_text(callback.message.text + "\n\nВремя запроса истекло")
+    try:
+        start, end = BotUtils.parse_booking_period(message.text)
+    except ValueError:
+        await message.answer("Не удалось разобрать время. Пример: 25.03.2025 09:00 18:00")
+        return
+    now = datetime.now()
+    if end <= start:
+        await message.answer("Конец брони должен быть позже начала")
+        return
+    if end <= now:
+        await message.answer("Это время уже прошло")
+        return
+    if start > now + timedelta(days=Config.BOOKING_MAX_DAYS):
+        await message.answer(f"Бронировать можно не дальше, чем на {Config.BOOKING_MAX_DAYS} дней вперед")
         return
 
-    emp = emp_table.get_by_telegram(int(user_id))
-    keys_accounting_table.new_entry(
-        key_name,
-        emp.first_name,
-        emp.last_name,
-        emp.phone_number,
-        comment=comment,
+    key_name = (await state.get_data())["key"]
+    emp = site.employees.get_by_telegram(message.from_user.id)
+    try:
+        await site.submit(
+            site.bookings.new_booking, key_name, emp.first_name, emp.last_name, message.from_user.id, max(start, now), end)
+    except sheets.BookingConflictError as e:
+        await message.answer(
+            f"В это время свободного ключа {render.escape_markdown(key_name)} нет:\n"
+            f"{render.booking_conflicts(e.conflicts)}\n"
+            f"Введите другое время\n\n(/cancel для отмены)",
+            parse_mode="Markdown"
+        )
+        return
+    await state.clear()
+    await message.answer(
+        f"✔ Ключ {key_name} забронирован на {render.booking_period(start, end)}.\n"
+        f"Когда бронь начнется, запрос на выдачу уйдет охране автоматически. Брони: /my_bookings"
     )
 
-    await bot.send_message(chat_id=user_id, text="✔ Охранник подтвердил ваш запрос на выдачу ключей")
-    await callback.message.edit_text(callback.message.text + "\n\n✔ Выдача ключа подтверждена")
-    requested_keys.pop(key_name, None)
 
+@dp.message(Command("my_bookings"))
+async def my_bookings(message: types.Message, site: sheets.Registry):
+    if not await BotUtils.check_permission(site, message.from_user.id, "user"):
+        await message.answer("Вы не имеете доступа к этой команде.")
+        return
+
+    bookings = site.bookings.of_user(message.from_user.id)
+    if not bookings:
+        await message.answer("У вас нет активных броней (/book - забронировать ключ)")
+        return
+    for booking in bookings:
+        token = await payloads.put({
+            "key_name": booking.key_name, "start": booking.start.isoformat(), "end": booking.end.isoformat()})
+        markup = BotUtils.make_keyboard([[
+            {"text": "Отменить бронь", "callback_data": CancelBookingCallback(token=token).pack()}
+        ]], inline=True)
+        await message.answer(render.booking(booking), parse_mode="Markdown", reply_markup=markup)
+
+
+@dp.callback_query(CancelBookingCallback.filter(), flags={"idempotent": True})
+async def cancel_booking(callback: CallbackQuery, callback_data: CancelBookingCallback, site: sheets.Registry):
+    payload = await payloads.get(callback_data.token)
+    start, end = (datetime.fromisoformat(payload[bound]) for bound in ("start", "end")) if payload else (None, None)
+    booking = next((
+        booking for booking in site.bookings.of_user(callback.from_user.id)
+        if payload and (booking.key_name, booking.start, booking.end) == (payload["key_name"], start, end)
+    ), None)
+    if booking is None:
+        await callback.answer("Бронь уже неактивна")
+        await callback.message.edit_reply_markup(reply_markup=None)
+        return
+    await site.submit(site.bookings.set_status, booking, sheets.BOOKING_CANCELLED)
+    await payloads.pop(callback_data.token)
+    await callback.message.edit_text(callback.message.text + "\n\n❌ Бронь отменена")
+    return "❌ Бронь отменена"
 
-@dp.callback_query(F.data.startswith("deny_key"))
-async def deny_key(callback: CallbackQuery):
-    _, user_id, key_name = callback.data.split(":")
-    await bot.send_message(chat_id=user_id, text="❌ Охранник отклонил ваш запрос на выдачу ключей.")
-    await callback.message.edit_text(callback.message.text + "\n\n❌ Вы отклонили запрос на выдачу ключей.")
-    requested_keys.pop(key_name, None)
 
 # endregion
 
@@ -677,8 +1144,8 @@ class FindKeyState(StatesGroup):
 
 
 @dp.message(Command("find_key"))
-async def find_key(message: types.Message, state: FSMContext):
-    if not await BotUtils.check_permission(message.from_user.id, "user"):
+async def find_key(message: types.Message, state: FSMContext, site: sheets.Registry):
+    if not await BotUtils.check_permission(site, message.from_user.id, "user"):
         await message.answer("Вы не имеете доступа к этой команде.")
         return
     await message.answer("Введите название ключа или номер базовой станции\n\n(/cancel для отмены)")
@@ -686,13 +1153,13 @@ async def find_key(message: types.Message, state: FSMContext):
 
 
 @dp.message(FindKeyState.waiting_for_input)
-async def process_find_key(message: types.Message, state: FSMContext):
+async def process_find_key(message: types.Message, state: FSMContext, site: sheets.Registry):
     if message.text == "/cancel":
         await state.clear()
         await message.answer("Отменено.", reply_markup=types.ReplyKeyboardRemove())
         return
 
-    similarities = await KeyCommandMixin.find_similar_keys(message.text)
+    similarities = await KeyCommandMixin.find_similar_keys(site, message.text)
     if not similarities:
         await message.answer("Ключ не найден")
         await state.clear()
@@ -704,33 +1171,71 @@ async def process_find_key(message: types.Message, state: FSMContext):
         return
 
     await message.answer(
-        await KeyCommandMixin.get_key_state(similarities[0]),
+        await KeyCommandMixin.get_key_state(site, similarities[0]),
         parse_mode="Markdown",
         reply_markup=types.ReplyKeyboardRemove())
     await state.clear()
 
 
+@dp.inline_query()
+async def inline_find_key(query: InlineQuery, site: sheets.Registry):
+    """@бот <начало названия или номер БС>: ключи с доступностью; выбранный результат отправляет название ключа"""
+    if not site.employees.get_by_telegram(query.from_user.id):
+        await query.answer(
+            [], cache_time=Config.INLINE_CACHE_TIME, is_personal=True,
+            button=InlineQueryResultsButton(text="Зарегистрироваться в боте", start_parameter="register"))
+        return
+
+    offset = int(query.offset) if query.offset.isdigit() else 0
+    keys = site.keys.search(query.query, offset + Config.INLINE_PAGE_SIZE + 1)  # +1: есть ли следующая страница
+    page = keys[offset:offset + Config.INLINE_PAGE_SIZE]
+    holders = site.keys_accounting.holders()
+    results = [
+        InlineQueryResultArticle(
+            id=str(offset + position),
+            title=key.key_name,
+            description=render.availability(key, holders.get(key.key_name)),
+            # Название ключа - готовый ввод для /get_key, /find_key и /key_history
+            input_message_content=InputTextMessageContent(message_text=key.key_name),
+        )
+        for position, key in enumerate(page)
+    ]
+    await query.answer(
+        results,
+        cache_time=Config.INLINE_CACHE_TIME,
+        is_personal=len(registries.sites) > 1,  # у площадок разные ключи
+        next_offset=str(offset + len(page)) if len(keys) > offset + len(page) else "",
+    )
+
+
 class KeyHistoryState(StatesGroup):
     waiting_for_input = State()
 
 
 @dp.message(Command("key_history"))
-async def key_history(message: types.Message, state: FSMContext):
-    if not await BotUtils.check_permission(message.from_user.id, "user"):
+async def key_history(message: types.Message, command: CommandObject, state: FSMContext, site: sheets.Registry):
+    if not await BotUtils.check_permission(site, message.from_user.id, "user"):
         await message.answer("Вы не имеете доступа к этой команде.")
         return
-    await message.answer("Введите название ключа или номер базовой станции\n\n(/cancel для отмены)")
+    try:
+        since, until = BotUtils.parse_period(command.args)
+    except ValueError:
+        await message.answer("Использование: /key_history [с ДД.ММ.ГГГГ] [по ДД.ММ.ГГГГ] или /key_history 7д (за 7 дней)")
+        return
+    period = f"\nПериод: {render.period(since, until)}" if since or until else ""
+    await message.answer(f"Введите название ключа или номер базовой станции{period}\n\n(/cancel для отмены)")
     await state.set_state(KeyHistoryState.waiting_for_input)
+    await state.update_data(period=command.args or "")  # разбирается заново при ответе: "7д" отсчитывается от ответа
 
 
 @dp.message(KeyHistoryState.waiting_for_input)
-async def process_key_history(message: types.Message, state: FSMContext):
+async def process_key_history(message: types.Message, state: FSMContext, site: sheets.Registry):
     if message.text == "/cancel":
         await state.clear()
         await message.answer("Отменено.", reply_markup=types.ReplyKeyboardRemove())
         return
 
-    similarities = await KeyCommandMixin.find_similar_keys(message.text)
+    similarities = await KeyCommandMixin.find_similar_keys(site, message.text)
     if not similarities:
         await message.answer("Ключ не найден")
         await state.clear()
@@ -741,19 +1246,22 @@ async def process_key_history(message: types.Message, state: FSMContext):
         await message.answer("Выберите ключ из найденных:", reply_markup=markup)
         return
 
-    history_messages = await KeyCommandMixin.get_key_history(similarities[0])
+    since, until = BotUtils.parse_period((await state.get_data()).get("period"))
+    history_messages = await KeyCommandMixin.get_key_history(site, similarities[0], since, until)
     for msg in history_messages:
         await message.answer(msg, parse_mode="Markdown", reply_markup=types.ReplyKeyboardRemove())
+    await message.answer(
+        "Выгрузить историю файлом:", reply_markup=await BotUtils.export_markup("key", similarities[0], since, until))
     await state.clear()
 
 
 @dp.message(Command("my_keys"))
-async def my_keys(message: types.Message):
-    if not await BotUtils.check_permission(message.from_user.id, "user"):
+async def my_keys(message: types.Message, site: sheets.Registry):
+    if not await BotUtils.check_permission(site, message.from_user.id, "user"):
         await message.answer("Вы не имеете доступа к этой команде.")
         return
 
-    history_messages = await KeyCommandMixin.get_my_keys(message.from_user.id)
+    history_messages = await KeyCommandMixin.get_my_keys(site, message.from_user.id)
     if not history_messages:
         await message.answer("У вас нет взятых ключей")
         return
@@ -767,22 +1275,29 @@ class EmpHistoryState(StatesGroup):
 
 
 @dp.message(Command("emp_history"))
-async def emp_history(message: types.Message, state: FSMContext):
-    if not await BotUtils.check_permission(message.from_user.id, "user"):
+async def emp_history(message: types.Message, command: CommandObject, state: FSMContext, site: sheets.Registry):
+    if not await BotUtils.check_permission(site, message.from_user.id, "user"):
         await message.answer("Вы не имеете доступа к этой команде.")
         return
-    await message.answer("Введите ФИ сотрудника для поиска\n\n(/cancel для отмены)")
+    try:
+        since, until = BotUtils.parse_period(command.args)
+    except ValueError:
+        await message.answer("Использование: /emp_history [с ДД.ММ.ГГГГ] [по ДД.ММ.ГГГГ] или /emp_history 7д (за 7 дней)")
+        return
+    period = f"\nПериод: {render.period(since, until)}" if since or until else ""
+    await message.answer(f"Введите ФИ сотрудника для поиска{period}\n\n(/cancel для отмены)")
     await state.set_state(EmpHistoryState.waiting_for_input)
+    await state.update_data(period=command.args or "")  # разбирается заново при ответе: "7д" отсчитывается от ответа
 
 
 @dp.message(EmpHistoryState.waiting_for_input)
-async def process_emp_history(message: types.Message, state: FSMContext):
+async def process_emp_history(message: types.Message, state: FSMContext, site: sheets.Registry):
     if message.text == "/cancel":
         await state.clear()
         await message.answer("Отменено.", reply_markup=types.ReplyKeyboardRemove())
         return
 
-    similarities = await KeyCommandMixin.find_similar_employees(message.text)
+    similarities = await KeyCommandMixin.find_similar_employees(site, message.text)
     if not similarities:
         await message.answer("Сотрудник не найден")
         await state.clear()
@@ -793,12 +1308,42 @@ async def process_emp_history(message: types.Message, state: FSMContext):
         await message.answer("Выберите сотрудника из найденных:", reply_markup=markup)
         return
 
-    history_messages = await KeyCommandMixin.get_emp_history(similarities[0])
+    since, until = BotUtils.parse_period((await state.get_data()).get("period"))
+    history_messages = await KeyCommandMixin.get_emp_history(site, similarities[0], since, until)
     for msg in history_messages:
         await message.answer(msg, parse_mode="Markdown", reply_markup=types.ReplyKeyboardRemove())
+    await message.answer(
+        "Выгрузить историю файлом:", reply_markup=await BotUtils.export_markup("emp", similarities[0], since, until))
     await state.clear()
 
 
+@dp.callback_query(ExportCallback.filter())
+async def export_history(callback: CallbackQuery, callback_data: ExportCallback, site: sheets.Registry):
+    if not await BotUtils.check_permission(site, callback.from_user.id, "user"):
+        await callback.answer("Вы не имеете доступа к этой команде.")
+        return
+
+    payload = await payloads.get(callback_data.token)
+    if payload is None:
+        await callback.answer("Кнопка устарела, запросите историю заново")
+        return
+    file_format, kind, name = callback_data.file_format, payload["kind"], payload["name"]
+    # Кнопки, выданные до появления периода, хранят только kind и name
+    since, until = (datetime.fromisoformat(payload[bound]) if payload.get(bound) else None for bound in ("since", "until"))
+    if kind == "key":
+        entries = await asyncio.to_thread(site.keys_accounting.key_history, name, since, until)
+    else:
+        first_name, last_name = name.split(" ", 1)
+        entries = await asyncio.to_thread(site.keys_accounting.emp_history, first_name, last_name, since, until)
+
+    await callback.answer("Готовлю файл...")
+    path = await asyncio.to_thread(export.export_history, entries, site.keys_accounting.keys_headers, file_format)
+    try:
+        await callback.message.answer_document(FSInputFile(path, filename=f"{name}.{file_format}"))
+    finally:
+        os.remove(path)
+
+
 # endregion
 
 # region Security Commands
@@ -809,47 +1354,48 @@ class ReturnKeyState(StatesGroup):
 
 
 @dp.message(Command("not_returned"))
-async def not_returned(message: types.Message):
-    if not await BotUtils.check_permission(message.from_user.id, "security"):
+async def not_returned(message: types.Message, site: sheets.Registry):
+    if not await BotUtils.check_permission(site, message.from_user.id, "security"):
         await message.answer("⛔ Требуются права security")
         return
 
     try:
-        keys = keys_accounting_table.get_not_returned_keys()
+        keys = site.keys_accounting.get_not_returned_keys()
         if not keys:
             await message.answer("✅ Все ключи на месте")
             return
 
         for key in keys:
-            emp = emp_table.get_by_name(key.emp_firstname, key.emp_lastname)
+            emp = site.employees.get_by_name(key.emp_firstname, key.emp_lastname)
             if not emp:
                 continue
 
-            markup = BotUtils.make_keyboard([[
-                {"text": "Подтвердить возврат",
-                 "callback_data": f"return_key:{key.key_name}:{emp.telegram}"}
-            ]], inline=True)
+            markup = await BotUtils.return_markup(key.key_name, emp.telegram)
 
             await message.answer(
-                await KeyCommandMixin.format_key_entry(key, True),
+                await KeyCommandMixin.format_key_entry(site, key, True),
                 reply_markup=markup,
                 parse_mode="Markdown"
             )
 
     except Exception as e:
-        logger.err(e, "Error in not_returned")
+        log.error("Error in not_returned", exc_info=e)
         await message.answer("⚠ Ошибка при получении списка ключей")
 
 
-@dp.callback_query(F.data.startswith("return_key"))
-async def confirm_return(callback: CallbackQuery):
-    if not await BotUtils.check_permission(callback.from_user.id, "security"):
+@dp.callback_query(ReturnKeyCallback.filter(), flags={"idempotent": True})
+async def confirm_return(callback: CallbackQuery, callback_data: ReturnKeyCallback, site: sheets.Registry):
+    if not await BotUtils.check_permission(site, callback.from_user.id, "security"):
         await callback.answer("⛔ Требуются права security")
         return
 
     try:
-        _, key_name, user_id = callback.data.split(":")
-        keys_accounting_table.set_return_time_by_key_name(key_name)
+        payload = await payloads.get(callback_data.token)
+        if payload is None:
+            await callback.answer("Кнопка устарела, откройте список ключей заново")
+            return
+        key_name, user_id = payload["key_name"], payload["user_id"]
+        await site.submit(site.keys_accounting.set_return_time_by_key_name, key_name)
 
         await bot.send_message(
             chat_id=user_id,
@@ -859,14 +1405,15 @@ async def confirm_return(callback: CallbackQuery):
             text=f"{callback.message.text}\n\n✅ Возврат подтвержден",
             reply_markup=None
         )
+        return "✅ Возврат подтвержден"
     except Exception as e:
-        logger.err(e, "Error in confirm_return")
+        log.error("Error in confirm_return", exc_info=e)
         await callback.answer("⚠ Ошибка при подтверждении возврата")
 
 
 @dp.message(Command("return_key"))
-async def return_key_start(message: types.Message, state: FSMContext):
-    if not await BotUtils.check_permission(message.from_user.id, "security"):
+async def return_key_start(message: types.Message, state: FSMContext, site: sheets.Registry):
+    if not await BotUtils.check_permission(site, message.from_user.id, "security"):
         await message.answer("⛔ Требуются права security")
         return
 
@@ -879,7 +1426,7 @@ async def return_key_start(message: types.Message, state: FSMContext):
 
 
 @dp.message(ReturnKeyState.waiting_for_input)
-async def process_return_key(message: types.Message, state: FSMContext):
+async def process_return_key(message: types.Message, state: FSMContext, site: sheets.Registry):
     if message.text == "/cancel":
         await state.clear()
         await message.answer("❌ Отменено", reply_markup=types.ReplyKeyboardRemove())
@@ -889,55 +1436,52 @@ async def process_return_key(message: types.Message, state: FSMContext):
         msg = await message.answer("🔍 Поиск ключа...")
 
         # Поиск ключа
-        key = keys_table.get_by_name(message.text)
+        key = site.keys.get_by_name(message.text)
         if not key:
-            similarities = await KeyCommandMixin.find_similar_keys(message.text)
+            similarities = await KeyCommandMixin.find_similar_keys(site, message.text)
             if not similarities:
                 await msg.edit_text("🔴 Ключ не найден")
                 return
-            key = keys_table.get_by_name(similarities[0])
+            key = site.keys.get_by_name(similarities[0])
 
         # Проверка статуса
-        entries = keys_accounting_table.get_not_returned_keys()
+        entries = site.keys_accounting.get_not_returned_keys()
         entry = next((e for e in entries if e.key_name == key.key_name), None)
         if not entry:
             await msg.edit_text(
                 f"Ключ {key.key_name} уже на месте:\n\n" +
-                await KeyCommandMixin.get_key_state(key.key_name),
+                await KeyCommandMixin.get_key_state(site, key.key_name),
                 parse_mode="Markdown"
             )
             return
 
         # Получаем данные сотрудника
-        emp = emp_table.get_by_name(entry.emp_firstname, entry.emp_lastname)
+        emp = site.employees.get_by_name(entry.emp_firstname, entry.emp_lastname)
         if not emp:
             await msg.edit_text("⚠ Не удалось найти сотрудника")
             return
 
         # Формируем подтверждение
-        markup = BotUtils.make_keyboard([[
-            {"text": "Подтвердить возврат",
-             "callback_data": f"return_key:{key.key_name}:{emp.telegram}"}
-        ]], inline=True)
+        markup = await BotUtils.return_markup(key.key_name, emp.telegram)
 
         await msg.delete()
         await message.answer(
-            await KeyCommandMixin.format_key_entry(entry, True),
+            await KeyCommandMixin.format_key_entry(site, entry, True),
             reply_markup=markup,
             parse_mode="Markdown"
         )
         await state.clear()
 
     except Exception as e:
-        logger.err(e, "Error in process_return_key")
+        log.error("Error in process_return_key", exc_info=e)
         await message.answer("⚠ Ошибка при обработке запроса")
     finally:
         await state.clear()
 
 
 @dp.message(Command("key_history"))
-async def key_history_start(message: types.Message, state: FSMContext):
-    if not await BotUtils.check_permission(message.from_user.id, "security"):
+async def key_history_start(message: types.Message, state: FSMContext, site: sheets.Registry):
+    if not await BotUtils.check_permission(site, message.from_user.id, "security"):
         await message.answer("⛔ Требуются права security")
         return
 
@@ -955,26 +1499,63 @@ async def key_history_start(message: types.Message, state: FSMContext):
 
 
 @dp.message(Command("restart"))
-async def restart_bot(message: types.Message):
+async def restart_bot(message: types.Message, site: sheets.Registry):
     try:
-        if not (await BotUtils.check_permission(message.from_user.id, "admin")):
+        if not (await BotUtils.check_permission(site, message.from_user.id, "admin")):
             await message.answer("Вы не имеете доступа к этой команде.")
             return
 
-        admin = emp_table.get_by_telegram(message.from_user.id)
-        logger.log(f"Restart initiated by {admin.first_name} {admin.last_name}")
+        admin = site.employees.get_by_telegram(message.from_user.id)
+        log.info("Restart initiated by %s %s", admin.first_name, admin.last_name, extra={"telegram": True})
 
         await message.answer("♻️ Выполняется перезапуск...")
         await asyncio.sleep(1)
 
+        if cluster:
+            await cluster.close()  # свежие процессы-обработчики запустит перезапущенный процесс
+        else:
+            payloads.close()
         await dp.storage.close()
         await bot.session.close()
+        await asyncio.to_thread(profile_cache.flush)
+        await asyncio.to_thread(registries.close)  # снимки листов для быстрого старта после execv
+        logger.shutdown_logging()
 
         os.execv(sys.executable, [sys.executable] + sys.argv)
 
     except Exception as e:
         await message.answer(f"⚠ Ошибка: {str(e)}")
-        logger.err(e, "Restart failed")
+        log.error("Restart failed", exc_info=e)
+
+
+@dp.message(Command("report"))
+async def usage_report(message: types.Message, command: CommandObject, site: sheets.Registry):
+    if not await BotUtils.check_permission(site, message.from_user.id, "admin"):
+        await message.answer("Вы не имеете доступа к этой команде.")
+        return
+
+    args = (command.args or "").split()
+    file_format = "csv" if "csv" in args else "xlsx"
+    try:
+        dates = [datetime.strptime(arg, "%d.%m.%Y") for arg in args if arg != "csv"]
+    except ValueError:
+        await message.answer("Использование: /report [с ДД.ММ.ГГГГ] [по ДД.ММ.ГГГГ] [csv]")
+        return
+    since = dates[0] if dates else None
+    until = dates[1] + timedelta(days=1) if len(dates) > 1 else None
+
+    overdue_after = timedelta(days=site.config.get("overdue_after_days", 3))
+
+    def build():
+        columns = report.journal_columns(site.keys_accounting)  # тоже вне цикла событий: после правок журнал дочитывается
+        result = report.build_report(columns, since, until, overdue_after)
+        data = report.to_csv(result) if file_format == "csv" else report.to_xlsx(result)
+        return report.render_text(result), data
+
+    text, data = await asyncio.to_thread(build)
+    await message.answer(text, parse_mode="Markdown")
+    await message.answer_document(
+        BufferedInputFile(data, filename=f"report_{site.name}_{datetime.now():%Y-%m-%d}.{file_format}"))
 
 
 # endregion
@@ -999,9 +1580,10 @@ async def get_feedback(message: types.Message, state: FSMContext):
         await state.clear()
         return
 
-    logger.log(
-        f"New feedback:\nFrom: {message.from_user.first_name} {message.from_user.last_name} "
-        f"(@{message.from_user.username})\n\n```\n{message.text}```")
+    log.info(
+        "New feedback:\nFrom: %s %s (@%s)\n\n```\n%s```",
+        message.from_user.first_name, message.from_user.last_name, message.from_user.username, message.text,
+        extra={"telegram": True})
     await message.answer("Отправлено.")
     await state.clear()
 
@@ -1015,5 +1597,6 @@ async def echo(message: types.Message):
 
 
 if __name__ == "__main__":
+    logger.setup_logging()
     dp.message.middleware.register(LogCommandsMiddleware())
-    asyncio.run(main())
+    runtime.run(main(), runtime_profile)
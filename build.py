@@ -61,6 +61,22 @@ files = [
     "icon.ico",
     "logger.py",
     "sheets.py",
+    "events.py",
+    "watcher.py",
+    "snapshot.py",
+    "xlsxparse.py",
+    "aggregates.py",
+    "report.py",
+    "export.py",
+    "render.py",
+    "profiles.py",
+    "payloads.py",
+    "keyindex.py",
+    "intervals.py",
+    "pending.py",
+    "throttle.py",
+    "runtime.py",
+    "cluster.py",
     "bot.py"
 ]
 
@@ -0,0 +1,482 @@
+from typing import Awaitable, Callable
+from datetime import datetime
+from aiogram import Bot, Dispatcher
+from aiogram.fsm.storage.redis import RedisStorage, DefaultKeyBuilder
+from aiogram.methods import GetUpdates
+import redis.asyncio
+import subprocess
+import asyncio
+import logging
+import secrets
+import socket
+import math
+import json
+import uuid
+import sys
+import os
+
+from pending import PendingRequests
+from throttle import IdempotencyCache
+import sheets
+
+log = logging.getLogger(__name__)
+
+# Кластерный режим: несколько процессов бота с общим состоянием в Redis (или совместимом сервере).
+# Лидер выбирается арендой ключа: он один опрашивает Telegram, кладет апдейты в общую очередь,
+# выполняет фоновые задачи и пишет в книги площадок. Апдейты из очереди обрабатывают все процессы,
+# включая лидера; изменения книг остальные процессы пересылают лидеру через очередь записей.
+# Записи пересылаются в JSON, и лидер выполняет только методы из WRITE_METHODS
+
+WORKER_ENV = "KEYSBOT_WORKER"  # номер дочернего процесса-обработчика; у основного процесса не задан
+WRITE_METHODS = {  # таблица реестра -> ее изменяющие методы, которые можно переслать писателю
+    "keys_accounting": {"new_entry", "set_return_time", "set_return_time_by_key_name", "archive_closed_entries"},
+    "keys": {"new_key"},
+    "employees": {"new_employee"},
+    "bookings": {"new_booking", "set_status"},
+}
+REMOTE_ERRORS = {  # ошибки писателя, которые пересылаются вызывающему с их типом
+    error.__name__: error for error in (ValueError, TypeError, KeyError, sheets.WriteConflictError)
+}
+
+
+def _expire(ttl: float) -> int:
+    """Время жизни ключа в секундах: с запасом, чтобы таймер процесса срабатывал раньше Redis"""
+    return math.ceil(ttl) + 60
+
+
+# region Forwarded writes
+
+
+def _encode(value):
+    """Аргумент или результат пересылаемого изменения в JSON: записи журнала и брони - через их поля"""
+    if isinstance(value, sheets.Entry):
+        return {"$entry": value.to_dict()}
+    if isinstance(value, sheets.Booking):
+        return {"$booking": {**value.to_dict(), "row": value.row}}
+    if isinstance(value, datetime):
+        return {"$datetime": value.isoformat()}
+    if isinstance(value, (list, tuple)):
+        return [_encode(item) for item in value]
+    if isinstance(value, dict):
+        return {"$dict": {key: _encode(item) for key, item in value.items()}}
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    raise TypeError(f"Cannot forward {type(value).__name__} to the writer")
+
+
+def _decode(value):
+    if isinstance(value, list):
+        return [_decode(item) for item in value]
+    if isinstance(value, dict):
+        (tag, data), = value.items()
+        if tag == "$entry":
+            return sheets.Entry(**data)
+        if tag == "$booking":
+            return sheets.Booking(**data)
+        if tag == "$datetime":
+            return datetime.fromisoformat(data)
+        if tag == "$dict":
+            return {key: _decode(item) for key, item in data.items()}
+        raise ValueError(f"Unknown tag {tag!r} in a forwarded write")
+    return value
+
+
+def _encode_error(error: Exception) -> dict:
+    if isinstance(error, sheets.BookingConflictError):
+        return {"type": "BookingConflictError", "booking": _encode(error.booking), "conflicts": _encode(error.conflicts)}
+    name = type(error).__name__
+    if name in REMOTE_ERRORS:
+        return {"type": name, "message": str(error)}
+    return {"type": None, "message": repr(error)}  # остальные ошибки приходят вызывающему как RuntimeError
+
+
+def _decode_error(data: dict) -> Exception:
+    if data["type"] == "BookingConflictError":
+        return sheets.BookingConflictError(_decode(data["booking"]), _decode(data["conflicts"]))
+    return REMOTE_ERRORS.get(data["type"], RuntimeError)(data["message"])
+
+
+# endregion
+
+
+class RedisPayloadStore:
+    """Данные inline-кнопок в Redis; интерфейс как у payloads.PayloadStore"""
+
+    def __init__(self, client: redis.asyncio.Redis, prefix: str, ttl: float = 7 * 24 * 60 * 60):
+        self.client = client
+        self.prefix = prefix
+        self.ttl = ttl
+
+    async def put(self, data: dict, ttl: float = None) -> str:
+        value = json.dumps(data, ensure_ascii=False)
+        while True:
+            token = secrets.token_urlsafe(6)
+            if await self.client.set(f"{self.prefix}:{token}", value, nx=True, ex=math.ceil(ttl or self.ttl)):
+                return token
+
+    async def restore(self, token: str, data: dict, ttl: float = None):
+        await self.client.set(f"{self.prefix}:{token}", json.dumps(data, ensure_ascii=False), ex=math.ceil(ttl or self.ttl))
+
+    async def get(self, token: str) -> dict | None:
+        value = await self.client.get(f"{self.prefix}:{token}")
+        return None if value is None else json.loads(value)
+
+    async def pop(self, token: str) -> dict | None:
+        value = await self.client.getdel(f"{self.prefix}:{token}")  # атомарно: токен достается одному процессу
+        return None if value is None else json.loads(value)
+
+
+class RedisPendingRequests(PendingRequests):
+    """Ожидающие запросы ключей в Redis; интерфейс как у pending.PendingRequests"""
+
+    def __init__(self, client: redis.asyncio.Redis, prefix: str):
+        super().__init__()
+        self.client = client
+        self.prefix = prefix
+
+    async def is_requested(self, site: str, key_name: str) -> bool:
+        return bool(await self.client.exists(f"{self.prefix}:request:{site}:{key_name}"))
+
+    async def add_request(self, site: str, key_name: str, user_id: int, ttl: float):
+        await self.client.set(f"{self.prefix}:request:{site}:{key_name}", user_id, ex=_expire(ttl))
+
+    async def pop_request(self, site: str, key_name: str) -> int | None:
+        value = await self.client.getdel(f"{self.prefix}:request:{site}:{key_name}")
+        return None if value is None else int(value)
+
+    async def add_approval(self, token: str, text: str, messages: list[tuple[int, int]], ttl: float):
+        await self.client.set(f"{self.prefix}:approval:{token}", json.dumps([text, messages]), ex=_expire(ttl))
+
+    async def has_approval(self, token: str) -> bool:
+        return bool(await self.client.exists(f"{self.prefix}:approval:{token}"))
+
+    async def pop_approval(self, token: str) -> tuple[str, list[tuple[int, int]]] | None:
+        value = await self.client.getdel(f"{self.prefix}:approval:{token}")
+        if value is None:
+            return None
+        text, messages = json.loads(value)
+        return text, [tuple(message) for message in messages]
+
+
+class RedisIdempotencyCache(IdempotencyCache):
+    """Недавно обработанные нажатия в Redis: повтор, попавший в другой процесс, тоже узнается"""
+
+    def __init__(self, client: redis.asyncio.Redis, prefix: str):
+        super().__init__()
+        self.client = client
+        self.prefix = prefix
+
+    async def begin(self, key: str, ttl: float) -> tuple[bool, str | None]:
+        if await self.client.set(f"{self.prefix}:{key}", "", nx=True, ex=math.ceil(ttl)):
+            return True, None
+        value = await self.client.get(f"{self.prefix}:{key}")
+        return False, "" if value is None else value.decode("utf-8")
+
+    async def finish(self, key: str, result: str, ttl: float):
+        await self.client.set(f"{self.prefix}:{key}", result, ex=math.ceil(ttl))
+
+    async def discard(self, key: str):
+        await self.client.delete(f"{self.prefix}:{key}")
+
+
+class RedisHash:
+    """Хэш Redis со строковыми значениями (закрепление пользователей за площадками); интерфейс как у sheets.UserSites"""
+
+    def __init__(self, client: redis.asyncio.Redis, key: str):
+        self.client = client
+        self.key = key
+
+    async def get(self, field: str, default: str = None) -> str | None:
+        value = await self.client.hget(self.key, field)
+        return default if value is None else value.decode("utf-8")
+
+    async def set(self, field: str, value: str):
+        await self.client.hset(self.key, field, value)
+
+    async def setdefault(self, field: str, default: str) -> str:
+        await self.client.hsetnx(self.key, field, default)
+        return await self.get(field, default)
+
+
+class Cluster:
+    """
+    Процесс кластера бота. Общее состояние (FSM, данные кнопок, ожидающие запросы, площадки пользователей)
+    хранится в Redis; см. комментарий в начале модуля
+    """
+
+    def __init__(
+            self,
+            url: str,
+            prefix: str = "keysbot",
+            workers: int = 1,
+            lease: float = 10.0,
+            concurrency: int = 16,
+            write_timeout: float = 120.0,
+            polling_timeout: int = 30,
+    ):
+        self.url = url
+        self.prefix = prefix
+        self.workers = max(1, workers)  # сколько процессов запускает основной процесс, включая себя
+        self.lease = lease  # аренда лидера, сек; без продления другой процесс станет лидером через lease
+        self.concurrency = concurrency  # одновременно обрабатываемых апдейтов на процесс
+        self.write_timeout = write_timeout
+        self.polling_timeout = polling_timeout
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.aredis = redis.asyncio.Redis.from_url(url)
+        self.is_leader = False
+        self.registries = None
+        self._leader_tasks: list[asyncio.Task] = []
+        self._children: list[subprocess.Popen] = []
+
+    @classmethod
+    def from_config(cls, path: str) -> "Cluster":
+        """Читает cluster.json: redis_url и необязательные prefix, workers, leader_lease, concurrency, write_timeout"""
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return cls(
+            data["redis_url"],
+            prefix=data.get("prefix", "keysbot"),
+            workers=data.get("workers", 1),
+            lease=data.get("leader_lease", 10.0),
+            concurrency=data.get("concurrency", 16),
+            write_timeout=data.get("write_timeout", 120.0),
+        )
+
+    def key(self, *parts) -> str:
+        return ":".join((self.prefix, *map(str, parts)))
+
+    # region Shared state
+
+    def storage(self) -> RedisStorage:
+        return RedisStorage(self.aredis, key_builder=DefaultKeyBuilder(prefix=self.key("fsm")))
+
+    def payload_store(self) -> RedisPayloadStore:
+        return RedisPayloadStore(self.aredis, self.key("callback"))
+
+    def pending_requests(self) -> RedisPendingRequests:
+        return RedisPendingRequests(self.aredis, self.key("pending"))
+
+    def idempotency_cache(self) -> RedisIdempotencyCache:
+        return RedisIdempotencyCache(self.aredis, self.key("seen"))
+
+    def attach(self, registries):
+        """Изменения площадок идут через лидера, закрепление пользователей - в общем хэше (переносится в run)"""
+        self.registries = registries
+        registries.route_writes(self)
+
+    # endregion
+
+    # region Writes
+
+    async def forward(self, registry, func: Callable, args: tuple, kwargs: dict):
+        """Registry.submit на не-лидере: метод таблицы выполняет лидер, ответ возвращается через Redis"""
+        owner = getattr(func, "__self__", None)
+        table = next((name for name in WRITE_METHODS if getattr(registry, name) is owner), None)
+        if table is None or func.__name__ not in WRITE_METHODS[table]:
+            raise TypeError(f"Only table methods from WRITE_METHODS can be forwarded to the writer, got {func!r}")
+        job_id = uuid.uuid4().hex
+        await self.aredis.lpush(self.key("writes"), json.dumps({
+            "job": job_id, "site": registry.name, "table": table, "method": func.__name__,
+            "args": _encode(args), "kwargs": _encode(kwargs),
+        }, ensure_ascii=False))
+        reply = await self.aredis.brpop([self.key("reply", job_id)], timeout=self.write_timeout)
+        if reply is None:
+            raise TimeoutError(f"No reply from the writer of site '{registry.name}' in {self.write_timeout}s")
+        outcome = json.loads(reply[1])
+        if "error" in outcome:
+            raise _decode_error(outcome["error"])
+        return _decode(outcome["value"])
+
+    async def _serve_writes(self):
+        while True:
+            try:
+                item = await self.aredis.brpop([self.key("writes")], timeout=1)
+            except redis.RedisError as e:
+                log.warning("Failed to read forwarded writes: %s", e)
+                await asyncio.sleep(1)
+                continue
+            if item is not None:
+                # Отдельные задачи: пересланные изменения попадают в один пакет group commit
+                asyncio.create_task(self._apply_write(item[1]))
+
+    async def _apply_write(self, raw: bytes):
+        try:
+            job = json.loads(raw)
+            job_id, site, table, method = job["job"], job["site"], job["table"], job["method"]
+        except (ValueError, TypeError, KeyError) as e:
+            log.warning("Dropping malformed forwarded write: %s", e)
+            return
+        try:
+            if method not in WRITE_METHODS.get(table, ()):
+                raise TypeError(f"Method {table}.{method} cannot be forwarded to the writer")
+            registry = await self.registries.open(site)
+            value = await registry.submit(getattr(getattr(registry, table), method), *_decode(job["args"]),
+                                          **_decode(job["kwargs"]))
+            data = json.dumps({"value": _encode(value)}, ensure_ascii=False)
+        except Exception as e:
+            data = json.dumps({"error": _encode_error(e)}, ensure_ascii=False)
+        reply = self.key("reply", job_id)
+        async with self.aredis.pipeline(transaction=True) as pipe:
+            await pipe.lpush(reply, data).expire(reply, math.ceil(self.write_timeout)).execute()
+
+    # endregion
+
+    # region Updates
+
+    async def _poll(self, dp: Dispatcher, bot: Bot):
+        """Лидер: long polling Telegram, апдейты уходят в общую очередь"""
+        offset = await self.aredis.get(self.key("offset"))
+        get_updates = GetUpdates(
+            offset=int(offset) if offset else None,
+            timeout=self.polling_timeout,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+        request_timeout = int(bot.session.timeout + self.polling_timeout) if bot.session.timeout else None
+        while True:
+            try:
+                updates = await bot(get_updates, request_timeout=request_timeout)
+            except Exception as e:
+                log.warning("Failed to fetch updates: %s", e)
+                await asyncio.sleep(5)
+                continue
+            if not updates:
+                continue
+            get_updates.offset = updates[-1].update_id + 1
+            async with self.aredis.pipeline(transaction=True) as pipe:
+                pipe.lpush(self.key("updates"), *(
+                    update.model_dump_json(by_alias=True, exclude_unset=True) for update in updates))
+                pipe.set(self.key("offset"), get_updates.offset)
+                await pipe.execute()
+
+    async def _consume(self, dp: Dispatcher, bot: Bot):
+        """Все процессы: разбирают общую очередь апдейтов"""
+        slots = asyncio.Semaphore(self.concurrency)
+        while True:
+            await slots.acquire()
+            try:
+                item = await self.aredis.brpop([self.key("updates")], timeout=1)
+            except redis.RedisError as e:
+                log.warning("Failed to read the update queue: %s", e)
+                await asyncio.sleep(1)
+                item = None
+            if item is None:
+                slots.release()
+                continue
+            asyncio.create_task(self._handle(dp, bot, item[1], slots))
+
+    @staticmethod
+    async def _handle(dp: Dispatcher, bot: Bot, raw: bytes, slots: asyncio.Semaphore):
+        try:
+            await dp.feed_raw_update(bot, bot.session.json_loads(raw))
+        except Exception as e:
+            log.error("Failed to handle update from the shared queue", exc_info=e)
+        finally:
+            slots.release()
+
+    # endregion
+
+    # region Leadership
+
+    async def _if_leader(self, command: str, *args) -> bool:
+        """
+        Выполняет команду над ключом аренды, только если аренда все еще наша (WATCH/MULTI, без Lua:
+        работает и на Redis-совместимых серверах без скриптов)
+        """
+        key = self.key("leader")
+        async with self.aredis.pipeline(transaction=True) as pipe:
+            await pipe.watch(key)
+            if await pipe.get(key) != self.worker_id.encode():
+                return False
+            pipe.multi()
+            pipe.execute_command(command, key, *args)
+            try:
+                await pipe.execute()
+            except redis.WatchError:
+                return False
+            return True
+
+    async def _elect(self, dp: Dispatcher, bot: Bot, leader_jobs, poll_updates: bool):
+        lease_ms = int(self.lease * 1000)
+        while True:
+            try:
+                if self.is_leader:
+                    held = await self._if_leader("PEXPIRE", lease_ms)
+                else:
+                    held = await self.aredis.set(self.key("leader"), self.worker_id, nx=True, px=lease_ms)
+            except redis.RedisError as e:
+                log.warning("Leader election failed: %s", e)
+                held = False
+            if held and not self.is_leader:
+                log.info("Worker %s is now the cluster leader", self.worker_id)
+                self.is_leader = True
+                jobs = [self._serve_writes(), *(job() for job in leader_jobs)]
+                if poll_updates:
+                    jobs.append(self._poll(dp, bot))
+                self._leader_tasks = [asyncio.create_task(job) for job in jobs]
+            elif not held and self.is_leader:
+                log.warning("Worker %s lost cluster leadership", self.worker_id)
+                await self._step_down()
+            await asyncio.sleep(self.lease / 3)
+
+    async def _step_down(self):
+        self.is_leader = False
+        tasks, self._leader_tasks = self._leader_tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def run(
+            self,
+            dp: Dispatcher,
+            bot: Bot,
+            leader_jobs: list[Callable[[], Awaitable]] = (),
+            poll_updates: bool = True,
+    ):
+        """
+        Обрабатывает апдейты из общей очереди и участвует в выборах лидера, пока задачу не отменят.
+        leader_jobs - фоновые задачи, которые должны идти в одном экземпляре на кластер.
+        poll_updates=False - апдейты в очередь кладет кто-то другой (webhook, бенчмарк)
+        """
+        if os.environ.get(WORKER_ENV) is None:
+            self.spawn_workers()
+        if self.registries is not None:
+            await self.registries.share_user_sites(RedisHash(self.aredis, self.key("user_sites")))
+        workflow_data = {"dispatcher": dp, "bots": [bot], **dp.workflow_data}
+        await dp.emit_startup(bot=bot, **workflow_data)
+        try:
+            await asyncio.gather(self._elect(dp, bot, leader_jobs, poll_updates), self._consume(dp, bot))
+        finally:
+            was_leader = self.is_leader
+            await self._step_down()
+            if was_leader:
+                await self._if_leader("DEL")
+            await dp.emit_shutdown(bot=bot, **workflow_data)
+
+    # endregion
+
+    # region Processes
+
+    def spawn_workers(self):
+        """Основной процесс запускает workers - 1 дочерних процессов той же программы"""
+        for number in range(1, self.workers):
+            env = {**os.environ, WORKER_ENV: str(number)}
+            args = [sys.executable, *(sys.argv[1:] if getattr(sys, "frozen", False) else sys.argv)]
+            self._children.append(subprocess.Popen(args, env=env, stdin=subprocess.DEVNULL))
+        if self._children:
+            log.info("Started %s cluster workers", len(self._children))
+
+    def stop_workers(self):
+        for child in self._children:
+            child.terminate()
+        for child in self._children:
+            try:
+                child.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                child.kill()
+        self._children = []
+
+    async def close(self):
+        self.stop_workers()
+        await self.aredis.aclose()
+
+    # endregion
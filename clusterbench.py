@@ -0,0 +1,161 @@
+import multiprocessing
+import threading
+import argparse
+import tempfile
+import asyncio
+import logging
+import socket
+import random
+import json
+import time
+import os
+
+log = logging.getLogger(__name__)
+
+BENCH_TOKEN = "123456:" + "A" * 35  # токен правильного вида; к Bot API бенчмарк не обращается
+
+
+def _serve_fake_redis() -> str:
+    """Redis-совместимый сервер fakeredis в потоке этого процесса; URL для подключения"""
+    from fakeredis import TcpFakeServer
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = TcpFakeServer(("127.0.0.1", port))
+    threading.Thread(target=server.serve_forever, name="fakeredis", daemon=True).start()
+    return f"redis://127.0.0.1:{port}/0"
+
+
+def _make_site(directory: str, keys: int) -> dict:
+    """Книга площадки с keys ключами и одним сотрудником; конфиг площадки для RegistryPool"""
+    import sheets
+
+    config = {
+        "excel_file_path": os.path.join(directory, "keys.xlsx"),
+        "keys_accounting_wks": "Журнал",
+        "keys_wks": "Ключи",
+        "employees_wks": "Сотрудники",
+    }
+    registry = sheets.Registry("bench", config)
+
+    async def fill():
+        await asyncio.gather(*(registry.submit(registry.keys.new_key, f"БС-{number:04d}", 1) for number in range(keys)))
+        await registry.submit(registry.employees.new_employee, "Тест", "Тестов", "79990000000", "1", ["user"])
+
+    asyncio.run(fill())
+    registry.close()
+    return config
+
+
+def _update(number: int, keys: int) -> str:
+    """Сообщение с названием ключа, как в /get_key; каждое десятое - с опечаткой (нечеткий поиск)"""
+    query = f"БС-{random.randrange(keys):04d}"
+    if number % 10 == 0:
+        query = query.replace("-", " ")
+    user_id = 1000 + number % 50
+    return json.dumps({"update_id": number, "message": {
+        "message_id": number, "date": int(time.time()), "text": query,
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+    }})
+
+
+def _worker(url: str, prefix: str, site_config: dict, latency: float, write_every: int):
+    """Процесс кластера: обработчик повторяет работу /get_key - поиск ключа, состояние FSM, ответ, запись"""
+    logging.basicConfig(level=logging.WARNING)
+    from aiogram import Bot, Dispatcher, types
+    from aiogram.fsm.context import FSMContext
+    from cluster import Cluster
+    import sheets
+
+    cluster = Cluster(url, prefix=prefix, lease=2)
+    registries = sheets.RegistryPool({"bench": site_config})
+    cluster.attach(registries)
+    dp = Dispatcher(storage=cluster.storage())
+    done = cluster.key("bench", "done")
+
+    @dp.message()
+    async def handle(message: types.Message, state: FSMContext):
+        site = await registries.open()
+        key = site.keys.get_by_name(message.text)
+        names = {k.key_name for k in site.keys.get_all_keys()}
+        similar = [key.key_name] if key else sheets.find_similar(message.text, names)
+        busy = {entry.key_name for entry in site.keys_accounting.get_not_returned_keys()}
+        await state.update_data(key=similar[0] if similar else None, busy=similar[0] in busy if similar else False)
+        await asyncio.sleep(latency)  # ответ пользователю через Bot API
+        if similar and message.message_id % write_every == 0:
+            await site.submit(site.keys_accounting.new_entry, similar[0], "Тест", "Тестов", "79990000000")
+        await cluster.aredis.incr(done)
+
+    async def run():
+        await cluster.aredis.incr(cluster.key("bench", "ready"))
+        await cluster.run(dp, Bot(BENCH_TOKEN), poll_updates=False)
+
+    asyncio.run(run())
+
+
+def bench(url: str, workers: int, updates: int, keys: int, latency: float, write_every: int, site_config: dict) -> float:
+    """Обновлений в секунду при workers процессах"""
+    import redis
+
+    prefix = f"bench{workers}"
+    client = redis.Redis.from_url(url)
+    client.delete(*(f"{prefix}:bench:{name}" for name in ("ready", "done")))
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=_worker, args=(url, prefix, site_config, latency, write_every), daemon=True)
+        for _ in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        while int(client.get(f"{prefix}:bench:ready") or 0) < workers:
+            time.sleep(0.1)
+        while client.get(f"{prefix}:leader") is None:
+            time.sleep(0.1)
+        # Прогрев: workbook загружен в каждом процессе до начала замера
+        warmup = [_update(number, keys) for number in range(1, workers * 10 + 1)]
+        client.lpush(f"{prefix}:updates", *warmup)
+        while int(client.get(f"{prefix}:bench:done") or 0) < len(warmup):
+            time.sleep(0.05)
+
+        batch = [_update(number, keys) for number in range(len(warmup) + 1, len(warmup) + updates + 1)]
+        target = len(warmup) + updates
+        started = time.perf_counter()
+        client.lpush(f"{prefix}:updates", *batch)
+        while int(client.get(f"{prefix}:bench:done") or 0) < target:
+            time.sleep(0.01)
+        return updates / (time.perf_counter() - started)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+        client.close()
+
+
+def main():
+    """Пропускная способность кластерного режима при разном числе процессов"""
+    parser = argparse.ArgumentParser(description="Throughput of the cluster mode for 1, 2, 4... worker processes")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="worker counts to measure")
+    parser.add_argument("--updates", type=int, default=2000, help="updates per measurement")
+    parser.add_argument("--keys", type=int, default=1000, help="keys in the benchmark workbook")
+    parser.add_argument("--latency", type=float, default=0.05, help="simulated Bot API reply latency, seconds")
+    parser.add_argument("--write-every", type=int, default=20, help="every N-th update writes a journal entry")
+    parser.add_argument("--redis", help="Redis URL (default: in-process fakeredis server)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    url = args.redis or _serve_fake_redis()
+    with tempfile.TemporaryDirectory() as directory:
+        site_config = _make_site(directory, args.keys)
+        baseline = None
+        for workers in args.workers:
+            rate = bench(url, workers, args.updates, args.keys, args.latency, args.write_every, site_config)
+            baseline = baseline or rate
+            log.info("%s worker(s): %.0f updates/s (x%.2f)", workers, rate, rate / baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+import argparse
+import tempfile
+import logging
+import random
+import timeit
+import os
+
+log = logging.getLogger(__name__)
+
+
+def _sort_values_by_headers(russian_headers, values, keys_headers):
+    """sort_values_by_headers до ColumnMap: соответствие столбцов считается заново для каждой строки"""
+    header_to_key = {v: k for k, v in keys_headers.items()}
+    sorted_keys = [header_to_key[header] for header in russian_headers]
+    value_dict = dict(zip(keys_headers.keys(), values))
+    return [value_dict[key] for key in sorted_keys]
+
+
+def main():
+    """Перестановка значений строки журнала в порядок столбцов листа: по строке против ColumnMap"""
+    parser = argparse.ArgumentParser(description="Column mapping per row vs ColumnMap built once per header set")
+    parser.add_argument("--rows", type=int, default=200000, help="rows per measurement")
+    parser.add_argument("--repeat", type=int, default=5, help="measurements per variant, the best one is reported")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    logging.getLogger("sheets").setLevel(logging.WARNING)
+    import sheets
+
+    with tempfile.TemporaryDirectory() as directory:  # заголовки журнала задает сама таблица
+        registry = sheets.Registry("bench", {
+            "excel_file_path": os.path.join(directory, "keys.xlsx"),
+            "keys_accounting_wks": "Журнал",
+            "keys_wks": "Ключи",
+            "employees_wks": "Сотрудники",
+            "snapshot": False,
+            "watch_file": False,
+        })
+        keys_headers = registry.keys_accounting.keys_headers
+        registry.close()
+    headers = list(keys_headers.values())
+    random.Random(0).shuffle(headers)  # столбцы листа переставлены вручную
+    row = ("БС-0001", "Иван", "Петров", "79990000000", "2024-01-01 10:00:00", None, "")
+
+    columns = sheets.ColumnMap(headers, keys_headers)
+    assert columns(row) == _sort_values_by_headers(headers, row, keys_headers)
+    variants = [
+        ("per-row mapping", lambda: _sort_values_by_headers(headers, row, keys_headers)),
+        ("ColumnMap", lambda: columns(row)),
+    ]
+    for name, call in variants:
+        cost = min(timeit.repeat(call, number=args.rows, repeat=args.repeat)) / args.rows * 1e6
+        log.info("%s: %.2f us/row", name, cost)
+
+
+if __name__ == "__main__":
+    main()
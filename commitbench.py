@@ -0,0 +1,99 @@
+import argparse
+import tempfile
+import asyncio
+import logging
+import time
+import os
+
+log = logging.getLogger(__name__)
+
+SITE_CONFIG = {
+    "keys_accounting_wks": "Журнал",
+    "keys_wks": "Ключи",
+    "employees_wks": "Сотрудники",
+    "snapshot": False,
+    "watch_file": False,
+}
+
+
+def _make_book(path: str, rows: int):
+    """Книга площадки с журналом из rows записей (все ключи возвращены)"""
+    import sheets
+
+    registry = sheets.Registry("bench", {**SITE_CONFIG, "excel_file_path": path, "commit_max_ops": rows})
+    journal = registry.keys_accounting
+
+    async def fill():
+        await asyncio.gather(*(
+            registry.submit(journal.new_entry, f"БС-{number:04d}", "Сотрудник", f"Номер{number}", "79990000000")
+            for number in range(rows)))
+        await asyncio.gather(*(
+            registry.submit(journal.set_return_time, entry) for entry in journal.get_not_returned_keys()))
+
+    try:
+        asyncio.run(fill())
+    finally:
+        registry.close()
+
+
+def approve(path: str, approvals: int, window: float, max_ops: int) -> tuple[float, int]:
+    """Секунды на approvals одновременных одобрений выдачи и число сохранений файла"""
+    import sheets
+
+    registry = sheets.Registry("bench", {
+        **SITE_CONFIG,
+        "excel_file_path": path,
+        "commit_window": window,
+        "commit_max_ops": max_ops,
+    })
+    journal = registry.keys_accounting
+    saves = 0
+    save = registry.save
+
+    def counted_save(*args, **kwargs):
+        nonlocal saves
+        saves += 1
+        return save(*args, **kwargs)
+
+    registry.save = counted_save
+
+    async def run():
+        await asyncio.gather(*(
+            registry.submit(journal.new_entry, f"Одобрено-{number}", "Охрана", f"Номер{number}", "79990000000")
+            for number in range(approvals)))
+
+    try:
+        started = time.perf_counter()
+        asyncio.run(run())
+        return time.perf_counter() - started, saves
+    finally:
+        registry.close()
+
+
+def main():
+    """Одновременные одобрения выдачи: сохранение на каждое изменение против группового сохранения"""
+    parser = argparse.ArgumentParser(description="Concurrent approvals: a save per mutation vs group commit")
+    parser.add_argument("--rows", type=int, default=300, help="journal rows before the burst")
+    parser.add_argument("--approvals", type=int, default=100, help="concurrent approvals")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    logging.getLogger("sheets").setLevel(logging.WARNING)
+    with tempfile.TemporaryDirectory() as directory:
+        original = os.path.join(directory, "original.xlsx")
+        _make_book(original, args.rows)
+        with open(original, "rb") as f:
+            book = f.read()
+        for name, window, max_ops in (
+                ("save per approval", 0, 1),
+                ("group commit", 0.05, 100),
+        ):
+            path = os.path.join(directory, "keys.xlsx")
+            with open(path, "wb") as f:
+                f.write(book)
+            elapsed, saves = approve(path, args.approvals, window, max_ops)
+            log.info("%s: %.2fs, %s saves", name, elapsed, saves)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+from dataclasses import dataclass, asdict
+from datetime import datetime
+from contextlib import nullcontext
+from typing import AsyncIterator, Callable, ContextManager, Iterator
+import asyncio
+import logging
+import json
+import os
+import threading
+
+log = logging.getLogger(__name__)
+
+
+# region Constants
+
+
+KEY_ISSUED = "key_issued"
+KEY_RETURNED = "key_returned"
+KEY_ADDED = "key_added"
+EMPLOYEE_REGISTERED = "employee_registered"
+ROWS_CHANGED = "rows_changed"  # строки листа изменены вне бота
+ENTRIES_ARCHIVED = "entries_archived"
+BOOKING_ADDED = "booking_added"
+BOOKING_STATUS_CHANGED = "booking_status_changed"  # бронь отменена, истекла или превращена в запрос
+
+INDEX_STEP = 256  # каждая 256-я запись попадает в разреженный индекс смещений
+READ_BATCH = 256  # сколько событий подписчик читает из файла за один поход в поток
+
+
+# endregion
+
+
+# region Event log
+
+
+@dataclass
+class Event:
+    offset: int
+    type: str
+    ts: str
+    data: dict
+
+    def to_json(self) -> str:
+        return json.dumps(asdict(self), ensure_ascii=False, default=str)
+
+    @classmethod
+    def from_json(cls, line: str) -> "Event":
+        return cls(**json.loads(line))
+
+
+class EventLog:
+    """
+    Append-only журнал событий (JSONL) с монотонно растущими смещениями.
+    Подписчики читают поток с любого смещения и ждут новых событий.
+    Файл может быть общим для нескольких процессов (кластер, смена лидера): смещение следующей записи
+    берется из самого файла под межпроцессной блокировкой shared_lock, а чтение идет до конца файла.
+    fsync=False оставляет сброс записей на диск операционной системе
+    """
+
+    def __init__(self, path: str, shared_lock: Callable[[], ContextManager] = None, poll_interval: float = 1.0,
+                 fsync: bool = True):
+        self.path = path
+        self.shared_lock = shared_lock or nullcontext  # None - файл пишет только этот процесс
+        self.poll_interval = poll_interval  # как часто подписчики проверяют записи других процессов, сек
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._listeners: list[Callable[[Event], None]] = []
+        self._waiters: set[tuple[asyncio.AbstractEventLoop, asyncio.Event]] = set()
+        self._index: list[int] = []  # байтовая позиция записи со смещением i * INDEX_STEP
+        self._size = 0  # байт до конца последней прочитанной полной записи
+        self.next_offset = 0
+        with self._lock:
+            self._scan()
+        self._file = open(self.path, "ab")
+
+    def _scan(self) -> bool:
+        """
+        Дочитывает записи, появившиеся в файле после self._size (в том числе записанные другими процессами):
+        продвигает next_offset и индекс. Вызывать под self._lock. True, если в конце файла недописанная строка
+        """
+        try:
+            if os.path.getsize(self.path) == self._size:
+                return False
+        except FileNotFoundError:
+            return False
+        with open(self.path, "rb") as f:
+            f.seek(self._size)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    return True  # другой процесс еще пишет строку или упал посреди записи
+                event = Event.from_json(line.decode("utf-8"))
+                if event.offset % INDEX_STEP == 0 and event.offset // INDEX_STEP == len(self._index):
+                    self._index.append(self._size)
+                self.next_offset = event.offset + 1
+                self._size += len(line)
+        return False
+
+    def append(self, event_type: str, **data) -> Event:
+        """Добавляет событие в журнал и будит подписчиков"""
+        return self.append_many([(event_type, data)])[0]
+
+    def append_many(self, items: list[tuple[str, dict]]) -> list[Event]:
+        """Добавляет события (тип, данные) одной записью с одним fsync - для пакета group commit"""
+        if not items:
+            return []
+        with self._lock, self.shared_lock():
+            if self._scan():  # под межпроцессной блокировкой никто не пишет: это остаток сбоя
+                log.warning("Truncating incomplete event at byte %s of %s", self._size, self.path)
+                with open(self.path, "r+b") as tail:
+                    tail.truncate(self._size)
+            if self._file.closed:
+                self._file = open(self.path, "ab")
+            ts = datetime.now().isoformat(timespec="seconds")
+            new_events, index = [], []
+            chunk = bytearray()
+            for number, (event_type, data) in enumerate(items):
+                event = Event(self.next_offset + number, event_type, ts, data)
+                if event.offset % INDEX_STEP == 0:
+                    index.append(self._size + len(chunk))
+                chunk += event.to_json().encode("utf-8") + b"\n"
+                new_events.append(event)
+            self._file.write(chunk)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self._index.extend(index)
+            self.next_offset += len(new_events)
+            self._size += len(chunk)
+            listeners = list(self._listeners)
+            waiters = list(self._waiters)
+
+        for event in new_events:
+            for callback in listeners:
+                try:
+                    callback(event)
+                except Exception as e:
+                    log.error("Error in event listener %s", callback, exc_info=e)
+        for loop, waiter in waiters:
+            loop.call_soon_threadsafe(waiter.set)
+        return new_events
+
+    def read(self, offset: int = 0, limit: int = None) -> Iterator[Event]:
+        """Читает события начиная с offset (включительно) до конца файла, но не больше limit"""
+        with self._lock:
+            self._scan()
+            end = self._size
+            index_pos = min(offset // INDEX_STEP, len(self._index) - 1) if offset > 0 else -1
+            start = self._index[index_pos] if index_pos >= 0 else 0
+        if start >= end:
+            return
+        with open(self.path, "rb") as f:
+            f.seek(start)
+            position = start
+            for line in f:
+                position += len(line)
+                if position > end:
+                    break  # дописано после _scan; прочитается следующим вызовом
+                event = Event.from_json(line.decode("utf-8"))
+                if event.offset >= offset:
+                    yield event
+                    if limit is not None:
+                        limit -= 1
+                        if limit <= 0:
+                            break
+
+    def listen(self, callback: Callable[[Event], None]):
+        """Синхронный слушатель, вызывается сразу после записи события"""
+        with self._lock:
+            self._listeners.append(callback)
+
+    def unlisten(self, callback: Callable[[Event], None]):
+        with self._lock:
+            if callback in self._listeners:
+                self._listeners.remove(callback)
+
+    async def subscribe(self, offset: int = 0) -> AsyncIterator[Event]:
+        """
+        Асинхронный поток событий начиная с offset. Для продолжения после перезапуска
+        передайте смещение последнего обработанного события + 1. Файл читается в потоке, порциями по READ_BATCH
+        """
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self._lock:
+            self._waiters.add(waiter)
+        try:
+            while True:
+                waiter[1].clear()
+                batch = await asyncio.to_thread(lambda: list(self.read(offset, READ_BATCH)))
+                for event in batch:
+                    offset = event.offset + 1
+                    yield event
+                if len(batch) < READ_BATCH and offset >= self.next_offset:
+                    try:  # записи других процессов будильник не поднимают: проверяем файл раз в poll_interval
+                        await asyncio.wait_for(waiter[1].wait(), self.poll_interval)
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            with self._lock:
+                self._waiters.discard(waiter)
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+# endregion
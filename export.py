@@ -0,0 +1,59 @@
+from datetime import datetime
+from typing import Iterable, Iterator
+import tempfile
+import logging
+import csv
+import os
+
+log = logging.getLogger(__name__)
+
+export_formats = ("csv", "xlsx")
+
+
+def history_rows(entries: Iterable, headers: dict[str, str]) -> Iterator[list]:
+    """Строка заголовков, затем по одной строке на запись журнала. headers: атрибут Entry -> заголовок"""
+    yield list(headers.values())
+    for entry in entries:
+        row = []
+        for attribute in headers:
+            value = getattr(entry, attribute)
+            if isinstance(value, datetime):
+                value = value.strftime("%d.%m.%Y %H:%M")
+            row.append("" if value is None else value)
+        yield row
+
+
+def write_csv(path: str, rows: Iterable[list]):
+    # utf-8-sig и ";" чтобы Excel сразу открыл файл с кириллицей по столбцам
+    with open(path, "w", encoding="utf-8-sig", newline="") as f:
+        writer = csv.writer(f, delimiter=";")
+        for row in rows:
+            writer.writerow(row)
+
+
+def write_xlsx(path: str, rows: Iterable[list]):
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)  # строки сразу уходят во временный файл, а не копятся в памяти
+    ws = wb.create_sheet("История")
+    for row in rows:
+        ws.append(row)
+    wb.save(path)
+
+
+def export_history(entries: Iterable, headers: dict[str, str], file_format: str = "xlsx") -> str:
+    """
+    Потоково записывает записи журнала во временный файл и возвращает путь к нему.
+    Блокирующая функция, из бота вызывается через asyncio.to_thread. Файл удаляет вызывающий
+    """
+    if file_format not in export_formats:
+        raise ValueError(f"Unknown export format: {file_format}")
+    fd, path = tempfile.mkstemp(prefix="history_", suffix=f".{file_format}")
+    os.close(fd)
+    try:
+        writer = write_csv if file_format == "csv" else write_xlsx
+        writer(path, history_rows(entries, headers))
+    except Exception:
+        os.remove(path)
+        raise
+    log.debug("History exported to %s (%s bytes)", path, os.path.getsize(path))
+    return path
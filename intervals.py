@@ -0,0 +1,139 @@
+from typing import Iterable
+import random
+
+# Дерево интервалов для броней ключей: декартово дерево (treap) по началу интервала,
+# в каждом узле хранится максимальный конец в поддереве. Вставка, удаление и поиск
+# пересечений с окном - O(log n + k) в среднем, где k - число найденных интервалов
+
+
+class _Node:
+    __slots__ = ("start", "end", "value", "priority", "max_end", "left", "right")
+
+    def __init__(self, start, end, value):
+        self.start = start
+        self.end = end
+        self.value = value
+        self.priority = random.random()
+        self.max_end = end  # максимальный конец в поддереве
+        self.left: _Node | None = None
+        self.right: _Node | None = None
+
+    def update(self):
+        self.max_end = self.end
+        if self.left is not None and self.left.max_end > self.max_end:
+            self.max_end = self.left.max_end
+        if self.right is not None and self.right.max_end > self.max_end:
+            self.max_end = self.right.max_end
+
+
+def _split(node: _Node | None, key: tuple, inclusive: bool) -> tuple[_Node | None, _Node | None]:
+    """Делит дерево на (start, end) < key (<= key при inclusive) и остальное"""
+    if node is None:
+        return None, None
+    node_key = (node.start, node.end)
+    if node_key < key or inclusive and node_key == key:
+        node.right, right = _split(node.right, key, inclusive)
+        node.update()
+        return node, right
+    left, node.left = _split(node.left, key, inclusive)
+    node.update()
+    return left, node
+
+
+def _merge(left: _Node | None, right: _Node | None) -> _Node | None:
+    """Склеивает деревья, все ключи left не больше ключей right"""
+    if left is None or right is None:
+        return left or right
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        left.update()
+        return left
+    right.left = _merge(left, right.left)
+    right.update()
+    return right
+
+
+class IntervalTree:
+    """Полуинтервалы [start, end) со значениями; одинаковые интервалы допускаются"""
+
+    def __init__(self, intervals: Iterable[tuple] = ()):
+        self.root: _Node | None = None
+        self._size = 0
+        for start, end, value in intervals:
+            self.insert(start, end, value)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def insert(self, start, end, value):
+        left, right = _split(self.root, (start, end), inclusive=True)
+        self.root = _merge(_merge(left, _Node(start, end, value)), right)
+        self._size += 1
+
+    def remove(self, start, end, value) -> bool:
+        """Удаляет интервал со значением value (сравнение через ==). False, если его нет"""
+        left, rest = _split(self.root, (start, end), inclusive=False)
+        same, right = _split(rest, (start, end), inclusive=True)
+        nodes = []
+        stack = [same] if same is not None else []
+        while stack:
+            node = stack.pop()
+            nodes.append(node)
+            stack.extend(child for child in (node.left, node.right) if child is not None)
+        removed = next((node for node in nodes if node.value == value), None)
+        same = None
+        for node in nodes:  # интервалы с одинаковыми границами: обычно один-два узла
+            if node is not removed:
+                node.left = node.right = None
+                node.update()
+                same = _merge(same, node)
+        self.root = _merge(_merge(left, same), right)
+        if removed is not None:
+            self._size -= 1
+        return removed is not None
+
+    def overlapping(self, start, end) -> list[tuple]:
+        """(start, end, value) интервалов, пересекающихся с [start, end), по возрастанию начала"""
+        found = []
+
+        def visit(node: _Node | None):
+            if node is None or node.max_end <= start:
+                return  # все интервалы поддерева закончились до окна
+            visit(node.left)
+            if node.start >= end:
+                return  # у правого поддерева начало тоже не раньше конца окна
+            if node.end > start:
+                found.append((node.start, node.end, node.value))
+            visit(node.right)
+
+        visit(self.root)
+        return found
+
+    def __iter__(self):
+        stack, node = [], self.root
+        while stack or node is not None:
+            while node is not None:
+                stack.append(node)
+                node = node.left
+            node = stack.pop()
+            yield node.start, node.end, node.value
+            node = node.right
+
+
+def max_depth(intervals: Iterable[tuple], start=None, end=None) -> int:
+    """Наибольшее число одновременно открытых интервалов (start, end, ...) внутри окна [start, end)"""
+    points = []
+    for interval_start, interval_end, *_ in intervals:
+        if start is not None and interval_start < start:
+            interval_start = start
+        if end is not None and interval_end > end:
+            interval_end = end
+        if interval_start < interval_end:
+            points.append((interval_start, 1))
+            points.append((interval_end, -1))
+    points.sort()  # при равном времени -1 раньше +1: [a, b) и [b, c) не пересекаются
+    depth = deepest = 0
+    for _, delta in points:
+        depth += delta
+        deepest = max(deepest, depth)
+    return deepest
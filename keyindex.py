@@ -0,0 +1,139 @@
+from collections import OrderedDict
+from typing import Iterable
+import threading
+import re
+
+# Префиксный поиск ключей для inline-режима: сжатое префиксное дерево (radix tree) по названиям ключей
+# и отдельное - по словам и номерам внутри названий ("БС-0123 Ленина" находится по "бс-01", "0123", "123", "лен")
+
+_separators = re.compile(r"[\s\-_/.,:;()]+")
+_digits = re.compile(r"\d+")
+
+
+def normalize(text: str) -> str:
+    """Форма для сравнения: без регистра, ё = е, пробелы схлопнуты"""
+    return " ".join(text.casefold().replace("ё", "е").split())
+
+
+def tokens(name: str) -> set[str]:
+    """Слова и номера внутри названия, кроме начала самого названия"""
+    normalized = normalize(name)
+    found = {word for word in _separators.split(normalized) if word}
+    for number in _digits.findall(normalized):
+        found.add(number)
+        found.add(number.lstrip("0") or "0")  # номер БС ищут и без ведущих нулей
+    found.discard(normalized)
+    return found
+
+
+class _Node:
+    __slots__ = ("label", "children", "values")
+
+    def __init__(self, label: str = ""):
+        self.label = label  # ребро от родителя
+        self.children: dict[str, _Node] = {}  # первый символ ребра -> узел
+        self.values: dict | None = None  # значения строк, заканчивающихся в узле (dict: порядок вставки, без повторов)
+
+
+class RadixTree:
+    """Строка -> значения. Ребра сжаты: цепочки узлов с одним потомком хранятся одной строкой"""
+
+    def __init__(self):
+        self.root = _Node()
+
+    def insert(self, word: str, value):
+        node = self.root
+        while word:
+            child = node.children.get(word[0])
+            if child is None:
+                child = node.children[word[0]] = _Node(word)
+                node = child
+                break
+            common = 0
+            limit = min(len(word), len(child.label))
+            while common < limit and word[common] == child.label[common]:
+                common += 1
+            if common < len(child.label):  # ребро расходится со словом: делим его
+                middle = _Node(child.label[:common])
+                child.label = child.label[common:]
+                middle.children[child.label[0]] = child
+                node.children[word[0]] = middle
+                child = middle
+            node, word = child, word[common:]
+        if node.values is None:
+            node.values = {}
+        node.values[value] = None
+
+    def _find(self, prefix: str) -> _Node | None:
+        node = self.root
+        while prefix:
+            child = node.children.get(prefix[0])
+            if child is None:
+                return None
+            if prefix.startswith(child.label):
+                prefix = prefix[len(child.label):]
+            elif child.label.startswith(prefix):
+                prefix = ""
+            else:
+                return None
+            node = child
+        return node
+
+    def search(self, prefix: str, limit: int, exclude: set = frozenset()) -> list:
+        """Значения строк с префиксом prefix в порядке строк, без повторов, не больше limit"""
+        node = self._find(prefix)
+        found = []
+        if node is None or limit <= 0:
+            return found
+        seen = set(exclude)
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            for value in node.values or ():
+                if value not in seen:
+                    seen.add(value)
+                    found.append(value)
+                    if len(found) >= limit:
+                        return found
+            stack.extend(node.children[first] for first in sorted(node.children, reverse=True))
+        return found
+
+
+class KeyIndex:
+    """
+    Автодополнение названий ключей: сначала совпадения с началом названия, затем со словами и номерами в нем.
+    Результаты кэшируются по префиксу (LRU); кэш сбрасывается при добавлении ключа
+    """
+
+    def __init__(self, names: Iterable[str] = (), cache_size: int = 4096):
+        self._names = RadixTree()
+        self._tokens = RadixTree()
+        self._cache: OrderedDict[str, list[str]] = OrderedDict()
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+        for name in names:
+            self.add(name)
+
+    def add(self, name: str):
+        with self._lock:
+            self._names.insert(normalize(name), name)
+            for token in tokens(name):
+                self._tokens.insert(token, name)
+            self._cache.clear()
+
+    def search(self, prefix: str, limit: int = 50) -> list[str]:
+        prefix = normalize(prefix)
+        with self._lock:
+            cached = self._cache.get(prefix)
+            if cached is not None and (len(cached) >= limit or cached[-1:] == [None]):
+                self._cache.move_to_end(prefix)
+                return [name for name in cached[:limit] if name is not None]
+            found = self._names.search(prefix, limit)
+            if prefix:
+                found += self._tokens.search(prefix, limit - len(found), exclude=set(found))
+            # None в конце - совпадений больше нет, кэш годится для любого limit
+            self._cache[prefix] = found if len(found) >= limit else found + [None]
+            self._cache.move_to_end(prefix)
+            if len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+            return list(found)
@@ -1,10 +1,16 @@
 import requests
 import traceback
+import logging
+import logging.handlers
+import atexit
+import queue
 import json
 import os
 import sys
+from datetime import datetime
 
 loaded = False
+log = logging.getLogger(__name__)
 
 
 def resource_path(relative_path):
@@ -13,6 +19,9 @@ def resource_path(relative_path):
     return os.path.join(base_path, relative_path)
 
 
+credentials_file = resource_path(os.path.join("credentials", "logger.json"))
+
+
 def singleton(cls):
     instances = {}
 
@@ -26,11 +35,11 @@ def singleton(cls):
 
 @singleton
 class Logger:
-    def __init__(self, credentials_path=resource_path(os.path.join("credentials", "logger.json"))):
+    def __init__(self, credentials_path=credentials_file):
 
         with open(credentials_path, "r") as f:
             logger_config = json.load(f)
-        print("Setting telegram logger token")
+        log.info("Setting telegram logger token")
         self.telegram_apikey = logger_config.get("telegram_apikey", None)
         if self.telegram_apikey is None:
             raise ValueError("Telegram API key is not set in the logger.json file, logs will not be sent to Telegram.")
@@ -39,7 +48,7 @@ class Logger:
             raise ValueError("LOGS_USER_ID is not set in the logger.json file, logs will not be sent to Telegram.")
         self.name = logger_config.get("project_name", None)
         if self.name is None:
-            print("WARNING: Project name is not set in the logger.json file, using default name 'Test Logger'")
+            log.warning("Project name is not set in the logger.json file, using default name 'Test Logger'")
             self.name = "Test Logger"
 
     @staticmethod
@@ -49,12 +58,16 @@ class Logger:
             text = text.replace(char, f'\\{char}')
         return text
 
+    @staticmethod
+    def error_text(additional_text: str, traceback_str: str) -> str:
+        return f"""{additional_text}\n```python\n{traceback_str}```"""
+
     def log(self, text, markdown: bool = True):
         url = f"https://api.telegram.org/bot{self.telegram_apikey}/sendMessage"
         text = f"From {self.name}:\n\n" + str(text)
         text = self.escape_markdown(text)
         if self.logs_user_id is None:
-            print("\n\nThis message was not sent to Telegram because the ID_LOGS is not set in the logger.json file")
+            log.warning("This message was not sent to Telegram because the ID_LOGS is not set in the logger.json file")
             return
         params = {
             "chat_id": self.logs_user_id,
@@ -63,7 +76,7 @@ class Logger:
         if markdown: params["parse_mode"] = "MarkdownV2"
         resp = requests.post(url, params=params)
         if resp.status_code != 200:
-            print(f"Failed to send log to Telegram: {resp.status_code} {resp.text}")
+            log.warning("Failed to send log to Telegram: %s %s", resp.status_code, resp.text)
 
     def err(self, error: Exception, additional_text: str = ""):
         traceback_str = ''.join(traceback.format_exception(
@@ -71,6 +84,154 @@ class Logger:
             error,
             error.__traceback__)
         )
-        print(traceback_str)
-        text = f"""{additional_text}\n```python\n{traceback_str}```"""
-        self.log(text)
+        self.log(self.error_text(additional_text, traceback_str))
+
+
+# region Logging pipeline
+
+
+_listeners: list[logging.handlers.QueueListener] = []
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats a record as one JSON object per line, `extra` fields included"""
+    _reserved = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "telegram"}
+
+    def format(self, record):
+        data = {
+            "ts": datetime.fromtimestamp(record.created).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3],
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in self._reserved:
+                data[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data["exc"] = record.exc_text
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that keeps the message and the traceback as separate fields"""
+
+    def prepare(self, record):
+        record = logging.makeLogRecord(record.__dict__)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.getMessage()
+        record.message = record.msg
+        record.args = None
+        record.exc_info = None
+        return record
+
+
+class TelegramHandler(logging.Handler):
+    """
+    Forwards records to the Telegram sink (Logger).
+    Sends everything at `level` and above, plus records logged with extra={"telegram": True}
+    """
+
+    def __init__(self, sink: Logger, level=logging.ERROR):
+        super().__init__()
+        self.sink = sink
+        self.min_level = level
+
+    def emit(self, record):
+        if record.name == log.name:  # failures of the sink itself
+            return
+        if record.levelno < self.min_level and not getattr(record, "telegram", False):
+            return
+        try:
+            if record.exc_text:
+                self.sink.log(self.sink.error_text(record.getMessage(), record.exc_text))
+            else:
+                self.sink.log(record.getMessage())
+        except Exception:  # noqa
+            self.handleError(record)
+
+
+def _async_handler(handler: logging.Handler) -> logging.Handler:
+    """Wraps handler into its own queue and background thread"""
+    q = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(q, handler, respect_handler_level=True)
+    listener.start()
+    _listeners.append(listener)
+    return _QueueHandler(q)
+
+
+def _level(value, default):
+    if value is None:
+        return default
+    if isinstance(value, int):
+        return value
+    return logging.getLevelName(str(value).upper())
+
+
+def setup_logging(credentials_path=credentials_file):
+    """
+    Sets up the logging pipeline:
+    caller -> queue -> background thread -> console, rotating JSONL file, Telegram (own thread).
+    Optional settings are read from logger.json: log_level, log_dir, log_max_bytes,
+    log_backup_count, telegram_log_level
+    """
+    global loaded
+    if loaded:
+        return
+    loaded = True
+
+    try:
+        with open(credentials_path, "r") as f:
+            config = json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        config = {}
+
+    level = _level(config.get("log_level"), logging.INFO)
+
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter("[%(asctime)s] %(levelname)s: %(message)s", "%Y-%m-%d %H:%M:%S"))
+
+    log_dir = resource_path(config.get("log_dir", "logs"))  # абсолютный log_dir os.path.join оставит как есть
+    os.makedirs(log_dir, exist_ok=True)
+    worker = os.environ.get("KEYSBOT_WORKER")  # дочерний процесс кластера (cluster.WORKER_ENV): свой файл и ротация
+    file = logging.handlers.RotatingFileHandler(
+        os.path.join(log_dir, f"bot.worker{worker}.jsonl" if worker else "bot.jsonl"),
+        maxBytes=config.get("log_max_bytes", 5 * 1024 * 1024),
+        backupCount=config.get("log_backup_count", 5),
+        encoding="utf-8",
+        delay=True,
+    )
+    file.setFormatter(JsonFormatter())
+
+    handlers = [console, file]
+    try:
+        handlers.append(_async_handler(
+            TelegramHandler(Logger(credentials_path), _level(config.get("telegram_log_level"), logging.ERROR))
+        ))
+    except (FileNotFoundError, ValueError) as e:
+        console.handle(logging.makeLogRecord({"msg": f"Telegram logs disabled: {e}", "levelno": logging.WARNING,
+                                              "levelname": "WARNING"}))
+
+    q = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(q, *handlers, respect_handler_level=True)
+    listener.start()
+    _listeners.insert(0, listener)
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.handlers = [_QueueHandler(q)]
+    atexit.register(shutdown_logging)
+
+
+def shutdown_logging():
+    """Flushes queued records and stops the background threads"""
+    global loaded
+    while _listeners:
+        _listeners.pop(0).stop()
+    logging.getLogger().handlers = []
+    loaded = False
+
+
+# endregion
@@ -1,23 +1,27 @@
-import bot
-import asyncio
-import traceback
 import logger
-from datetime import datetime
+import logging
+
+logger.setup_logging()
+
+import bot  # noqa: E402
+import runtime  # noqa: E402
+import multiprocessing  # noqa: E402
+import sys  # noqa: E402
+
+log = logging.getLogger(__name__)
 
 
 async def run():
     await bot.main()
 
-lgr = None
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # процессы xlsxparse в собранном exe
     try:
-        lgr = logger.Logger()
-        asyncio.run(run())
-    except Exception as e:
-        tb = traceback.format_exc()
-        with open("log.txt", "a", encoding="utf-8") as f:
-            f.write(f"\n{datetime.now().strftime('%d.%m.%Y %H:%M:%S')}:\n{tb}\n")
-        print(tb)
-        if lgr is not None: lgr.err(e, "Error while running bot")
-    input("Press Enter to exit...")
+        runtime.run(run(), bot.runtime_profile)
+    except Exception:
+        log.critical("Error while running bot", exc_info=True)
+    finally:
+        logger.shutdown_logging()
+    if sys.stdin is not None and sys.stdin.isatty():  # у процессов-обработчиков кластера нет консоли
+        input("Press Enter to exit...")
@@ -0,0 +1,71 @@
+from datetime import datetime, timedelta
+import argparse
+import tempfile
+import logging
+import time
+import os
+
+log = logging.getLogger(__name__)
+
+
+def _make_book(path: str, rows: int):
+    """Книга с журналом из rows записей: строки, числа и даты, как в рабочем файле"""
+    from openpyxl import Workbook
+
+    workbook = Workbook(write_only=True)
+    journal = workbook.create_sheet("Журнал")
+    journal.append(["Ключ", "Имя", "Фамилия", "Телефон", "Выдан", "Возвращен", "Комментарий"])
+    started = datetime(2024, 1, 1)
+    for number in range(rows):
+        received = started + timedelta(minutes=number)
+        returned = None if number % 10 == 0 else received + timedelta(hours=2)
+        journal.append([f"БС-{number % 5000:04d}", "Сотрудник", f"Номер{number % 300}", 79990000000 + number % 300,
+                        received, returned, "" if number % 7 else "Пропуск"])
+    keys = workbook.create_sheet("Ключи")
+    for number in range(5000):
+        keys.append([f"БС-{number:04d}", 1, "None", "None"])
+    workbook.save(path)
+
+
+def _openpyxl_values(path: str) -> dict[str, list[tuple]]:
+    """Значения листов так, как их читает openpyxl: read_only и iter_rows(values_only=True)"""
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(path, read_only=True)
+    try:
+        return {sheet.title: list(sheet.iter_rows(values_only=True)) for sheet in workbook.worksheets}
+    finally:
+        workbook.close()
+
+
+def main():
+    """Холодный старт: разбор большого журнала openpyxl против xlsxparse с разным числом процессов"""
+    parser = argparse.ArgumentParser(description="Cold-start parse of a large journal: openpyxl vs xlsxparse workers")
+    parser.add_argument("--rows", type=int, default=200000, help="journal rows")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4], help="xlsxparse worker counts")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    import xlsxparse
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "keys.xlsx")
+        _make_book(path, args.rows)
+        log.info("%s rows, %.1f MB, %s CPUs", args.rows, os.path.getsize(path) / 2 ** 20, os.cpu_count())
+
+        started = time.perf_counter()
+        expected = _openpyxl_values(path)
+        log.info("openpyxl read_only + iter_rows: %.1fs", time.perf_counter() - started)
+        for workers in args.workers:
+            started = time.perf_counter()
+            values = xlsxparse.read_values(path, workers)
+            elapsed = time.perf_counter() - started
+            same = all(
+                [row for row in values[name] if any(cell is not None for cell in row)] ==
+                [row for row in rows if any(cell is not None for cell in row)]
+                for name, rows in expected.items())
+            log.info("xlsxparse, %s worker(s): %.1fs%s", workers, elapsed, "" if same else ", ROWS DIFFER")
+
+
+if __name__ == "__main__":
+    main()
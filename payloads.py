@@ -0,0 +1,106 @@
+import threading
+import logging
+import secrets
+import json
+import time
+import os
+
+log = logging.getLogger(__name__)
+
+COMPACT_MIN = 1000  # журнал не сжимается, пока в нем меньше строк
+
+
+class PayloadStore:
+    """
+    Данные inline-кнопок на стороне сервера. В callback_data уходит только короткий токен,
+    поэтому длина комментариев и символы в них больше не ограничены 64 байтами Telegram.
+    Записи живут ttl секунд и сохраняются между перезапусками в журнал (JSONL): put и pop дописывают
+    по строке, а файл переписывается целиком, только когда мертвых строк становится больше живых
+    """
+
+    def __init__(self, path: str, ttl: float = 7 * 24 * 60 * 60):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._records: dict[str, dict] = {}  # токен -> {"expires": ..., "data": {...}}
+        self._lines = 0  # строк в журнале, включая снятые и истекшие токены
+        self._file = None
+        if os.path.exists(path):
+            self._replay()
+        with self._lock:
+            self._compact()
+
+    def _replay(self):
+        with open(self.path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    log.warning("Skipping incomplete record at the end of %s", self.path)  # сжатие ее отбросит
+                    break
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError as e:
+                    log.warning("Skipping corrupted record in %s: %s", self.path, e)
+                    continue
+                if "pop" in record:
+                    self._records.pop(record["pop"], None)
+                else:
+                    self._records[record["put"]] = {"expires": record["expires"], "data": record["data"]}
+
+    async def put(self, data: dict, ttl: float = None) -> str:
+        """Сохраняет данные и возвращает токен для callback_data"""
+        with self._lock:
+            token = secrets.token_urlsafe(6)
+            while token in self._records:
+                token = secrets.token_urlsafe(6)
+            record = self._records[token] = {"expires": time.time() + (ttl or self.ttl), "data": data}
+            self._append({"put": token, **record})
+        return token
+
+    async def restore(self, token: str, data: dict, ttl: float = None):
+        """Возвращает снятый pop токен: действие по кнопке не удалось, и ее можно нажать снова"""
+        with self._lock:
+            record = self._records[token] = {"expires": time.time() + (ttl or self.ttl), "data": data}
+            self._append({"put": token, **record})
+
+    async def get(self, token: str) -> dict | None:
+        """Данные по токену или None, если токен неизвестен или истек"""
+        record = self._records.get(token)
+        if record is None or record["expires"] < time.time():
+            return None
+        return record["data"]
+
+    async def pop(self, token: str) -> dict | None:
+        """Как get, но токен больше не действует (одноразовые кнопки)"""
+        with self._lock:
+            record = self._records.pop(token, None)
+            if record is not None:
+                self._append({"pop": token})
+        if record is None or record["expires"] < time.time():
+            return None
+        return record["data"]
+
+    def _append(self, record: dict):
+        """Дописывает строку в журнал; вызывать под self._lock"""
+        self._file.write(json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n")
+        self._file.flush()
+        self._lines += 1
+        if self._lines > max(COMPACT_MIN, 2 * len(self._records)):
+            self._compact()
+
+    def _compact(self):
+        """Переписывает журнал: только живые токены, по строке на каждый. Вызывать под self._lock"""
+        if self._file is not None:
+            self._file.close()
+        now = time.time()
+        self._records = {token: record for token, record in self._records.items() if record["expires"] >= now}
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "wb") as f:
+            for token, record in self._records.items():
+                f.write(json.dumps({"put": token, **record}, ensure_ascii=False).encode("utf-8") + b"\n")
+        os.replace(temp_path, self.path)
+        self._lines = len(self._records)
+        self._file = open(self.path, "ab")
+
+    def close(self):
+        with self._lock:
+            self._file.close()
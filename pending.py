@@ -0,0 +1,36 @@
+import threading
+
+
+class PendingRequests:
+    """
+    Запросы ключей, ожидающие ответа охраны, и сообщения этих запросов у охранников.
+    Живут в памяти процесса и снимаются таймерами бота; для нескольких процессов -
+    cluster.RedisPendingRequests с тем же интерфейсом, где ttl еще и страхует от упавшего процесса.
+    Методы асинхронные ради общего интерфейса: у Redis каждый вызов - запрос к серверу
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._requests: dict[tuple[str, str], int] = {}  # (площадка, ключ) -> user_id запросившего
+        self._approvals: dict[str, tuple[str, list[tuple[int, int]]]] = {}  # токен -> (текст, [(chat_id, message_id)])
+
+    async def is_requested(self, site: str, key_name: str) -> bool:
+        return (site, key_name) in self._requests
+
+    async def add_request(self, site: str, key_name: str, user_id: int, ttl: float):
+        self._requests[(site, key_name)] = user_id
+
+    async def pop_request(self, site: str, key_name: str) -> int | None:
+        """Снимает запрос; user_id запросившего или None, если запроса уже нет"""
+        with self._lock:
+            return self._requests.pop((site, key_name), None)
+
+    async def add_approval(self, token: str, text: str, messages: list[tuple[int, int]], ttl: float):
+        self._approvals[token] = (text, messages)
+
+    async def has_approval(self, token: str) -> bool:
+        return token in self._approvals
+
+    async def pop_approval(self, token: str) -> tuple[str, list[tuple[int, int]]] | None:
+        with self._lock:
+            return self._approvals.pop(token, None)
@@ -0,0 +1,78 @@
+from dataclasses import dataclass, asdict
+import threading
+import logging
+import json
+import time
+import os
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class Profile:
+    user_id: str
+    username: str | None = None
+    first_name: str | None = None
+    last_name: str | None = None
+    updated: float = 0.0  # time.time() последнего обновления
+
+
+class ProfileCache:
+    """
+    Профили пользователей Telegram (username, имя), собранные из входящих апдейтов.
+    Хранятся в JSON-файле между перезапусками, устаревают через ttl секунд.
+    update не трогает диск: изменения копятся в памяти и пишутся периодическим flush
+    """
+
+    def __init__(self, path: str, ttl: float = 24 * 60 * 60):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()  # flush из разных потоков пишут файл по очереди
+        self._dirty = False
+        self._profiles: dict[str, Profile] = {}
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self._profiles = {user_id: Profile(**data) for user_id, data in json.load(f).items()}
+            except (json.JSONDecodeError, TypeError) as e:
+                log.warning("Profile cache %s is corrupted, starting empty: %s", path, e)
+
+    def get(self, user_id) -> Profile | None:
+        return self._profiles.get(str(user_id))
+
+    def username(self, user_id) -> str | None:
+        profile = self._profiles.get(str(user_id))
+        return profile.username if profile else None
+
+    def is_stale(self, user_id) -> bool:
+        profile = self._profiles.get(str(user_id))
+        return profile is None or time.time() - profile.updated > self.ttl
+
+    def update(self, user_id, username: str = None, first_name: str = None, last_name: str = None):
+        """Запоминает профиль в памяти; на диск его запишет следующий flush, если что-то поменялось"""
+        user_id = str(user_id)
+        with self._lock:
+            old = self._profiles.get(user_id)
+            profile = Profile(user_id, username, first_name, last_name, time.time())
+            self._profiles[user_id] = profile
+            changed = old is None or (old.username, old.first_name, old.last_name) != (username, first_name, last_name)
+            if changed or profile.updated - old.updated > self.ttl / 2:
+                self._dirty = True
+
+    def flush(self):
+        """Пишет профили на диск, если они менялись с прошлого flush. Блокирующий: из бота — через to_thread"""
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                data = {user_id: asdict(p) for user_id, p in self._profiles.items()}
+                self._dirty = False
+            try:
+                temp_path = f"{self.path}.tmp"
+                with open(temp_path, "w", encoding="utf-8") as f:
+                    json.dump(data, f, ensure_ascii=False)
+                os.replace(temp_path, self.path)
+            except OSError:
+                self._dirty = True  # попробуем снова в следующий раз
+                raise
@@ -0,0 +1,135 @@
+from datetime import datetime, timedelta
+import statistics
+import threading
+import argparse
+import tempfile
+import logging
+import shutil
+import time
+import os
+
+log = logging.getLogger(__name__)
+
+SITE_CONFIG = {
+    "keys_accounting_wks": "Журнал",
+    "keys_wks": "Ключи",
+    "employees_wks": "Сотрудники",
+    "snapshot": False,
+}
+
+
+def _make_book(path: str, rows: int, keys: int):
+    """Книга площадки: журнал из rows записей (каждая десятая не возвращена), keys ключей, 200 сотрудников"""
+    from openpyxl import load_workbook
+    import sheets
+
+    sheets.Registry("bench", {**SITE_CONFIG, "excel_file_path": path, "watch_file": False}).close()  # листы с заголовками
+    workbook = load_workbook(path)
+    journal = workbook["Журнал"]
+    started = datetime(2024, 1, 1)
+    for number in range(rows):
+        received = started + timedelta(minutes=number)
+        returned = None if number % 10 == 0 else (received + timedelta(hours=2)).strftime(sheets.datetime_format)
+        journal.append([f"БС-{number % keys:04d}", "Сотрудник", f"Номер{number % 200}", "79990000000",
+                        received.strftime(sheets.datetime_format), returned, ""])
+    for number in range(keys):
+        workbook["Ключи"].append([f"БС-{number:04d}", 1, "None", "None"])
+    for number in range(200):
+        workbook["Сотрудники"].append(
+            ["Сотрудник", f"Номер{number}", "79990000000", str(number), "security" if number < 5 else "user"])
+    workbook.save(path)
+
+
+def _edited_copies(path: str, directory: str, count: int) -> list[str]:
+    """Копии книги с внешними правками (новая выдача и возврат), заготовленные заранее: подмена файла - один os.replace"""
+    from openpyxl import load_workbook
+    import sheets
+
+    workbook = load_workbook(path)
+    journal = workbook["Журнал"]
+    copies = []
+    for number in range(count):
+        now = datetime.now().strftime(sheets.datetime_format)
+        journal.append(["БС-0000", "Внешний", f"Редактор{number}", "79990000000", now, None, ""])
+        journal.cell(row=2 + number, column=6, value=now)
+        copy = os.path.join(directory, f"edit{number}.xlsx")
+        workbook.save(copy)
+        copies.append(copy)
+    return copies
+
+
+def trace(path: str, copies: list[str], inline: bool, watch: bool, duration: float, interval: float) -> list[float]:
+    """Задержки чтения (мс): запрос каждые interval секунд, файл подменяется извне равномерно за duration"""
+    import sheets
+
+    registry = sheets.Registry("bench", {
+        **SITE_CONFIG,
+        "excel_file_path": path,
+        "watch_file": watch,
+        "watch_interval": 0.1,
+        "max_staleness": 0 if inline else 30,  # 0 - устаревший workbook перечитывается прямо в запросе
+    })
+    journal, keys, employees = registry.keys_accounting, registry.keys, registry.employees
+
+    def read():
+        journal.get_not_returned_keys()
+        journal.aggregates.key("БС-0001")
+        journal.key_history("БС-0001")
+        keys.get_by_name("БС-0002")
+        employees.with_role("security")
+
+    def edit():
+        for copy in copies:
+            time.sleep(duration / (len(copies) + 1))
+            shutil.copy(copy, path + ".tmp")
+            os.replace(path + ".tmp", path)
+
+    read()
+    latencies = []
+    editor = threading.Thread(target=edit)
+    editor.start()
+    deadline = time.perf_counter() + duration
+    try:
+        # После последней правки читаем, пока она не будет подхвачена: иначе подмена в хвосте трассы не попадет в замер
+        while time.perf_counter() < deadline or editor.is_alive() or registry._refreshing:
+            started = time.perf_counter()
+            read()
+            latencies.append((time.perf_counter() - started) * 1000)
+            time.sleep(interval)
+    finally:
+        editor.join()
+        registry.close()
+    return latencies
+
+
+def main():
+    """Задержка чтения во время внешних правок книги: перечитывание в фоне против перечитывания в запросе"""
+    parser = argparse.ArgumentParser(description="Read latency trace while the workbook is edited externally")
+    parser.add_argument("--rows", type=int, default=40000, help="journal rows")
+    parser.add_argument("--keys", type=int, default=1000, help="keys in the workbook")
+    parser.add_argument("--edits", type=int, default=3, help="external edits during the trace")
+    parser.add_argument("--duration", type=float, default=20, help="trace length, seconds")
+    parser.add_argument("--interval", type=float, default=0.01, help="pause between reads, seconds")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    logging.getLogger("sheets").setLevel(logging.WARNING)
+    with tempfile.TemporaryDirectory() as directory:
+        original = os.path.join(directory, "original.xlsx")
+        _make_book(original, args.rows, args.keys)
+        copies = _edited_copies(original, directory, args.edits)
+        for number, (name, inline, watch) in enumerate((
+                ("inline reload", True, True),
+                ("background, watcher", False, True),
+                ("background, no watcher", False, False),
+        )):
+            path = os.path.join(directory, f"keys{number}.xlsx")  # фоновое чтение прошлого прогона еще может читать свой файл
+            shutil.copy(original, path)
+            latencies = trace(path, copies, inline, watch, args.duration, args.interval)
+            quantiles = statistics.quantiles(latencies, n=100)
+            log.info("%s: %s reads, p50 %.2fms, p99 %.2fms, max %.0fms, %s reads >100ms", name, len(latencies),
+                     quantiles[49], quantiles[98], max(latencies), sum(latency > 100 for latency in latencies))
+
+
+if __name__ == "__main__":
+    main()
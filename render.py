@@ -0,0 +1,201 @@
+from datetime import timedelta
+from functools import lru_cache
+from typing import Callable, Iterable
+import weakref
+
+# Готовые шаблоны сообщений. Тексты совпадают с прежними f-строками из bot.py символ в символ
+
+
+# region Templates
+
+
+TIME_FORMAT = "%H:%M (%d.%m.%Y)"
+CHUNK_SIZE = 2000  # после этой длины история продолжается в новом сообщении
+
+_KEY_STATE = "*Ключ*: `{}`\n*  Состояние*: {}\n".format
+_KEY_INFO = "*  Количество ключей*: `{}`\n*  Тип ключа*: `{}`\n*  Тип аппаратный*: `{}`\n\n".format
+_KEY_TAKEN = "*Ключ выдан:*\n  *Имя*: `{} {}`\n  *Выдан в*: `{}`\n".format
+_KEY_LAST_USER = "*Последний пользователь:*\n  *Имя*: `{} {}`\n  *Взял в*: `{}`\n  *Вернул в*: `{}`\n".format
+_KEY_COMMENT = "  *Комментарии*: \"{}\"\n".format
+_KEY_CONTACT = "  *Контакт*: {}\n".format
+
+_HISTORY_NAME = "*Имя*: `{} {}`\n".format
+_HISTORY_KEY = "*Ключ*: `{}`\n".format
+_HISTORY_TAKEN = "| *Взял в*: `{}`\n".format
+_HISTORY_RETURNED = "| *Вернул в*: `{}`\n".format
+_HISTORY_CONTACT = "| *Контакт*: {}\n".format
+_HISTORY_COMMENT = "| *Комментарии*: \"{}\"\n".format
+_HISTORY_KEY_INFO = "| *Количество ключей*: `{}`\n| *Тип ключа*: `{}`\n| *Тип аппаратный*: `{}`\n".format
+_HISTORY_PERIOD = "*Период*: {}\n*Записей за период*: {}\n".format
+
+_BOOKING = "*Ключ*: `{}`\n*Время*: {}\n".format
+_CONFLICT_BOOKING = "| Бронь: `{} {}`, {}\n".format
+_CONFLICT_TAKEN = "| На руках: `{} {}` с {}\n".format
+
+_INLINE_FREE = "На месте, ключей: {}".format
+_INLINE_TAKEN = "Выдан: {} {} в {}".format
+
+_markdown_escape = str.maketrans({char: f"\\{char}" for char in "_*[`"})
+
+
+# endregion
+
+
+# region Helpers
+
+
+def escape_markdown(text: str) -> str:
+    return text.translate(_markdown_escape)
+
+
+@lru_cache(maxsize=4096)
+def _phone_format(phone: str) -> str:
+    digits = ''.join(filter(str.isdigit, phone))
+    if digits.startswith('8'):
+        digits = '7' + digits[1:]
+    elif not digits.startswith('7'):
+        digits = '7' + digits
+    digits = digits[:11]
+    return f'+{digits}'
+
+
+def phone_format(phone) -> str:
+    return _phone_format(str(phone))
+
+
+def format_time(value) -> str:
+    return value.strftime(TIME_FORMAT)
+
+
+class _Fragments:
+    """
+    Отрисованные фрагменты записей журнала. Записи не меняются после создания (изменение строки
+    дает новый объект Entry), поэтому фрагмент живет вместе с объектом, а версия страхует от правок на месте
+    """
+
+    def __init__(self, build: Callable):
+        self.build = build
+        self.cache = weakref.WeakKeyDictionary()
+
+    def __call__(self, entry) -> str:
+        version = (entry.time_returned, entry.comment, entry.emp_phone)
+        cached = self.cache.get(entry)
+        if cached is None or cached[0] != version:
+            cached = self.cache[entry] = (version, self.build(entry))
+        return cached[1]
+
+
+# endregion
+
+
+# region Fragments
+
+
+def _key_card_entry(entry) -> str:
+    if entry.time_returned is None:
+        text = _KEY_TAKEN(entry.emp_firstname, entry.emp_lastname, format_time(entry.time_received))
+    else:
+        text = _KEY_LAST_USER(entry.emp_firstname, entry.emp_lastname,
+                              format_time(entry.time_received), format_time(entry.time_returned))
+    if entry.comment:
+        text += _KEY_COMMENT(escape_markdown(entry.comment))
+    return text + _KEY_CONTACT(phone_format(entry.emp_phone))
+
+
+def _key_history_entry(entry) -> str:
+    text = _HISTORY_NAME(entry.emp_firstname, entry.emp_lastname) + _HISTORY_TAKEN(format_time(entry.time_received))
+    if entry.time_returned:
+        text += _HISTORY_RETURNED(format_time(entry.time_returned))
+    text += _HISTORY_CONTACT(phone_format(entry.emp_phone))
+    if entry.comment:
+        text += _HISTORY_COMMENT(escape_markdown(entry.comment))
+    return text + "\n"
+
+
+def _emp_history_entry(entry) -> str:
+    text = _HISTORY_KEY(entry.key_name) + _HISTORY_TAKEN(format_time(entry.time_received))
+    if entry.time_returned:
+        text += _HISTORY_RETURNED(format_time(entry.time_returned))
+    if entry.comment:
+        text += _HISTORY_COMMENT(escape_markdown(entry.comment))
+    return text + "\n"
+
+
+key_card_entry = _Fragments(_key_card_entry)
+key_history_entry = _Fragments(_key_history_entry)
+emp_history_entry = _Fragments(_emp_history_entry)
+
+
+def key_card(entry, key=None) -> str:
+    """Карточка ключа по записи журнала; key - строка из таблицы ключей или None"""
+    text = _KEY_STATE(entry.key_name, 'Не на месте' if entry.time_returned is None else 'Этот ключ сейчас на месте')
+    if key:
+        text += _KEY_INFO(key.count, key.key_type, key.hardware_type)
+    return text + key_card_entry(entry)
+
+
+def my_key(entry, key=None) -> str:
+    text = _HISTORY_KEY(entry.key_name) + _HISTORY_TAKEN(format_time(entry.time_received))
+    if key:
+        text += _HISTORY_KEY_INFO(key.count, key.key_type, key.hardware_type)
+    if entry.comment:
+        text += _HISTORY_COMMENT(escape_markdown(entry.comment))
+    return text
+
+
+def period(since=None, until=None) -> str:
+    """Период [since, until) словами; until не включается, поэтому показывается предыдущий день"""
+    since = since.strftime("%d.%m.%Y") if since else "начала"
+    until = (until - timedelta(seconds=1)).strftime("%d.%m.%Y") if until else "сегодня"
+    return f"с {since} по {until}"
+
+
+def history_period(since, until, count: int) -> str:
+    return _HISTORY_PERIOD(period(since, until), count)
+
+
+def booking_period(start, end) -> str:
+    if start.date() == end.date():
+        return f"{start:%d.%m.%Y %H:%M} - {end:%H:%M}"
+    return f"{start:%d.%m.%Y %H:%M} - {end:%d.%m.%Y %H:%M}"
+
+
+def booking(item) -> str:
+    return _BOOKING(item.key_name, booking_period(item.start, item.end))
+
+
+def booking_conflicts(conflicts) -> str:
+    """Брони и невозвращенные записи журнала, которые заняли ключ"""
+    lines = []
+    for item in conflicts:
+        if hasattr(item, "start"):
+            lines.append(_CONFLICT_BOOKING(item.emp_firstname, item.emp_lastname, booking_period(item.start, item.end)))
+        else:
+            lines.append(_CONFLICT_TAKEN(item.emp_firstname, item.emp_lastname, format_time(item.time_received)))
+    return "".join(lines)
+
+
+def availability(key, holder=None) -> str:
+    """Одна строка о доступности ключа для описания inline-результата; holder - невозвращенная запись"""
+    if holder is None:
+        return _INLINE_FREE(key.count)
+    return _INLINE_TAKEN(holder.emp_firstname, holder.emp_lastname, format_time(holder.time_received))
+
+
+def chunks(header: str, fragments: Iterable[str], size: int = CHUNK_SIZE) -> list[str]:
+    """Склеивает фрагменты в сообщения: новое начинается, когда текущее длиннее size"""
+    messages = []
+    parts = [header]
+    length = len(header)
+    for fragment in fragments:
+        if length > size:
+            messages.append("".join(parts))
+            parts = []
+            length = 0
+        parts.append(fragment)
+        length += len(fragment)
+    messages.append("".join(parts))
+    return messages
+
+
+# endregion
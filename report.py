@@ -0,0 +1,295 @@
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from typing import Sequence
+import numpy as np
+import argparse
+import logger
+import logging
+import weakref
+import csv
+import io
+
+log = logging.getLogger(__name__)
+
+
+# region Columns
+
+
+_epoch = datetime(1970, 1, 1)
+_second = timedelta(seconds=1)
+_nat = np.iinfo(np.int64).min  # целочисленное представление NaT
+
+
+@dataclass
+class JournalColumns:
+    """Журнал в виде столбцов NumPy: ключи и сотрудники закодированы целыми числами"""
+    key_names: list[str]
+    emp_names: list[str]
+    key: np.ndarray  # int32, индекс в key_names
+    emp: np.ndarray  # int32, индекс в emp_names
+    received: np.ndarray  # datetime64[s]
+    returned: np.ndarray  # datetime64[s], NaT если ключ не вернули
+
+    def __len__(self):
+        return len(self.key)
+
+    @classmethod
+    def from_entries(cls, entries: Sequence) -> "JournalColumns":
+        key_codes: dict[str, int] = {}
+        emp_codes: dict[str, int] = {}
+        key, emp, received, returned = _encode(entries, key_codes, emp_codes)
+        return cls(list(key_codes), list(emp_codes), key, emp,
+                   received.astype("datetime64[s]"), returned.astype("datetime64[s]"))
+
+    def updated(self, previous: Sequence, entries: Sequence) -> "JournalColumns":
+        """
+        Столбцы для entries по столбцам этих записей previous (копия, эти не меняются): пересчитываются только
+        записи, которых на своем месте в previous не было, - новые в конце и замененные (возврат ключа).
+        Если записи сдвинулись (архивация, удаление строк), столбцы строятся заново
+        """
+        common = min(len(previous), len(entries))
+        changed = [i for i, (old, new) in enumerate(zip(previous, entries)) if old is not new]
+        if len(entries) < len(previous) or len(changed) > common // 4:
+            return JournalColumns.from_entries(entries)
+        key_codes = {name: code for code, name in enumerate(self.key_names)}
+        emp_codes = {name: code for code, name in enumerate(self.emp_names)}
+        tail = _encode(entries[common:], key_codes, emp_codes)
+        columns = [np.concatenate((column[:common], added)) for column, added in zip(
+            (self.key, self.emp, self.received.astype(np.int64), self.returned.astype(np.int64)), tail)]
+        if changed:
+            for column, values in zip(columns, _encode([entries[i] for i in changed], key_codes, emp_codes)):
+                column[changed] = values
+        key, emp, received, returned = columns
+        return JournalColumns(list(key_codes), list(emp_codes), key, emp,
+                              received.astype("datetime64[s]"), returned.astype("datetime64[s]"))
+
+
+def _encode(entries: Sequence, key_codes: dict[str, int], emp_codes: dict[str, int]) -> tuple[np.ndarray, ...]:
+    """Столбцы записей: коды ключей и сотрудников (новые имена дописываются в словари) и время в секундах"""
+    count = len(entries)
+    key = np.fromiter(
+        (key_codes.setdefault(entry.key_name, len(key_codes)) for entry in entries), np.int32, count)
+    emp = np.fromiter(
+        (emp_codes.setdefault(f"{entry.emp_firstname} {entry.emp_lastname}", len(emp_codes)) for entry in entries),
+        np.int32, count)
+    # через целые секунды в разы быстрее, чем np.array из объектов datetime
+    received = np.fromiter(
+        ((entry.time_received - _epoch) // _second for entry in entries), np.int64, count)
+    returned = np.fromiter(
+        (_nat if entry.time_returned is None else (entry.time_returned - _epoch) // _second for entry in entries),
+        np.int64, count)
+    return key, emp, received, returned
+
+
+_columns_cache = weakref.WeakKeyDictionary()  # таблица -> (версия журнала, записи, JournalColumns)
+
+
+def journal_columns(table) -> JournalColumns:
+    """
+    Столбцы журнала таблицы (sheets.KeysAccountingTable). После изменений журнала дописываются
+    и обновляются только новые и замененные записи (JournalColumns.updated)
+    """
+    version = table.journal_version()
+    cached = _columns_cache.get(table)
+    if cached is not None and cached[0] == version:
+        return cached[2]
+    entries = table.get_entries()
+    columns = JournalColumns.from_entries(entries) if cached is None else cached[2].updated(cached[1], entries)
+    _columns_cache[table] = (version, entries, columns)
+    return columns
+
+
+# endregion
+
+
+# region Report
+
+
+@dataclass
+class Table:
+    title: str
+    headers: list[str]
+    rows: list[list]
+
+
+@dataclass
+class Report:
+    since: datetime | None
+    until: datetime | None
+    total: int = 0
+    not_returned: int = 0
+    overdue: int = 0
+    average_holding: float | None = None  # в часах
+    tables: list[Table] = field(default_factory=list)
+
+    def table(self, title: str) -> Table:
+        return next(table for table in self.tables if table.title == title)
+
+
+def _hours(seconds: np.ndarray) -> np.ndarray:
+    return np.round(seconds / 3600, 2)
+
+
+def _group(codes: np.ndarray, size: int, holding: np.ndarray, returned: np.ndarray, overdue: np.ndarray):
+    """Количество, среднее время на руках (ч) и доля просрочек по группам"""
+    counts = np.bincount(codes, minlength=size)
+    returned_counts = np.bincount(codes, weights=returned, minlength=size)
+    holding_sums = np.bincount(codes, weights=np.where(returned, holding, 0), minlength=size)
+    overdue_counts = np.bincount(codes, weights=overdue, minlength=size)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        average = _hours(holding_sums / returned_counts)
+        overdue_rate = np.round(overdue_counts / counts * 100, 1)
+    return counts, average, overdue_counts.astype(np.int64), overdue_rate
+
+
+def _rows(names: Sequence, counts, average, overdue_counts, overdue_rate, top: int = None) -> list[list]:
+    present = np.flatnonzero(counts)
+    order = present[np.argsort(-counts[present], kind="stable")]
+    if top is not None:
+        order = order[:top]
+    return [
+        [names[i], int(counts[i]), None if np.isnan(average[i]) else float(average[i]),
+         int(overdue_counts[i]), float(overdue_rate[i])]
+        for i in order
+    ]
+
+
+def build_report(
+        columns: JournalColumns,
+        since: datetime = None,
+        until: datetime = None,
+        overdue_after: timedelta = timedelta(days=3),
+        now: datetime = None,
+) -> Report:
+    """
+    Сводка по журналу за [since, until): самые используемые ключи, активные сотрудники и помесячная динамика.
+    Просроченной считается запись, где ключ держали (или держат до сих пор) дольше overdue_after
+    """
+    now = np.datetime64(now or datetime.now(), "s")
+    mask = np.ones(len(columns), dtype=bool)
+    if since is not None:
+        mask &= columns.received >= np.datetime64(since, "s")
+    if until is not None:
+        mask &= columns.received < np.datetime64(until, "s")
+
+    key = columns.key[mask]
+    emp = columns.emp[mask]
+    received = columns.received[mask]
+    returned_at = columns.returned[mask]
+
+    returned = ~np.isnat(returned_at)
+    holding = (np.where(returned, returned_at, now) - received).astype(np.float64)
+    overdue = holding > overdue_after.total_seconds()
+
+    report = Report(since, until)
+    report.total = int(mask.sum())
+    report.not_returned = int((~returned).sum())
+    report.overdue = int(overdue.sum())
+    if returned.any():
+        report.average_holding = float(_hours(holding[returned].mean()))
+
+    headers = ["Количество", "Среднее время на руках, ч", "Просрочено", "Просрочено, %"]
+    report.tables.append(Table("Ключи", ["Ключ"] + headers, _rows(
+        columns.key_names, *_group(key, len(columns.key_names), holding, returned, overdue))))
+    report.tables.append(Table("Сотрудники", ["Сотрудник"] + headers, _rows(
+        columns.emp_names, *_group(emp, len(columns.emp_names), holding, returned, overdue))))
+
+    months, month_codes = np.unique(received.astype("datetime64[M]"), return_inverse=True)
+    month_names = [str(month) for month in months]
+    month_stats = _group(month_codes.astype(np.int64), len(months), holding, returned, overdue)
+    month_rows = _rows(month_names, *month_stats)
+    month_rows.sort(key=lambda row: row[0])
+    report.tables.append(Table("По месяцам", ["Месяц"] + headers, month_rows))
+    return report
+
+
+# endregion
+
+
+# region Rendering
+
+
+def _period(report: Report) -> str:
+    since = report.since.strftime("%d.%m.%Y") if report.since else "начала"
+    until = (report.until - timedelta(seconds=1)).strftime("%d.%m.%Y") if report.until else "сегодня"  # until не включается
+    return f"с {since} по {until}"
+
+
+def render_text(report: Report, top: int = 5) -> str:
+    """Краткая сводка в Markdown для сообщения в Telegram"""
+    text = (
+        f"*Отчет {_period(report)}*\n"
+        f"*Выдач ключей*: {report.total}\n"
+        f"*Сейчас на руках*: {report.not_returned}\n"
+        f"*Просрочено*: {report.overdue}"
+        f"{f' ({report.overdue / report.total * 100:.1f}%)' if report.total else ''}\n"
+    )
+    if report.average_holding is not None:
+        text += f"*Среднее время на руках*: {report.average_holding:.1f} ч\n"
+    for title in ("Ключи", "Сотрудники"):
+        rows = report.table(title).rows[:top]
+        if not rows:
+            continue
+        text += f"\n*{title}, топ {len(rows)}:*\n"
+        for name, count, average, *_ in rows:
+            text += f"`{name}` — {count} раз(а)"
+            text += f", в среднем {average:.1f} ч\n" if average is not None else "\n"
+    return text
+
+
+def to_xlsx(report: Report) -> bytes:
+    """Все таблицы отчета, каждая на своем листе"""
+    from openpyxl import Workbook
+    wb = Workbook(write_only=True)
+    for table in report.tables:
+        ws = wb.create_sheet(table.title)
+        ws.append(table.headers)
+        for row in table.rows:
+            ws.append(row)
+    buffer = io.BytesIO()
+    wb.save(buffer)
+    return buffer.getvalue()
+
+
+def to_csv(report: Report) -> bytes:
+    """Все таблицы отчета в одном CSV, разделенные пустой строкой"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=";")
+    for i, table in enumerate(report.tables):
+        if i:
+            writer.writerow([])
+        writer.writerow([table.title])
+        writer.writerow(table.headers)
+        writer.writerows(table.rows)
+    return buffer.getvalue().encode("utf-8-sig")
+
+
+# endregion
+
+
+def main():
+    """Отчет по журналу ключей из командной строки"""
+    parser = argparse.ArgumentParser(description="Usage report over the keys journal (archive included)")
+    parser.add_argument("--site", help="site to report on (default: the default site)")
+    parser.add_argument("--since", type=lambda s: datetime.strptime(s, "%d.%m.%Y"), help="DD.MM.YYYY, inclusive")
+    parser.add_argument("--until", type=lambda s: datetime.strptime(s, "%d.%m.%Y"), help="DD.MM.YYYY, exclusive")
+    parser.add_argument("--overdue-days", type=float, default=3, help="holding time counted as overdue")
+    parser.add_argument("--output", help="write the tables to OUTPUT (.xlsx or .csv)")
+    args = parser.parse_args()
+
+    logger.setup_logging()
+    import sheets
+
+    site = sheets.RegistryPool.from_config().get(args.site)
+    columns = journal_columns(site.keys_accounting)
+    report = build_report(columns, args.since, args.until, timedelta(days=args.overdue_days))
+    print(render_text(report, top=10))
+    if args.output:
+        with open(args.output, "wb") as f:
+            f.write(to_csv(report) if args.output.lower().endswith(".csv") else to_xlsx(report))
+        log.info("Report saved to %s", args.output)
+    logger.shutdown_logging()
+
+
+if __name__ == "__main__":
+    main()
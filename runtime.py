@@ -0,0 +1,94 @@
+from dataclasses import dataclass, fields
+from typing import Any, Awaitable, TypeVar
+from aiogram.client.session.aiohttp import AiohttpSession
+import asyncio
+import logging
+import json
+import os
+
+log = logging.getLogger(__name__)
+
+# Производительный режим выполнения (включается файлом credentials/runtime.json):
+# цикл событий uvloop, JSON через orjson и настроенный пул соединений с Bot API.
+# uvloop и orjson необязательны: без них используется стандартный цикл и модуль json
+
+T = TypeVar("T")
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+@dataclass
+class RuntimeProfile:
+    uvloop: bool = True
+    orjson: bool = True
+    connection_limit: int | None = None  # None - по числу одновременно обрабатываемых апдейтов
+    keepalive_timeout: float = 60  # сколько держать простаивающее соединение с Bot API, сек
+    dns_cache_ttl: int = 600  # сек
+    request_timeout: float = 30  # на запрос к Bot API, сек; getUpdates получает сверху время опроса
+
+    @classmethod
+    def from_config(cls, path: str) -> "RuntimeProfile | None":
+        """Читает runtime.json; None, если файла нет (режим по умолчанию)"""
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        known = {field.name for field in fields(cls)}
+        unknown = set(data) - known
+        if unknown:
+            log.warning("Unknown runtime settings ignored: %s", ", ".join(sorted(unknown)))
+        return cls(**{name: value for name, value in data.items() if name in known})
+
+
+def json_dumps(value: Any) -> str:
+    return orjson.dumps(value).decode("utf-8")
+
+
+def json_loads(value: str | bytes) -> Any:
+    return orjson.loads(value)
+
+
+def connection_limit(profile: RuntimeProfile, concurrency: int) -> int:
+    """
+    Размер пула соединений: по одному на одновременно обрабатываемый апдейт, вдвое - на рассылки
+    (запрос ключа уходит всем охранникам сразу), плюс длинный опрос getUpdates
+    """
+    return profile.connection_limit or concurrency * 2 + 1
+
+
+class TunedSession(AiohttpSession):
+    """Сессия Bot API с keep-alive, кэшем DNS, ограниченным пулом соединений и, если есть, orjson"""
+
+    def __init__(self, profile: RuntimeProfile, limit: int, **kwargs):
+        if profile.orjson and orjson is not None:
+            kwargs.setdefault("json_loads", json_loads)
+            kwargs.setdefault("json_dumps", json_dumps)
+        elif profile.orjson:
+            log.info("orjson is not installed, using the json module")
+        super().__init__(limit=limit, timeout=profile.request_timeout, **kwargs)
+        # Все запросы идут на один хост api.telegram.org, поэтому limit - это и лимит на хост
+        self._connector_init.update(
+            keepalive_timeout=profile.keepalive_timeout,
+            ttl_dns_cache=profile.dns_cache_ttl,
+        )
+
+
+def loop_factory(profile: RuntimeProfile | None):
+    """new_event_loop из uvloop, если он включен в профиле и установлен (на Windows uvloop нет); иначе None"""
+    if profile is None or not profile.uvloop:
+        return None
+    try:
+        import uvloop
+    except ImportError:
+        log.info("uvloop is not installed, using the default event loop")
+        return None
+    return uvloop.new_event_loop
+
+
+def run(main: Awaitable[T], profile: RuntimeProfile | None = None) -> T:
+    """asyncio.run с циклом событий из профиля"""
+    with asyncio.Runner(loop_factory=loop_factory(profile)) as runner:
+        return runner.run(main)
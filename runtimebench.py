@@ -0,0 +1,131 @@
+import argparse
+import asyncio
+import logging
+import json
+import time
+
+log = logging.getLogger(__name__)
+
+BENCH_TOKEN = "123456:" + "A" * 35  # токен правильного вида; запросы уходят на локальный сервер
+
+
+def _update(number: int) -> bytes:
+    """Сообщение пользователя в том виде, в каком апдейт лежит в очереди кластера"""
+    user_id = 1000 + number % 50
+    return json.dumps({"update_id": number, "message": {
+        "message_id": number, "date": int(time.time()), "text": f"БС-{number % 1000:04d}",
+        "chat": {"id": user_id, "type": "private"},
+        "from": {"id": user_id, "is_bot": False, "first_name": "Bench"},
+    }}, ensure_ascii=False).encode("utf-8")
+
+
+def _reply() -> bytes:
+    """Ответ Bot API на sendMessage с клавиатурой"""
+    return json.dumps({"ok": True, "result": {
+        "message_id": 1, "date": int(time.time()), "text": "Ключ БС-0001 свободен",
+        "chat": {"id": 1000, "type": "private"},
+        "from": {"id": 123456, "is_bot": True, "first_name": "Keys"},
+        "reply_markup": {"inline_keyboard": [[{"text": "Взять", "callback_data": "get:1"}]]},
+    }}, ensure_ascii=False).encode("utf-8")
+
+
+async def _serve() -> tuple:
+    """Локальный сервер вместо api.telegram.org: на любой метод отвечает готовым сообщением"""
+    from aiohttp import web
+
+    reply = _reply()
+
+    async def handle(request: web.Request):
+        await request.read()
+        return web.Response(body=reply, content_type="application/json")
+
+    app = web.Application()
+    app.router.add_route("POST", "/{tail:.*}", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+
+
+async def _bench(profile, updates: int, concurrency: int) -> float:
+    """Микросекунд на апдейт: разбор JSON апдейта, обработчик, sendMessage с клавиатурой, разбор ответа"""
+    from aiogram import Bot, Dispatcher, types
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    from aiogram.utils.keyboard import InlineKeyboardBuilder
+    import runtime
+
+    runner, url = await _serve()
+    api = TelegramAPIServer.from_base(url)
+    if profile is None:
+        session = AiohttpSession(api=api)
+    else:
+        session = runtime.TunedSession(profile, runtime.connection_limit(profile, concurrency), api=api)
+    bot = Bot(BENCH_TOKEN, session=session)
+    dp = Dispatcher()
+
+    @dp.message()
+    async def handle(message: types.Message):
+        keyboard = InlineKeyboardBuilder()
+        keyboard.button(text="Взять", callback_data=f"get:{message.message_id}")
+        await message.answer(f"Ключ {message.text} свободен", reply_markup=keyboard.as_markup())
+
+    slots = asyncio.Semaphore(concurrency)
+
+    async def feed(raw: bytes):
+        try:
+            await dp.feed_raw_update(bot, bot.session.json_loads(raw))
+        finally:
+            slots.release()
+
+    async def run(batch: list[bytes]):
+        tasks = []
+        for raw in batch:
+            await slots.acquire()
+            tasks.append(asyncio.create_task(feed(raw)))
+        await asyncio.gather(*tasks)
+
+    try:
+        await run([_update(number) for number in range(concurrency * 10)])  # прогрев: соединения открыты
+        batch = [_update(number) for number in range(updates)]
+        started = time.perf_counter()
+        await run(batch)
+        return (time.perf_counter() - started) / updates * 1e6
+    finally:
+        await bot.session.close()
+        await runner.cleanup()
+
+
+def main():
+    """Накладные расходы на апдейт: стандартная сессия и цикл против производительного режима"""
+    parser = argparse.ArgumentParser(description="Per-update overhead of the default and the performance runtime")
+    parser.add_argument("--updates", type=int, default=5000, help="updates per measurement")
+    parser.add_argument("--concurrency", type=int, default=16, help="updates in flight at once")
+    parser.add_argument("--repeat", type=int, default=3, help="measurements per variant, the best one is reported")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    logging.getLogger("aiogram").setLevel(logging.WARNING)  # иначе строка лога на каждый апдейт
+    import runtime
+
+    variants = [
+        ("default", None),
+        ("orjson", runtime.RuntimeProfile(uvloop=False)),
+        ("uvloop", runtime.RuntimeProfile(orjson=False)),
+        ("orjson + uvloop", runtime.RuntimeProfile()),
+    ]
+    baseline = None
+    for name, profile in variants:
+        if profile is not None and (profile.orjson and runtime.orjson is None
+                                    or profile.uvloop and runtime.loop_factory(profile) is None):
+            log.info("%s: skipped, not installed", name)
+            continue
+        cost = min(runtime.run(_bench(profile, args.updates, args.concurrency), profile) for _ in range(args.repeat))
+        baseline = baseline or cost
+        log.info("%s: %.0f us/update (x%.2f)", name, cost, baseline / cost)
+
+
+if __name__ == "__main__":
+    main()
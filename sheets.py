@@ -1,16 +1,37 @@
-from dataclasses import dataclass
-from datetime import datetime
+from collections import OrderedDict, defaultdict, deque
+from contextlib import contextmanager
+from concurrent.futures import Future
+from bisect import bisect_right, insort_right
+from dataclasses import dataclass, asdict, field
+from datetime import datetime, timedelta
 from itertools import permutations
+from operator import attrgetter, itemgetter
 from prettytable import PrettyTable
 from difflib import SequenceMatcher
 from openpyxl import Workbook, load_workbook
-import logger
+from aggregates import JournalAggregates, JournalHistory
+from intervals import IntervalTree, max_depth
+from keyindex import KeyIndex
+from watcher import FileWatcher
+from typing import Callable, Iterator, TypeVar
+import xlsxparse
+import snapshot
+import events
+import asyncio
+import logging
 import json
 import os
+import re
 import sys
+import threading
 import zipfile
 import time
 
+if sys.platform == "win32":
+    import msvcrt
+else:
+    import fcntl
+
 
 def resource_path(relative_path):
     """ Get absolute path to resource, works for dev and for PyInstaller """
@@ -23,6 +44,11 @@ def resource_path(relative_path):
 
 datetime_format = "%Y-%m-%d %H:%M:%S"
 tables_path = resource_path(os.path.join("credentials", "excel_tables.json"))
+default_site_name = "default"
+
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
 
 
 # endregion
@@ -53,11 +79,43 @@ def find_similar(query: str, strings: list[str]) -> list[str]:
 
 
 def sort_values_by_headers(russian_headers, values, keys_headers):
-    header_to_key = swap(keys_headers)
-    sorted_keys = [header_to_key[header] for header in russian_headers]
-    value_dict = dict(zip(keys_headers.keys(), values))
-    sorted_values = [value_dict[key] for key in sorted_keys]
-    return sorted_values
+    return ColumnMap(russian_headers, keys_headers)(values)
+
+
+class ColumnMap:
+    """
+    Соответствие столбцов листа полям объекта, вычисляется один раз для набора заголовков.
+    Вызов переставляет значения строки так же, как sort_values_by_headers, одним itemgetter
+    """
+
+    def __init__(self, headers, keys_headers: dict):
+        header_to_key = swap(keys_headers)
+        keys = list(keys_headers)
+        self.headers = tuple(headers)
+        self.attributes = [header_to_key[header] for header in self.headers]  # поле объекта для каждого столбца
+        order = [keys.index(attribute) for attribute in self.attributes]
+        if len(order) == 1:
+            getter = itemgetter(order[0])
+            self._get = lambda values: (getter(values),)
+        else:
+            self._get = itemgetter(*order) if order else (lambda values: ())
+        self.values_of = attrgetter(*self.attributes) if self.attributes else (lambda obj: ())
+
+    def __call__(self, values) -> list:
+        return list(self._get(values))
+
+    def encode(self, obj) -> list:
+        """Значения полей объекта в порядке столбцов листа"""
+        values = self.values_of(obj)
+        return [values] if len(self.attributes) == 1 else list(values)
+
+
+def row_hash(row: tuple) -> int:
+    """Хэш строки листа без учета типов ячеек и пустых ячеек в конце"""
+    values = [str(x).strip() if x is not None else "" for x in row]
+    while values and not values[-1]:
+        values.pop()
+    return hash(tuple(values))
 
 
 def print_table(rows: list[list], headers: list[str]):
@@ -72,6 +130,30 @@ def swap(d: dict):
     return {v: k for k, v in d.items()}
 
 
+@contextmanager
+def file_lock(path: str):
+    """Межпроцессная advisory-блокировка на файле path, ждет, пока блокировку не отпустят"""
+    with open(path, "a+b") as f:
+        if sys.platform == "win32":
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)  # сам ждет ~10 секунд, затем OSError
+                    break
+                except OSError:
+                    continue
+        else:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if sys.platform == "win32":
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
 def singleton(cls):
     instances = {}
 
@@ -84,110 +166,216 @@ def singleton(cls):
 # endregion
 
 
-# region Connection
-
-
-logger = logger.Logger()
-tables_data = None
-workbook = None
-isFirstCreation = False
-
-if workbook is None:
-    with open(tables_path, "r", encoding="utf-8") as f:
-        tables_data = json.load(f)
-    print(f"Opening workbook")
-
-    try:
-        # Пытаемся загрузить существующую книгу
-        try:
-            workbook = load_workbook(tables_data["excel_file_path"])
-        except (FileNotFoundError, KeyError, zipfile.BadZipFile):
-            # Если файл не существует или поврежден, создаем новую книгу
-            workbook = Workbook()
-            # Удаляем лист по умолчанию
-            for sheet in workbook.sheetnames:
-                workbook.remove(workbook[sheet])
-            # Создаем необходимые листы
-            workbook.create_sheet(tables_data["keys_accounting_wks"])
-            workbook.create_sheet(tables_data["keys_wks"])
-            workbook.create_sheet(tables_data["employees_wks"])
-
-            isFirstCreation = True
-
-            workbook.save(tables_data["excel_file_path"])
-            print(f"Created new workbook at {tables_data['excel_file_path']}")
-
-    except Exception as e:
-        print(f"Error while opening/creating workbook: {e}")
-        raise
-
-    print(f"Workbook opened")
-
-
-# endregion
-
-
 # region Classes
 
 
-_global_workbook = None
-_global_last_reload_time = 0
-_global_last_file_mtime = 0
-
-
 class BaseTable:
     sheet_name: str
-    reload_interval = tables_data["excel_reload_interval"]  # в секундах
 
-    def __init__(self):
-        self._file_path = tables_data["excel_file_path"]
+    def __init__(self, registry: "Registry"):
+        self.registry = registry
+        self._file_path = registry.file_path
+        self.reload_interval = registry.reload_interval  # в секундах
+        self._headers: tuple | None = None
+        self._row_hashes: list[int] = []
+        self._decoded: list = []
+        self._synced_version: int | None = None
+        self._column_map: ColumnMap | None = None
+        self._header_cache: tuple[int | None, list] = (None, [])  # (версия workbook, заголовки)
         self._init_workbook()
 
     def _init_workbook(self):
         """Инициализация workbook и worksheet"""
-        self._check_reload(force=True)
+        self._check_reload()
 
     def _check_reload(self, force=False):
-        """Проверяет необходимость перезагрузки общего workbook"""
-        global _global_workbook, _global_last_reload_time, _global_last_file_mtime
-
-        now = time.time()
+        """Проверяет необходимость перезагрузки workbook реестра"""
         try:
-            current_mtime = os.path.getmtime(self._file_path)
-
-            if (
-                force or
-                _global_workbook is None or
-                now - _global_last_reload_time > self.reload_interval or
-                current_mtime > _global_last_file_mtime
-            ):
-                _global_workbook = load_workbook(self._file_path)
-                _global_last_reload_time = now
-                _global_last_file_mtime = current_mtime
-                # print(f"[BaseTable] Reloaded workbook from file")
-
-            if self.sheet_name not in _global_workbook.sheetnames:
-                _global_workbook.create_sheet(self.sheet_name)
-
-            self.wb = _global_workbook
-            self.ws = self.wb[self.sheet_name]
-
+            self.registry.check_reload(force)
         except Exception as err:
-            print(f"[BaseTable] Error checking or loading workbook: {err}")
+            log.error("Error checking or loading workbook: %s", err)
             raise
 
+    @property
+    def ws(self):
+        return self.registry.worksheet(self.sheet_name)
+
     def _save_workbook(self):
-        """Сохраняет общий workbook в файл"""
-        global _global_last_reload_time, _global_last_file_mtime
+        """Сохраняет workbook реестра в файл"""
+        self.registry.save()
+
+    def get_headers(self) -> list:
+        """Заголовки листа, перечитываются только после перезагрузки workbook"""
+        self._check_reload()
+        version, headers = self._header_cache
+        if version != self.registry.version:
+            headers = list(next(self.registry.rows(self.sheet_name, max_row=1), ()))[:len(self.keys_headers)]
+            self._header_cache = (self.registry.version, headers)
+        return list(headers)
+
+    def _columns(self, headers) -> ColumnMap:
+        """ColumnMap для заголовков, пересобирается только когда заголовки меняются"""
+        headers = tuple(headers)
+        if self._column_map is None or self._column_map.headers != headers:
+            self._column_map = ColumnMap(headers, self.keys_headers)
+        return self._column_map
+
+    # region Row cache
+
+    def _decode_row(self, headers: tuple, row: tuple, index: int):
+        """Превращает строку листа в объект таблицы, None - пропустить строку"""
+        raise NotImplementedError
+
+    def _set_row(self, obj, index: int):
+        """Обновляет номер строки у объекта, который сдвинулся при правке листа"""
+
+    def _sync(self, notify: bool = True):
+        """
+        Синхронизирует кэш строк с текущей версией workbook. Если кэш уже на текущей версии,
+        блокировка не берется: чтение не ждет писателя, который держит ее во время изменений
+        """
+        if self._synced_version == self.registry.version and self.registry.fresh:
+            return
+        with self.registry.lock:
+            self._check_reload()
+            if self._synced_version != self.registry.version:
+                self._sync_rows(notify)
+
+    def _rows(self) -> list:
+        """Декодированные строки листа, синхронизированные с текущей версией workbook"""
+        self._sync()
+        return [obj for obj in self._decoded if obj is not None]
+
+    def _rows_changed(self):
+        """Вызывается, когда содержимое кэша строк поменялось не через методы таблицы"""
+
+    def _prepare_rows(self, diff: "RowsDiff"):
+        """
+        Без блокировки, до применения diff: готовит производные структуры таблицы (сводки, индексы)
+        с учетом изменившихся строк. Результат попадает в diff.prepared, None - готовить нечего
+        """
+
+    def _rows_updated(self, diff: "RowsDiff"):
+        """Под блокировкой, после применения diff к кэшу строк: обновляет производные структуры таблицы"""
+        self._rows_changed()
+
+    def _cached(self, index: int):
+        """Объект строки index из кэша или None"""
+        position = index - 2
+        if self._synced_version != self.registry.version or not 0 <= position < len(self._decoded):
+            return None
+        return self._decoded[position]
+
+    def _sync_rows(self, notify: bool = True):
+        """Сверяет кэш строк с листом текущего workbook и сразу применяет разницу"""
+        self._apply_rows(self._diff_rows(self.registry.rows(self.sheet_name)), self.registry.version, notify)
+
+    def _diff_rows(self, rows: Iterator[tuple]) -> "RowsDiff":
+        """
+        Сравнивает лист с кэшем по хэшам строк и декодирует только вставленные или измененные строки.
+        Совпадающие по содержимому строки переиспользуются, даже если они сдвинулись.
+        Кэш не меняется, поэтому новый workbook можно сравнивать без блокировки
+        """
+        old_headers, old_hashes, old_decoded = self._headers, self._row_hashes, self._decoded
+        base = old_hashes
+        headers = next(rows, None)
+        if headers is None:
+            return RowsDiff(base, None, [], [], changed=bool(old_decoded), reset=True)
+
+        reset = headers != old_headers
+        if reset:
+            old_hashes, old_decoded = [], []
+        rows = list(rows)
+        hashes = [row_hash(row) for row in rows]
+        if hashes == old_hashes:
+            return RowsDiff(base, headers, hashes, old_decoded)
+        diff = RowsDiff(base, headers, hashes, [], changed=True, reset=reset)
+
+        old_positions = defaultdict(deque)
+        for position, fingerprint in enumerate(old_hashes):
+            old_positions[fingerprint].append(position)
+
+        for position, (fingerprint, row) in enumerate(zip(hashes, rows)):
+            index = position + 2
+            candidates = old_positions.get(fingerprint)
+            if candidates:
+                old_position = candidates.popleft()
+                obj = old_decoded[old_position]
+                if old_position != position and obj is not None:
+                    diff.moved.append((obj, index))
+            else:
+                obj = self._decode_row(headers, row, index)
+                diff.inserted.append(index)
+                if obj is not None:
+                    diff.added.append(obj)
+            diff.decoded.append(obj)
+
+        for positions in old_positions.values():
+            for position in positions:
+                diff.deleted.append(position + 2)
+                if old_decoded[position] is not None:
+                    diff.removed.append(old_decoded[position])
+        diff.deleted.sort()
+        return diff
+
+    def _apply_rows(self, diff: "RowsDiff", version: int, notify: bool = True):
+        """Под блокировкой: переводит кэш строк на версию workbook version и сообщает о внешних правках"""
+        is_initial = self._synced_version is None
+        self._synced_version = version
+        self._headers = diff.headers
+        if not diff.changed:
+            return
+        for obj, index in diff.moved:
+            self._set_row(obj, index)
+        self._row_hashes, self._decoded = diff.hashes, diff.decoded
+        if diff.reset:
+            self._rows_changed()
+        else:
+            self._rows_updated(diff)
+
+        if diff.headers is None or is_initial or not notify or not self.registry.is_writer:
+            return  # в кластере о правках сообщает только писатель, иначе каждое изменение попадет в журнал N раз
+        inserted, deleted = diff.inserted, diff.deleted
+        changed = sorted(set(inserted) & set(deleted))
+        if changed:
+            inserted = [index for index in inserted if index not in changed]
+            deleted = [index for index in deleted if index not in changed]
+        log.info(
+            "Sheet '%s' changed externally: %s inserted, %s changed, %s deleted",
+            self.sheet_name, len(inserted), len(changed), len(deleted))
+        self.registry.events.append(
+            events.ROWS_CHANGED, sheet=self.sheet_name, inserted=inserted, changed=changed, deleted=deleted)
+
+    def _cache_row(self, index: int):
+        """Обновляет кэш после собственной записи в строку index без перечитывания листа"""
+        if self._synced_version != self.registry.version or self._headers is None:
+            return
+        row = next(self.ws.iter_rows(min_row=index, max_row=index, values_only=True))
+        position = index - 2
+        while len(self._decoded) <= position:
+            self._row_hashes.append(row_hash(()))
+            self._decoded.append(None)
+        self._row_hashes[position] = row_hash(row)
+        self._decoded[position] = self._decode_row(self._headers, row, index)
+
+    # endregion
 
-        try:
-            self.wb.save(self._file_path)
-            _global_last_reload_time = time.time()
-            _global_last_file_mtime = os.path.getmtime(self._file_path)
-            # print(f"[BaseTable] Saved workbook to file")
-        except Exception as err:
-            print(f"[BaseTable] Error saving workbook: {err}")
-            raise
+
+@dataclass
+class RowsDiff:
+    """Разница между кэшем строк таблицы и листом: считается без блокировки, применяется под ней"""
+    base: list[int]  # хэши кэша, с которым сравнивали: если кэш с тех пор заменен, разница устарела
+    headers: tuple | None
+    hashes: list[int]
+    decoded: list
+    changed: bool = False
+    reset: bool = False  # заголовки поменялись или лист пуст: производные структуры строятся заново
+    moved: list[tuple[object, int]] = field(default_factory=list)  # (объект, новый номер строки)
+    inserted: list[int] = field(default_factory=list)
+    deleted: list[int] = field(default_factory=list)
+    added: list = field(default_factory=list)  # объекты вставленных и измененных строк
+    removed: list = field(default_factory=list)  # объекты удаленных и измененных строк, как в кэше
+    prepared: object = None  # результат _prepare_rows
 
 
 class Entry:
@@ -227,6 +415,18 @@ class Entry:
             raise TypeError(
                 f"time_returned must be a datetime object or a string in '%d.%m.%Y %H:%M:%S' format. Current value: {time_returned}")
 
+    def to_dict(self) -> dict:
+        return {
+            "key_name": self.key_name,
+            "emp_firstname": self.emp_firstname,
+            "emp_lastname": self.emp_lastname,
+            "emp_phone": self.emp_phone,
+            "time_received": self.time_received.strftime(datetime_format),
+            "time_returned": self.time_returned.strftime(datetime_format) if self.time_returned else None,
+            "comment": self.comment,
+            "row": self.row,
+        }
+
     def __repr__(self):
         return (
             "----------\n"
@@ -240,7 +440,7 @@ class Entry:
 
 
 class KeysAccountingTable(BaseTable):
-    def __init__(self):
+    def __init__(self, registry: "Registry"):
         self.keys_headers = {
             "key_name": "Ключ",
             "emp_firstname": "Имя",
@@ -250,8 +450,20 @@ class KeysAccountingTable(BaseTable):
             "time_returned": "Время сдачи",
             "comment": "Комментарий",
         }
-        self.sheet_name = tables_data["keys_accounting_wks"]
-        super().__init__()
+        self.sheet_name = registry.config["keys_accounting_wks"]
+        self.archive_after_days = registry.config.get("archive_after_days")  # None - архивирование выключено
+        self._aggregates: JournalAggregates | None = None
+        self._history: JournalHistory | None = None
+        self.generation = 0  # растет при любом изменении записей журнала
+        # (journal_version, ключ -> последняя невозвращенная запись, ключ -> все невозвращенные записи)
+        self._holders: tuple[tuple, dict[str, Entry], dict[str, list[Entry]]] = ((), {}, {})
+        self.archive = JournalArchive(
+            registry.config.get("archive_dir") or os.path.join(os.path.dirname(registry.file_path), "archive"),
+            os.path.splitext(os.path.basename(registry.file_path))[0],
+            self.sheet_name,
+            self._decode_row,
+        )
+        super().__init__(registry)
 
     def new_entry(self, key_name: str, emp_firstname: str, emp_lastname: str, emp_phone: str, comment: str = ""):
         self._check_reload()
@@ -259,51 +471,198 @@ class KeysAccountingTable(BaseTable):
         self.append_entry(Entry(key_name, emp_firstname, emp_lastname, emp_phone, datetime.now(), None, comment))
 
     def setup_table(self):
-        print("Setting up keys accounting table")
+        log.info("Setting up keys accounting table")
         if self.ws.max_row == 0 or not any(cell.value for cell in self.ws[1]):
             self.ws.delete_rows(1, self.ws.max_row)
             self.ws.append(list(self.keys_headers.values()))
             self._save_workbook()
-
-    def get_headers(self):
-        self._check_reload()
-        return [cell.value for cell in self.ws[1]][:len(self.keys_headers)]
+            self._synced_version = None
+            self._header_cache = (None, [])
 
     def append_entry(self, entry: Entry):
-        self._check_reload()
-        print("Appending entry:", entry)
-        headers = self.get_headers()
-        values = []
-        for header in headers:
-            key = swap(self.keys_headers)[header]
-            val = getattr(entry, key)
-            if isinstance(val, datetime):
-                val = val.strftime(datetime_format)
-            values.append(val)
-        self.ws.append(values)
-        self._save_workbook()
+        log.debug("Appending entry: %s", entry)
+
+        def append() -> int:
+            columns = self._columns(self.get_headers())
+            values = [val.strftime(datetime_format) if isinstance(val, datetime) else val for val in columns.encode(entry)]
+            self.ws.append(values)
+            index = self.ws.max_row
+            # Кэши обновляются внутри записи: если сохранить не удастся, write откатит их вместе с workbook
+            self._cache_row(index)
+            self.generation += 1
+            cached = self._cached(index)
+            if self._aggregates is not None and cached is not None:
+                self._aggregates.issued(cached)
+            if self._history is not None and cached is not None:
+                self._history.issued(cached)
+            return index
+
+        entry.row = self.registry.write(append)
+        self.registry.emit(events.KEY_ISSUED, **entry.to_dict())
+
+    def _decode_row(self, headers: tuple, row: tuple, index: int) -> Entry | None:
+        if not any(row):  # Skip empty rows
+            return None
+        row = [str(x).strip() if x is not None else "" for x in row][:len(self.keys_headers)]
+        row = self._columns(headers)(row)
+        row.append(index)
+        try:
+            return Entry(*row)
+        except ValueError as err:
+            log.warning("Error in row %s: %s, %s", index, row, err)
+            return None
+
+    def _set_row(self, obj: Entry, index: int):
+        obj.row = index
 
     def get_all_entries(self) -> list[Entry]:
-        self._check_reload()
-        rows = list(self.ws.iter_rows(values_only=True))
-        if not rows:
-            return []
-        headers = rows[0]
-        rows = rows[1:]
-        entries = []
-        for index, row in enumerate(rows, 2):
-            if not any(row):  # Skip empty rows
-                continue
-            row = [str(x).strip() if x is not None else "" for x in row][:len(self.keys_headers)]
-            row = sort_values_by_headers(headers, row, self.keys_headers)
-            row.append(index)
-            try:
-                entries.append(Entry(*row))
-            except ValueError as err:
-                print(f"Error in row {index}: {row}, {err}")
-                pass
+        """Записи основного листа (недавние и невозвращенные)"""
+        return self._rows()
+
+    def get_entries(self, since: datetime = None, until: datetime = None) -> list[Entry]:
+        """
+        Записи журнала вместе с архивом, время получения в [since, until).
+        Читаются только архивные месяцы, попадающие в диапазон
+        """
+        entries = self.archive.get_entries(since, until) + self.get_all_entries()
+        if since is not None or until is not None:
+            entries = [
+                entry for entry in entries
+                if (since is None or entry.time_received >= since) and (until is None or entry.time_received < until)
+            ]
         return entries
 
+    def _rows_changed(self):
+        self._aggregates = None
+        self._history = None
+        self.generation += 1
+
+    def _prepare_rows(self, diff: RowsDiff):
+        """Сводки и история с учетом правок (копии, меняются только затронутые ключи и сотрудники) и невозвращенные записи"""
+        history, aggregates = self._history, self._aggregates
+        new_history = new_aggregates = None
+        if history is not None:
+            new_history = history.updated(diff.removed, diff.added)
+        elif aggregates is not None:
+            new_history = JournalHistory.from_entries(entry for entry in diff.decoded if entry is not None)
+        if aggregates is not None:
+            # Сводки считаются по всему журналу: затронутым ключам и сотрудникам нужны и их архивные записи.
+            # Раз сводки построены, архивные месяцы уже прочитаны и берутся из кэша архива
+            changed = [*diff.removed, *diff.added]
+            full_history = JournalHistory.merged(
+                [*map(self.archive.history, self.archive.months()), new_history],
+                keys={entry.key_name for entry in changed},
+                employees={(entry.emp_firstname, entry.emp_lastname) for entry in changed})
+            new_aggregates = aggregates.updated(full_history, diff.removed, diff.added)
+        by_key = defaultdict(list)
+        for entry in diff.decoded:
+            if entry is not None and entry.time_returned is None:
+                by_key[entry.key_name].append(entry)
+        holders = ({name: entries[-1] for name, entries in by_key.items()}, dict(by_key))
+        return history, aggregates, new_history, new_aggregates, holders
+
+    def _rows_updated(self, diff: RowsDiff):
+        if diff.prepared is None:
+            return self._rows_changed()
+        history, aggregates, new_history, new_aggregates, holders = diff.prepared
+        # Готовые структуры ставятся, только если исходные не поменялись с начала подготовки
+        self._history = new_history if self._history is history else None
+        self._aggregates = new_aggregates if self._aggregates is aggregates else None
+        self.generation += 1
+        self._holders = ((self.registry.version, self.generation), *holders)
+
+    def journal_version(self) -> tuple:
+        """Меняется при любом изменении записей журнала, ключ для кэшей поверх get_entries()"""
+        self._sync()
+        return self.registry.version, self.generation
+
+    @property
+    def aggregates(self) -> JournalAggregates:
+        """Сводки по ключам и сотрудникам с учетом архива, пересчитываются только после внешних правок"""
+        self._sync()
+        if self._aggregates is None:
+            self._aggregates = JournalAggregates.from_entries(self.get_entries())
+        return self._aggregates
+
+    @property
+    def history(self) -> JournalHistory:
+        """История по ключам и сотрудникам листа (без архива), перестраивается только после внешних правок"""
+        with self.registry.lock:
+            self._sync()
+            if self._history is None:
+                self._history = JournalHistory.from_entries(self.get_all_entries())
+            return self._history
+
+    def _histories(self, since: datetime = None, until: datetime = None) -> list[JournalHistory]:
+        """Истории архивных месяцев, пересекающихся с [since, until), и история листа"""
+        return [*map(self.archive.history, self.archive.months(since, until)), self.history]
+
+    def key_history(self, key_name: str, since: datetime = None, until: datetime = None) -> list[Entry]:
+        """Записи по ключу (с архивом), время получения в [since, until). Читаются только месяцы из диапазона"""
+        return JournalHistory.merged(self._histories(since, until), keys=[key_name]).key(key_name, since, until)
+
+    def emp_history(self, first_name: str, last_name: str, since: datetime = None, until: datetime = None) -> list[Entry]:
+        """Записи по сотруднику (с архивом), время получения в [since, until). Читаются только месяцы из диапазона"""
+        name = (first_name, last_name)
+        return JournalHistory.merged(self._histories(since, until), employees=[name]).employee(*name, since, until)
+
+    def rebuild_aggregates(self) -> list[str]:
+        """Полный пересчет сводок по журналу. Возвращает расхождения со сводками до пересчета"""
+        entries = self.get_entries()
+        problems = self._aggregates.check(entries) if self._aggregates is not None else []
+        self._aggregates = JournalAggregates.from_entries(entries)
+        for problem in problems:
+            log.warning("Aggregates mismatch in site '%s': %s", self.registry.name, problem)
+        return problems
+
+    def archive_closed_entries(self, older_than_days: float = None) -> int:
+        """
+        Переносит возвращенные более older_than_days дней назад записи в помесячные архивные файлы.
+        Возвращает количество перенесенных записей
+        """
+        if older_than_days is None:
+            older_than_days = self.archive_after_days
+        if older_than_days is None:
+            return 0
+        cutoff = datetime.now() - timedelta(days=older_than_days)
+
+        def archive():
+            entries = [entry for entry in self.get_all_entries() if entry.time_returned and entry.time_returned < cutoff]
+            if not entries:
+                return entries, {}
+
+            archived_rows = {entry.row for entry in entries}
+            headers = self._headers
+            rows = list(self.ws.iter_rows(min_row=2, values_only=True))
+            by_month = defaultdict(list)
+            for entry in entries:
+                by_month[entry.time_received.strftime("%Y-%m")].append(rows[entry.row - 2])
+            # Сначала пишем архив: при сбое запись окажется в обоих местах, а не потеряется.
+            # Повторное применение после конфликта безопасно, архив отбрасывает дубликаты
+            for month, month_rows in by_month.items():
+                self.archive.append(month, headers, month_rows)
+
+            # Удаляем на месте, снизу вверх и подряд идущими блоками: у оставшихся строк сохраняются
+            # оформление и формулы, а номера еще не удаленных строк не сдвигаются
+            indexes = sorted(archived_rows, reverse=True)
+            start = 0
+            for position in range(1, len(indexes) + 1):
+                if position == len(indexes) or indexes[position] != indexes[position - 1] - 1:
+                    self.ws.delete_rows(indexes[position - 1], position - start)
+                    start = position
+            aggregates = self._aggregates
+            self._sync_rows(notify=False)
+            self._aggregates = aggregates  # записи только переехали в архив, сводки не меняются (история листа - да)
+            return entries, by_month
+
+        entries, by_month = self.registry.write(archive)
+        if not entries:
+            return 0
+
+        log.info("Archived %s entries of site '%s' into %s", len(entries), self.registry.name, ", ".join(sorted(by_month)))
+        self.registry.emit(events.ENTRIES_ARCHIVED, count=len(entries), months=sorted(by_month))
+        return len(entries)
+
     def get_not_returned_keys(self) -> list[Entry]:
         self._check_reload()
         entries = self.get_all_entries()
@@ -313,17 +672,71 @@ class KeysAccountingTable(BaseTable):
                 not_returned_keys.append(entry)
         return not_returned_keys
 
+    def _open(self) -> tuple[tuple, dict[str, Entry], dict[str, list[Entry]]]:
+        with self.registry.lock:
+            version = self.journal_version()
+            if self._holders[0] != version:
+                by_key = defaultdict(list)
+                for entry in self.get_not_returned_keys():
+                    by_key[entry.key_name].append(entry)
+                self._holders = (version, {name: entries[-1] for name, entries in by_key.items()}, dict(by_key))
+            return self._holders
+
+    def holders(self) -> dict[str, Entry]:
+        """Невозвращенные записи по названию ключа (последняя выдача), пересчет только после изменений журнала"""
+        return self._open()[1]
+
+    def open_entries(self, key_name: str) -> list[Entry]:
+        """Все невозвращенные записи по ключу (у ключа может быть несколько экземпляров)"""
+        return self._open()[2].get(key_name, [])
+
+    def _find_row(self, entry: Entry) -> int | None:
+        """Текущий номер строки записи: entry.row, если строка не сдвинулась, иначе поиск по листу"""
+        headers = next(self.ws.iter_rows(max_row=1, values_only=True), None)
+
+        def matches(row, index) -> bool:
+            found = self._decode_row(headers, row, index)
+            return (
+                found is not None and
+                (found.key_name, found.emp_firstname, found.emp_lastname, found.time_received) ==
+                (entry.key_name, entry.emp_firstname, entry.emp_lastname, entry.time_received)
+            )
+
+        if entry.row and 2 <= entry.row <= self.ws.max_row:
+            row = next(self.ws.iter_rows(min_row=entry.row, max_row=entry.row, values_only=True))
+            if matches(row, entry.row):
+                return entry.row
+        for index, row in enumerate(self.ws.iter_rows(min_row=2, values_only=True), 2):
+            if matches(row, index):
+                return index
+        return None
+
     def set_return_time(self, entry: Entry, time_returned: datetime = None) -> None:
-        self._check_reload()
-        headers = self.get_headers()
         if time_returned is None:
             time_returned = datetime.now().strftime(datetime_format)
-        col_idx = headers.index(self.keys_headers["time_returned"]) + 1
-        self.ws.cell(row=entry.row, column=col_idx, value=time_returned)
-        self._save_workbook()
+
+        def set_returned() -> int:
+            headers = self.get_headers()
+            index = self._find_row(entry)
+            if index is None:
+                raise ValueError(f"Entry of key '{entry.key_name}' not found in sheet '{self.sheet_name}'")
+            col_idx = headers.index(self.keys_headers["time_returned"]) + 1
+            self.ws.cell(row=index, column=col_idx, value=time_returned)
+            self._cache_row(index)
+            self.generation += 1
+            cached = self._cached(index)
+            if self._aggregates is not None and cached is not None:
+                self._aggregates.returned(cached)
+            if self._history is not None and cached is not None:
+                self._history.returned(cached)
+            return index
+
+        entry.row = self.registry.write(set_returned)
+        if isinstance(time_returned, datetime):
+            time_returned = time_returned.strftime(datetime_format)
+        self.registry.emit(events.KEY_RETURNED, **{**entry.to_dict(), "time_returned": time_returned})
 
     def set_return_time_by_key_name(self, key_name: str, time_returned: datetime = None) -> None:
-        self._check_reload()
         entries = self.get_not_returned_keys()
         for entry in entries:
             if entry.key_name == key_name:
@@ -340,71 +753,118 @@ class Key:
 
 
 class KeysTable(BaseTable):
-    def __init__(self):
+    def __init__(self, registry: "Registry"):
         self.keys_headers = {
             "key_name": "Ключ",
             "count": "Количество",
             "key_type": "Тип ключа",
             "hardware_type": "Тип (Аппаратный)",
         }
-        self.sheet_name = tables_data["keys_wks"]
-        super().__init__()
+        self.sheet_name = registry.config["keys_wks"]
+        self._by_name: dict[str, Key] | None = None  # название -> ключ, строится лениво вместе с _index
+        self._index: KeyIndex | None = None
+        super().__init__(registry)
+
+    def _indexed(self) -> tuple[dict[str, Key], KeyIndex]:
+        """Индексы по названию; строки листа не копируются, индексы строятся только после изменения листа"""
+        self._sync()
+        by_name, index = self._by_name, self._index
+        if by_name is None or index is None:
+            with self.registry.lock:
+                self._sync()
+                if self._by_name is None:
+                    by_name = {}
+                    for key in self._decoded:
+                        if key is not None:
+                            by_name.setdefault(key.key_name, key)
+                    self._index = KeyIndex(by_name)
+                    self._by_name = by_name
+                by_name, index = self._by_name, self._index
+        return by_name, index
 
     def get_by_name(self, name: str) -> Key | None:
-        self._check_reload()
-        keys = self.get_all_keys()
-        for key in keys:
-            if key.key_name == name:
-                return key
-        return None
+        return self._indexed()[0].get(name)
+
+    def search(self, prefix: str, limit: int = 50) -> list[Key]:
+        """Ключи, название которых или слово/номер в нем начинается с prefix (для inline-режима)"""
+        by_name, index = self._indexed()
+        return [by_name[name] for name in index.search(prefix, limit)]
 
     def setup_table(self):
-        print("Setting up keys table")
+        log.info("Setting up keys table")
         if self.ws.max_row == 0 or not any(cell.value for cell in self.ws[1]):
             self.ws.delete_rows(1, self.ws.max_row)
             self.ws.append(list(self.keys_headers.values()))
             self._save_workbook()
-
-    def get_headers(self):
-        self._check_reload()
-        return [cell.value for cell in self.ws[1]][:len(self.keys_headers)]
+            self._synced_version = None
+            self._header_cache = (None, [])
 
     def new_key(self, key_name, count):
         self._check_reload()
         self.add_key(Key(key_name, count, "None", "None"))
 
     def add_key(self, key_obj: Key):
-        self._check_reload()
-        headers = self.get_headers()
-        values = []
-        for header in headers:
-            key = swap(self.keys_headers)[header]
-            val = getattr(key_obj, key)
-            values.append(val)
-        self.ws.append(values)
-        self._save_workbook()
+        def append():
+            self.ws.append(self._columns(self.get_headers()).encode(key_obj))
+            index = self.ws.max_row
+            self._cache_row(index)
+            key = self._cached(index)
+            if self._by_name is not None and key is not None and key.key_name not in self._by_name:
+                self._by_name[key.key_name] = key
+                self._index.add(key.key_name)
+
+        self.registry.write(append)
+        self.registry.emit(events.KEY_ADDED, **asdict(key_obj))
+
+    def _decode_row(self, headers: tuple, row: tuple, index: int) -> Key | None:
+        if not any(row):  # Skip empty rows
+            return None
+        row = [str(x).strip() if x is not None else "" for x in row][:len(self.keys_headers)]
+        while len(row) < len(self.keys_headers):
+            row.append("")
+        row = self._columns(headers)(row)
+        try:
+            return Key(*row)
+        except ValueError:
+            log.warning("Error in table keys in row %s", row)
+            return None
+
+    def _rows_changed(self):
+        self._by_name = self._index = None
+
+    def _prepare_rows(self, diff: RowsDiff):
+        """Индекс по названию с учетом правок; префиксное дерево строится заново, только если ключ исчез"""
+        by_name, index = self._by_name, self._index
+        if by_name is None or index is None:
+            return None
+        new_by_name = dict(by_name)
+        touched = {key.key_name for key in diff.removed}
+        for name in touched:
+            new_by_name.pop(name, None)
+        if touched:
+            for key in diff.decoded:
+                if key is not None and key.key_name in touched:
+                    new_by_name.setdefault(key.key_name, key)
+        added = []
+        for key in diff.added:
+            if key.key_name not in new_by_name:
+                new_by_name[key.key_name] = key
+                added.append(key.key_name)
+        if any(name not in new_by_name for name in touched):
+            return by_name, new_by_name, KeyIndex(new_by_name), []
+        return by_name, new_by_name, index, added
+
+    def _rows_updated(self, diff: RowsDiff):
+        if diff.prepared is None or self._by_name is not diff.prepared[0]:
+            return self._rows_changed()
+        _, by_name, index, added = diff.prepared
+        for name in added:
+            index.add(name)
+        self._index = index
+        self._by_name = by_name
 
     def get_all_keys(self) -> list[Key]:
-        self._check_reload()
-        rows = list(self.ws.iter_rows(values_only=True))
-        if not rows:
-            return []
-        headers = rows[0]
-        rows = rows[1:]
-        keys = []
-        for row in rows:
-            if not any(row):  # Skip empty rows
-                continue
-            row = [str(x).strip() if x is not None else "" for x in row][:len(self.keys_headers)]
-            while len(row) < len(self.keys_headers):
-                row.append("")
-            row = sort_values_by_headers(headers, row, self.keys_headers)
-            try:
-                keys.append(Key(*row))
-            except ValueError:
-                print(f"Error in table keys in row {row}")
-                pass
-        return keys
+        return self._rows()
 
 
 class Employee:
@@ -441,8 +901,18 @@ class Employee:
         )
 
 
+def _roles_index(employees: list) -> dict[str, list[Employee]]:
+    """Роль -> сотрудники с ней, в порядке строк листа"""
+    by_role = defaultdict(list)
+    for employee in employees:
+        if employee is not None:
+            for role in employee.roles:
+                by_role[role].append(employee)
+    return dict(by_role)
+
+
 class EmployeesTable(BaseTable):
-    def __init__(self):
+    def __init__(self, registry: "Registry"):
         self.keys_headers = {
             "first_name": "Имя",
             "last_name": "Фамилия",
@@ -450,19 +920,18 @@ class EmployeesTable(BaseTable):
             "telegram": "Телеграм",
             "roles": "Роли",
         }
-        self.sheet_name = tables_data["employees_wks"]
-        super().__init__()
+        self.sheet_name = registry.config["employees_wks"]
+        self._by_role: dict[str, list[Employee]] | None = None  # роль -> сотрудники, строится лениво
+        super().__init__(registry)
 
     def setup_table(self):
-        print("Setting up employees table")
+        log.info("Setting up employees table")
         if self.ws.max_row == 0 or not any(cell.value for cell in self.ws[1]):
             self.ws.delete_rows(1, self.ws.max_row)
             self.ws.append(list(self.keys_headers.values()))
             self._save_workbook()
-
-    def get_headers(self):
-        self._check_reload()
-        return [cell.value for cell in self.ws[1]][:len(self.keys_headers)]
+            self._synced_version = None
+            self._header_cache = (None, [])
 
     def new_employee(
             self,
@@ -476,37 +945,45 @@ class EmployeesTable(BaseTable):
         self.add_employee(Employee(first_name, last_name, phone, telegram, roles))
 
     def add_employee(self, employee_obj: Employee):
-        self._check_reload()
-        headers = self.get_headers()
-        values = []
-        for header in headers:
-            key = swap(self.keys_headers)[header]
-            val = getattr(employee_obj, key)
-            if isinstance(val, list):
-                val = ", ".join(val)
-            values.append(str(val))
-        self.ws.append(values)
-        self._save_workbook()
+        def append() -> int:
+            columns = self._columns(self.get_headers())
+            values = [str(", ".join(val) if isinstance(val, list) else val) for val in columns.encode(employee_obj)]
+            self.ws.append(values)
+            index = self.ws.max_row
+            self._cache_row(index)
+            employee = self._cached(index)
+            if self._by_role is not None and employee is not None:
+                for role in employee.roles:
+                    self._by_role.setdefault(role, []).append(employee)
+
+        self.registry.write(append)
+        self.registry.emit(events.EMPLOYEE_REGISTERED, **vars(employee_obj))
+
+    def _rows_changed(self):
+        self._by_role = None
+
+    def _prepare_rows(self, diff: RowsDiff):
+        if self._by_role is None:
+            return None
+        return self._by_role, _roles_index(diff.decoded)
+
+    def _rows_updated(self, diff: RowsDiff):
+        prepared = diff.prepared
+        self._by_role = prepared[1] if prepared is not None and self._by_role is prepared[0] else None
+
+    def _decode_row(self, headers: tuple, row: tuple, index: int) -> Employee | None:
+        if not any(row):  # Skip empty rows
+            return None
+        row = [str(x).strip() if x is not None else "" for x in row][:len(self.keys_headers)]
+        row = self._columns(headers)(row)
+        try:
+            return Employee(*row)
+        except ValueError:
+            log.warning("Error in table employees in row %s", row)
+            return None
 
     def get_all_employees(self) -> list[Employee]:
-        self._check_reload()
-        rows = list(self.ws.iter_rows(values_only=True))
-        if not rows:
-            return []
-        headers = rows[0]
-        rows = rows[1:]
-        employees = []
-        for row in rows:
-            if not any(row):  # Skip empty rows
-                continue
-            row = [str(x).strip() if x is not None else "" for x in row][:len(self.keys_headers)]
-            row = sort_values_by_headers(headers, row, self.keys_headers)
-            try:
-                employees.append(Employee(*row))
-            except ValueError:
-                print(f"Error in table employees in row {row}")
-                pass
-        return employees
+        return self._rows()
 
     def get_by_telegram(self, telegram: str):
         self._check_reload()
@@ -516,12 +993,24 @@ class EmployeesTable(BaseTable):
             if employee.telegram == telegram:
                 return employee
 
+    def with_role(self, role: str) -> list[Employee]:
+        """Сотрудники с ролью role по индексу ролей, индекс пересобирается только после изменения листа"""
+        self._sync()
+        by_role = self._by_role
+        if by_role is None:
+            with self.registry.lock:
+                self._sync()
+                if self._by_role is None:
+                    self._by_role = _roles_index(self._decoded)
+                by_role = self._by_role
+        return list(by_role.get(role, ()))
+
+    def get_security_employees(self) -> list[Employee]:
+        return self.with_role("security")
+
     def get_security_employee(self):
-        self._check_reload()
-        employees = self.get_all_employees()
-        for employee in employees:
-            if "security" in employee.roles:
-                return employee
+        employees = self.get_security_employees()
+        return employees[0] if employees else None
 
     def get_by_name(self, first_name: str, last_name: str):
         self._check_reload()
@@ -531,30 +1020,1238 @@ class EmployeesTable(BaseTable):
                 return employee
 
 
-if isFirstCreation:
-    kat = KeysAccountingTable()
-    kat.setup_table()
-    del kat
-    keys = KeysTable()
-    keys.setup_table()
-    del keys
-    emps = EmployeesTable()
-    emps.setup_table()
-    del emps
+BOOKING_ACTIVE = "Активна"
+BOOKING_REQUESTED = "Запрошена"  # время брони наступило, охране отправлен запрос
+BOOKING_CANCELLED = "Отменена"
+BOOKING_EXPIRED = "Истекла"  # бронь закончилась раньше, чем бот успел отправить запрос
+
+
+@dataclass
+class Booking:
+    key_name: str
+    emp_firstname: str
+    emp_lastname: str
+    telegram: str
+    start: datetime
+    end: datetime
+    status: str = field(default=BOOKING_ACTIVE, compare=False)  # одна и та же бронь в любом статусе
+    row: int | None = field(default=None, compare=False)
+
+    def __post_init__(self):
+        if isinstance(self.start, str):
+            self.start = datetime.strptime(self.start, datetime_format)
+        if isinstance(self.end, str):
+            self.end = datetime.strptime(self.end, datetime_format)
+        self.start, self.end = self.start.replace(microsecond=0), self.end.replace(microsecond=0)  # как в листе
+        if self.end <= self.start:
+            raise ValueError(f"Booking ends before it starts: {self.start} - {self.end}")
+        self.telegram = str(self.telegram)
+        self.status = self.status or BOOKING_ACTIVE
+
+    def to_dict(self) -> dict:
+        return {
+            "key_name": self.key_name,
+            "emp_firstname": self.emp_firstname,
+            "emp_lastname": self.emp_lastname,
+            "telegram": self.telegram,
+            "start": self.start.strftime(datetime_format),
+            "end": self.end.strftime(datetime_format),
+            "status": self.status,
+        }
+
+
+class BookingConflictError(Exception):
+    """В окне брони не остается свободного экземпляра ключа; conflicts - брони и записи журнала, которые его занимают"""
+
+    def __init__(self, booking: Booking, conflicts: list):
+        super().__init__(booking, conflicts)
+        self.booking = booking
+        self.conflicts = conflicts
+
+    def __str__(self):
+        return f"Key '{self.booking.key_name}' is fully booked in {self.booking.start} - {self.booking.end}"
+
+
+_booking_start = attrgetter("start")
+
+
+def _index_booking(trees: dict[str, IntervalTree], by_start: list[Booking], booking: Booking):
+    """Добавляет активную бронь в дерево интервалов ее ключа и в список по началу"""
+    if booking.status != BOOKING_ACTIVE:
+        return
+    tree = trees.get(booking.key_name)
+    if tree is None:
+        tree = trees[booking.key_name] = IntervalTree()
+    tree.insert(booking.start, booking.end, booking)
+    insort_right(by_start, booking, key=_booking_start)
+
+
+class BookingsTable(BaseTable):
+    """
+    Брони ключей на будущее время. Активные брони индексируются деревом интервалов на каждый ключ,
+    поэтому проверка пересечений не зависит от общего числа броней; список по началу нужен планировщику
+    """
+
+    def __init__(self, registry: "Registry"):
+        self.keys_headers = {
+            "key_name": "Ключ",
+            "emp_firstname": "Имя",
+            "emp_lastname": "Фамилия",
+            "telegram": "Телеграм",
+            "start": "Начало",
+            "end": "Конец",
+            "status": "Статус",
+        }
+        self.sheet_name = registry.config.get("bookings_wks", "Брони")
+        self.open_entry_hours = registry.config.get("booking_open_entry_hours", 24)  # если по ключу нет статистики
+        self._trees: dict[str, IntervalTree] | None = None  # ключ -> активные брони, строится лениво
+        self._by_start: list[Booking] = []  # активные брони по времени начала
+        super().__init__(registry)
+
+    def setup_table(self):
+        log.info("Setting up bookings table")
+        if self._ensure_headers():
+            self._save_workbook()
+
+    def _ensure_headers(self) -> bool:
+        """Размечает пустой лист (книги, созданные до появления броней). True, если заголовки добавлены"""
+        if self.ws.max_row != 0 and any(cell.value for cell in self.ws[1]):
+            return False
+        self.ws.delete_rows(1, self.ws.max_row)
+        self.ws.append(list(self.keys_headers.values()))
+        self._synced_version = None
+        self._header_cache = (None, [])
+        return True
+
+    def _decode_row(self, headers: tuple, row: tuple, index: int) -> Booking | None:
+        if not any(row):  # Skip empty rows
+            return None
+        row = [str(x).strip() if x is not None else "" for x in row][:len(self.keys_headers)]
+        while len(row) < len(self.keys_headers):
+            row.append("")
+        row = self._columns(headers)(row)
+        try:
+            return Booking(*row, row=index)
+        except ValueError as err:
+            log.warning("Error in table bookings in row %s: %s, %s", index, row, err)
+            return None
+
+    def _set_row(self, obj: Booking, index: int):
+        obj.row = index
+
+    def _rows_changed(self):
+        self._trees = None  # _by_start заменится вместе с деревьями при следующем построении
+
+    def _rows_updated(self, diff: RowsDiff):
+        """Правки броней переносятся в деревья по одной: O(log n) на бронь вместо перестройки индекса"""
+        if self._trees is None:
+            return
+        for booking in diff.removed:
+            self._index_remove(booking)
+        for booking in diff.added:
+            self._index_add(booking)
+
+    def get_all_bookings(self) -> list[Booking]:
+        return self._rows()
+
+    # region Index
+
+    def _indexed(self) -> tuple[dict[str, IntervalTree], list[Booking]]:
+        """Индексы активных броней; строки листа не копируются, индексы строятся только после изменения листа"""
+        self._sync()
+        trees, by_start = self._trees, self._by_start
+        if trees is None:
+            with self.registry.lock:
+                self._sync()
+                if self._trees is None:
+                    # Строится в стороне: читатели без блокировки не должны видеть недостроенный индекс
+                    trees, by_start = {}, []
+                    for booking in self._decoded:
+                        if booking is not None:
+                            _index_booking(trees, by_start, booking)
+                    self._by_start = by_start
+                    self._trees = trees
+                trees, by_start = self._trees, self._by_start
+        return trees, by_start
+
+    def _index_add(self, booking: Booking):
+        _index_booking(self._trees, self._by_start, booking)
+
+    def _index_remove(self, booking: Booking):
+        tree = self._trees.get(booking.key_name)
+        if tree is None or not tree.remove(booking.start, booking.end, booking):
+            return
+        start = bisect_right(self._by_start, booking.start, key=_booking_start) - 1
+        while start >= 0 and self._by_start[start].start == booking.start:
+            if self._by_start[start] == booking:
+                del self._by_start[start]
+                return
+            start -= 1
+
+    # endregion
+
+    def capacity(self, key_name: str) -> int:
+        """Сколько экземпляров ключа можно выдать одновременно (столбец "Количество", по умолчанию 1)"""
+        key = self.registry.keys.get_by_name(key_name)
+        try:
+            return max(int(key.count), 1) if key else 1
+        except (TypeError, ValueError):
+            return 1
+
+    def occupied(self, key_name: str, start: datetime, end: datetime, now: datetime = None) -> list[tuple]:
+        """
+        (начало, конец, бронь или запись журнала), занимающие ключ в окне [start, end).
+        Невозвращенный ключ считается занятым до ожидаемого возврата: выдача плюс среднее время на руках
+        """
+        tree = self._indexed()[0].get(key_name)
+        found = tree.overlapping(start, end) if tree is not None else []
+        journal = self.registry.keys_accounting
+        entries = journal.open_entries(key_name)
+        if entries:
+            now = now or datetime.now()
+            holding = journal.aggregates.key(key_name).average_holding or timedelta(hours=self.open_entry_hours)
+            for entry in entries:
+                expected = max(entry.time_received + holding, now)
+                if entry.time_received < end and expected > start:
+                    found.append((entry.time_received, expected, entry))
+        return found
+
+    def conflicts(self, key_name: str, start: datetime, end: datetime) -> list:
+        """Брони и записи, из-за которых в окне не остается свободного экземпляра ключа; [] - ключ свободен"""
+        occupied = self.occupied(key_name, start, end)
+        if max_depth(occupied, start, end) < self.capacity(key_name):
+            return []
+        return [value for _, _, value in occupied]
+
+    def due(self, now: datetime = None) -> list[Booking]:
+        """Активные брони, время которых уже наступило"""
+        by_start = self._indexed()[1]
+        return by_start[:bisect_right(by_start, now or datetime.now(), key=_booking_start)]
+
+    def next_start(self) -> datetime | None:
+        """Начало ближайшей активной брони"""
+        by_start = self._indexed()[1]
+        return by_start[0].start if by_start else None
+
+    def of_user(self, telegram) -> list[Booking]:
+        """Активные брони сотрудника по времени начала"""
+        telegram = str(telegram)
+        return [booking for booking in self._indexed()[1] if booking.telegram == telegram]
+
+    def new_booking(
+            self,
+            key_name: str,
+            emp_firstname: str,
+            emp_lastname: str,
+            telegram: str,
+            start: datetime,
+            end: datetime
+    ) -> Booking:
+        self._check_reload()
+        return self.add_booking(Booking(key_name, emp_firstname, emp_lastname, telegram, start, end))
+
+    def add_booking(self, booking: Booking) -> Booking:
+        """Добавляет бронь, если в ее окне остается свободный экземпляр ключа, иначе BookingConflictError"""
+        def append() -> int:
+            # Проверка внутри записи: между проверкой и сохранением никто другой бронь не добавит
+            conflicts = self.conflicts(booking.key_name, booking.start, booking.end)
+            if conflicts:
+                raise BookingConflictError(booking, conflicts)
+            self._ensure_headers()
+            columns = self._columns(self.get_headers())
+            values = [val.strftime(datetime_format) if isinstance(val, datetime) else val for val in columns.encode(booking)]
+            self.ws.append(values)
+            index = self.ws.max_row
+            self._cache_row(index)
+            cached = self._cached(index)
+            if self._trees is not None and cached is not None:
+                self._index_add(cached)
+            return index
+
+        booking.row = self.registry.write(append)
+        log.info("Key '%s' booked by %s %s for %s - %s",
+                 booking.key_name, booking.emp_firstname, booking.emp_lastname, booking.start, booking.end)
+        self.registry.emit(events.BOOKING_ADDED, **booking.to_dict())
+        return booking
+
+    def _find_row(self, booking: Booking) -> int | None:
+        """Текущий номер строки брони: booking.row, если строка не сдвинулась, иначе поиск по листу"""
+        headers = next(self.ws.iter_rows(max_row=1, values_only=True), None)
+        if booking.row and 2 <= booking.row <= self.ws.max_row:
+            row = next(self.ws.iter_rows(min_row=booking.row, max_row=booking.row, values_only=True))
+            if self._decode_row(headers, row, booking.row) == booking:
+                return booking.row
+        for index, row in enumerate(self.ws.iter_rows(min_row=2, values_only=True), 2):
+            if self._decode_row(headers, row, index) == booking:
+                return index
+        return None
+
+    def set_status(self, booking: Booking, status: str) -> Booking:
+        def update() -> int:
+            index = self._find_row(booking)
+            if index is None:
+                raise ValueError(f"Booking of key '{booking.key_name}' not found in sheet '{self.sheet_name}'")
+            col_idx = self.get_headers().index(self.keys_headers["status"]) + 1
+            self.ws.cell(row=index, column=col_idx, value=status)
+            self._indexed()
+            self._index_remove(booking)
+            self._cache_row(index)
+            cached = self._cached(index)
+            if cached is not None:
+                self._index_add(cached)
+            return index
+
+        booking.row = self.registry.write(update)
+        booking.status = status
+        self.registry.emit(events.BOOKING_STATUS_CHANGED, **booking.to_dict())
+        return booking
+
+
+class JournalArchive:
+    """Помесячные архивные файлы журнала: <archive_dir>/<имя книги>_<ГГГГ-ММ>.xlsx"""
+
+    def __init__(self, directory: str, base_name: str, sheet_name: str, decode_row):
+        self.directory = directory
+        self.base_name = base_name
+        self.sheet_name = sheet_name
+        self._decode_row = decode_row
+        self._pattern = re.compile(re.escape(base_name) + r"_(\d{4}-\d{2})\.xlsx$")
+        self._cache: dict[str, tuple[float, list[Entry]]] = {}  # месяц -> (mtime, записи)
+        self._histories: dict[str, tuple[float, JournalHistory]] = {}  # месяц -> (mtime, история месяца)
+
+    def path(self, month: str) -> str:
+        return os.path.join(self.directory, f"{self.base_name}_{month}.xlsx")
+
+    def months(self, since: datetime = None, until: datetime = None) -> list[str]:
+        """Архивные месяцы по порядку; с since/until - только пересекающиеся с [since, until)"""
+        if not os.path.isdir(self.directory):
+            return []
+        first = since.strftime("%Y-%m") if since else None
+        last = until.strftime("%Y-%m") if until else None
+        return sorted(
+            month for month in (m.group(1) for m in map(self._pattern.match, os.listdir(self.directory)) if m)
+            if not (first and month < first) and not (last and month > last)
+        )
+
+    def append(self, month: str, headers: tuple, rows: list[tuple]):
+        """Дописывает строки в архив месяца, уже имеющиеся в нем строки пропускаются"""
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(month)
+        if os.path.exists(path):
+            wb = load_workbook(path)
+            ws = wb[self.sheet_name]
+        else:
+            wb = Workbook()
+            ws = wb.active
+            ws.title = self.sheet_name
+            ws.append(list(headers))
+        existing = {row_hash(row) for row in ws.iter_rows(min_row=2, values_only=True)}
+        for row in rows:
+            if row_hash(row) not in existing:
+                ws.append(list(row))
+        tmp_path = path + ".tmp"
+        wb.save(tmp_path)
+        os.replace(tmp_path, path)
+        self._cache.pop(month, None)
+        self._histories.pop(month, None)
+
+    def read(self, month: str) -> list[Entry]:
+        path = self.path(month)
+        mtime = os.path.getmtime(path)
+        cached = self._cache.get(month)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        wb = load_workbook(path, read_only=True)
+        try:
+            rows = wb[self.sheet_name].iter_rows(values_only=True)
+            headers = next(rows, None)
+            entries = []
+            if headers is not None:
+                for index, row in enumerate(rows, 2):
+                    entry = self._decode_row(headers, row, index)
+                    if entry is not None:
+                        entry.row = None  # строки архива не адресуются в основном листе
+                        entries.append(entry)
+        finally:
+            wb.close()
+        self._cache[month] = (mtime, entries)
+        return entries
+
+    def history(self, month: str) -> JournalHistory:
+        """История одного месяца, строится при первом запросе и живет, пока не изменился файл месяца"""
+        mtime = os.path.getmtime(self.path(month))
+        cached = self._histories.get(month)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        history = JournalHistory.from_entries(self.read(month))
+        self._histories[month] = (mtime, history)
+        return history
+
+    def get_entries(self, since: datetime = None, until: datetime = None) -> list[Entry]:
+        """Записи архивных месяцев, пересекающихся с [since, until)"""
+        entries = []
+        for month in self.months(since, until):
+            entries.extend(self.read(month))
+        return entries
 
 
 # endregion
 
 
+# region Registries
+
+
+class WriteConflictError(Exception):
+    pass
+
+
+@dataclass
+class SiteSummary:
+    """
+    То, что фоновым задачам бота нужно от выгруженной площадки. Пишется рядом с книгой при выгрузке реестра
+    и действует, пока файл книги не изменился: тогда напоминания и брони проверяются без загрузки книги
+    """
+    signature: tuple[int, int]  # сигнатура файла книги, по которой посчитана сводка
+    next_booking: datetime | None = None  # начало ближайшей активной брони
+    oldest_open: datetime | None = None  # самая ранняя выдача среди невозвращенных ключей
+    oldest_returned: datetime | None = None  # самый ранний возврат среди записей листа (кандидаты в архив)
+
+    def needs_attention(self, now: datetime, remind_after: timedelta, archive_after_days: float | None) -> bool:
+        """Есть ли ключи, о которых пора напомнить, или записи, которые пора перенести в архив"""
+        if self.oldest_open is not None and self.oldest_open + remind_after < now:
+            return True
+        return (archive_after_days is not None and self.oldest_returned is not None and
+                self.oldest_returned < now - timedelta(days=archive_after_days))
+
+    @staticmethod
+    def path(config: dict) -> str:
+        return config.get("summary_path") or os.path.splitext(config["excel_file_path"])[0] + ".summary.json"
+
+    def write(self, path: str):
+        data = {name: value.isoformat() if isinstance(value, datetime) else value for name, value in asdict(self).items()}
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+        os.replace(temp_path, path)
+
+    @classmethod
+    def read(cls, config: dict) -> "SiteSummary | None":
+        """Сводка площадки или None, если ее нет или книга изменилась после ее записи"""
+        try:
+            with open(cls.path(config), "r", encoding="utf-8") as f:
+                data = json.load(f)
+            stat = os.stat(config["excel_file_path"])
+        except (OSError, ValueError):
+            return None
+        if tuple(data.get("signature") or ()) != (stat.st_mtime_ns, stat.st_size):
+            return None
+        return cls(
+            (stat.st_mtime_ns, stat.st_size),
+            *(datetime.fromisoformat(data[name]) if data.get(name) else None
+              for name in ("next_booking", "oldest_open", "oldest_returned")))
+
+
+class Registry:
+    """Реестр ключей одной площадки: свой файл, свой кэш workbook и своя блокировка"""
+
+    def __init__(self, name: str, config: dict):
+        self.name = name
+        self.config = config
+        self.file_path = config["excel_file_path"]
+        self.reload_interval = config.get("excel_reload_interval", 300)
+        self.lock = threading.RLock()  # состояние workbook и кэшей; сохранение файла идет без нее
+        self.write_lock = threading.RLock()  # изменения книги целиком, вместе с сохранением; берется раньше self.lock
+        self.workbook = None
+        self.snapshot: snapshot.Snapshot | None = None  # данные листов до загрузки workbook при теплом старте
+        self.snapshot_path = (config.get("snapshot_path") or self.file_path + ".snapshot") \
+            if config.get("snapshot", True) else None
+        self._snapshot_signature = None  # сигнатура файла, по которому записан текущий снимок
+        self.parse_workers = config.get("parse_workers", 0)  # > 0: холодный старт через xlsxparse
+        self.last_reload_time = 0
+        self.file_signature = None  # (mtime_ns, size) файла на момент последней загрузки или сохранения
+        self.lock_path = config.get("lock_path") or self.file_path + ".lock"
+        self.version = 0  # растет при каждой загрузке workbook с диска
+        self.commit_window = config.get("commit_window", 0.05)  # сколько ждать попутных изменений, сек
+        self.commit_max_ops = config.get("commit_max_ops", 100)  # максимум изменений на одно сохранение
+        self._write_queue: asyncio.Queue | None = None
+        self._writer: asyncio.Task | None = None
+        self._batch_thread: int | None = None  # поток, который сейчас применяет пакет изменений
+        self._write_thread: int | None = None  # поток, который держит write_lock в write
+        self._batch_events: list[tuple[str, dict]] = []
+        self.max_staleness = config.get("max_staleness", 30)  # сколько секунд можно отвечать по устаревшему workbook
+        self.disk_generation = 0  # растет при каждом обнаруженном изменении файла или истечении reload_interval
+        self._stale_since: float | None = None  # time.monotonic(), с которого workbook устарел
+        self._refreshing = False
+        self._refresh_done = threading.Condition(self.lock)
+        self.watcher: FileWatcher | None = None
+        self.write_router = None  # cluster.Cluster: изменения выполняет единственный писатель кластера
+        self.last_used = time.monotonic()
+        events_path = config.get("events_path") or os.path.splitext(self.file_path)[0] + ".events.jsonl"
+        # Журнал общий для процессов площадки: после смены лидера кластера пишет другой процесс
+        self.events = events.EventLog(events_path, shared_lock=lambda: file_lock(events_path + ".lock"),
+                                      fsync=config.get("events_fsync", True))
+
+        is_first_creation = self._open_workbook()
+
+        self.keys_accounting = KeysAccountingTable(self)
+        self.keys = KeysTable(self)
+        self.employees = EmployeesTable(self)
+        self.bookings = BookingsTable(self)
+
+        if is_first_creation:
+            self.keys_accounting.setup_table()
+            self.keys.setup_table()
+            self.employees.setup_table()
+            self.bookings.setup_table()
+
+        if config.get("watch_file", True):
+            self.watcher = FileWatcher(
+                self.file_path, self._on_file_changed, self._on_watch_tick,
+                poll_interval=config.get("watch_interval", 1.0),
+            ).start()
+        if self.snapshot is not None:
+            with self.lock:
+                self._start_refresh()  # workbook для записи читается в фоне, чтение уже идет из снимка
+
+    def __repr__(self):
+        return f"Registry({self.name!r}, {self.file_path!r})"
+
+    def _open_workbook(self) -> bool:
+        """Открывает книгу площадки, создает новую при отсутствии. Возвращает True, если книга создана"""
+        log.info("Opening workbook of site '%s'", self.name)
+        if self._open_snapshot() or self._open_parsed():
+            return False
+        is_first_creation = False
+        try:
+            # Пытаемся загрузить существующую книгу
+            try:
+                self.workbook = load_workbook(self.file_path)
+            except (FileNotFoundError, KeyError, zipfile.BadZipFile):
+                # Если файл не существует или поврежден, создаем новую книгу
+                self.workbook = Workbook()
+                # Удаляем лист по умолчанию
+                for sheet in self.workbook.sheetnames:
+                    self.workbook.remove(self.workbook[sheet])
+                # Создаем необходимые листы
+                self.workbook.create_sheet(self.config["keys_accounting_wks"])
+                self.workbook.create_sheet(self.config["keys_wks"])
+                self.workbook.create_sheet(self.config["employees_wks"])
+                self.workbook.create_sheet(self.config.get("bookings_wks", "Брони"))
+
+                is_first_creation = True
+
+                self.workbook.save(self.file_path)
+                log.info("Created new workbook at %s", self.file_path)
+
+        except Exception as e:
+            log.error("Error while opening/creating workbook: %s", e)
+            raise
+
+        self.last_reload_time = time.time()
+        self.file_signature = self._signature()
+        self.version += 1
+        if not is_first_creation:
+            self._write_snapshot(self.workbook, self.file_signature)
+        log.info("Workbook of site '%s' opened", self.name)
+        return is_first_creation
+
+    def _open_snapshot(self) -> bool:
+        """Теплый старт: если снимок соответствует файлу, данные листов берутся из него без разбора xlsx"""
+        if not self.snapshot_path or not os.path.exists(self.file_path):
+            return False
+        signature = self._signature()
+        snap = snapshot.Snapshot.open(self.snapshot_path, signature, self.file_path)
+        if snap is None:
+            return False
+        self._snapshot_signature = signature
+        self._open_rows(snap, signature)
+        log.info("Workbook of site '%s' opened from snapshot", self.name)
+        return True
+
+    def _open_parsed(self) -> bool:
+        """
+        Холодный старт при parse_workers > 0: значения листов читает xlsxparse (параллельно при нескольких
+        процессах), workbook для записи загружается в фоне, как и после старта из снимка
+        """
+        if self.parse_workers < 1 or not os.path.exists(self.file_path):
+            return False
+        signature = self._signature()
+        started = time.perf_counter()
+        try:
+            sheets = xlsxparse.read_values(self.file_path, self.parse_workers)
+        except Exception as e:
+            log.warning("Fast parsing of %s failed, loading it with openpyxl: %s", self.file_path, e)
+            return False
+        if self._signature() != signature:
+            return False  # файл поменялся во время разбора
+        self._open_rows(snapshot.MemorySnapshot(sheets), signature)
+        log.info("Workbook of site '%s' parsed with %s workers in %.2fs",
+                 self.name, self.parse_workers, time.perf_counter() - started)
+        return True
+
+    def _open_rows(self, rows: "snapshot.Snapshot | snapshot.MemorySnapshot", signature: tuple[int, int]):
+        self.snapshot = rows
+        self.last_reload_time = time.time()
+        self.file_signature = signature
+        self.version += 1
+
+    def _write_snapshot(self, workbook: Workbook, signature: tuple[int, int]):
+        """
+        Записывает снимок листов workbook, прочитанного из файла с сигнатурой signature.
+        workbook не должен меняться во время записи: свежезагруженный или под self.lock
+        """
+        if not self.snapshot_path or signature == self._snapshot_signature:
+            return
+        try:
+            digest = snapshot.file_digest(self.file_path)
+            if self._signature() != signature:
+                return  # файл уже изменился, снимок по нему был бы неверным
+            sheets = {ws.title: list(ws.iter_rows(values_only=True)) for ws in workbook.worksheets}
+            snapshot.write(self.snapshot_path, sheets, signature, digest)
+            self._snapshot_signature = signature
+        except snapshot.UnsupportedValue as e:
+            log.info("Workbook of site '%s' can not be snapshotted: %s", self.name, e)
+        except OSError as e:
+            log.warning("Failed to write snapshot of site '%s': %s", self.name, e)
+
+    def _write_summary(self):
+        """Сводка для фоновых задач по выгружаемому реестру; вызывать под self.lock, пока workbook не сброшен"""
+        try:
+            if self._signature() != self.file_signature:
+                return  # файл изменился после загрузки: сводка была бы неверной, без нее площадку загрузят
+            entries = self.keys_accounting.get_all_entries()
+            SiteSummary(
+                self.file_signature,
+                self.bookings.next_start(),
+                min((entry.time_received for entry in entries if entry.time_returned is None), default=None),
+                min((entry.time_returned for entry in entries if entry.time_returned is not None), default=None),
+            ).write(SiteSummary.path(self.config))
+        except Exception as e:
+            log.warning("Failed to write summary of site '%s': %s", self.name, e)
+
+    def worksheet(self, sheet_name: str):
+        """Лист workbook для записи; если пока работаем по снимку, workbook читается сразу"""
+        with self.lock:
+            if self.workbook is None:
+                self.check_reload(verify=True)
+            if sheet_name not in self.workbook.sheetnames:
+                self.workbook.create_sheet(sheet_name)
+            return self.workbook[sheet_name]
+
+    def rows(self, sheet_name: str, max_row: int = None) -> Iterator[tuple]:
+        """Значения строк листа (с заголовком): из снимка, пока workbook не загружен, иначе из workbook"""
+        with self.lock:
+            if self.workbook is None and self.snapshot is not None:
+                if sheet_name not in self.snapshot.sheetnames:
+                    return iter(())
+                return self.snapshot.rows(sheet_name, max_row)
+            return self.worksheet(sheet_name).iter_rows(max_row=max_row, values_only=True)
+
+    def _signature(self) -> tuple[int, int]:
+        stat = os.stat(self.file_path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def _on_file_changed(self):
+        """Поток наблюдателя: файл изменился. Собственные сохранения узнаются по сигнатуре и пропускаются"""
+        with self.lock:
+            if self.workbook is None and self.snapshot is None:  # реестр уже выгружен
+                return
+            try:
+                if self._signature() == self.file_signature:
+                    return
+            except FileNotFoundError:
+                return
+            log.debug("Workbook of site '%s' changed on disk", self.name)
+            self._mark_stale()
+
+    def _on_watch_tick(self):
+        if self.loaded and time.time() - self.last_reload_time > self.reload_interval:
+            with self.lock:
+                self._mark_stale()
+
+    def _mark_stale(self):
+        """Отмечает workbook устаревшим и запускает фоновое перечитывание, если оно еще не идет"""
+        self.disk_generation += 1
+        if self._stale_since is None:
+            self._stale_since = time.monotonic()
+        self._start_refresh()
+
+    def _start_refresh(self):
+        if not self._refreshing:
+            self._refreshing = True
+            threading.Thread(target=self.refresh, name=f"refresh:{self.name}", daemon=True).start()
+
+    @property
+    def loaded(self) -> bool:
+        """Данные площадки в памяти: workbook или, при теплом старте, снимок"""
+        return self.workbook is not None or self.snapshot is not None
+
+    @property
+    def fresh(self) -> bool:
+        """
+        Проверка без блокировки: текущие данные можно отдавать без перечитывания. За файлом следит
+        наблюдатель, а устаревший workbook еще в пределах max_staleness
+        """
+        stale_since = self._stale_since
+        return self.loaded and self.watcher is not None and (
+            stale_since is None or time.monotonic() - stale_since <= self.max_staleness)
+
+    def refresh(self):
+        """
+        Фоновое перечитывание (stale-while-revalidate): новый workbook читается и сверяется с кэшами таблиц
+        без блокировки, пока запросы обслуживает текущий, и подменяется вместе с ними под блокировкой.
+        Если за время чтения файл поменялся или этот процесс сам сохранил workbook, результат отбрасывается
+        """
+        try:
+            while True:
+                with self.lock:
+                    if not self.loaded or (self._stale_since is None and self.workbook is not None):
+                        self._refreshing = False
+                        self._refresh_done.notify_all()
+                        return
+                    base, generation, started = self.file_signature, self.disk_generation, time.time()
+                    from_rows = self.workbook is None
+                    signature = self._signature()
+                    if (
+                            signature == base and self.workbook is not None and
+                            started - self.last_reload_time <= self.reload_interval
+                    ):
+                        self._stale_since = None  # изменение уже подхвачено (например, записью)
+                        self._refreshing = False
+                        self._refresh_done.notify_all()
+                        return
+                workbook = load_workbook(self.file_path)
+                self._write_snapshot(workbook, signature)
+                with self.write_lock:  # пока идет запись, кэши таблиц меняются; подменяем после нее
+                    with self.lock:
+                        if not self.loaded or self.file_signature != base or (from_rows and self.workbook is not None):
+                            continue  # workbook уже перечитан или сохранен нами
+                    # После старта из снимка файл тот же, поэтому расхождения - не внешние правки и о них не сообщаем
+                    if not self._install(workbook, signature, started, notify=not from_rows):
+                        continue
+                with self.lock:
+                    if self.disk_generation != generation:
+                        self._stale_since = time.monotonic()  # пока читали, пришло новое изменение
+                        continue
+                    self._refreshing = False
+                    self._refresh_done.notify_all()
+                log.debug("Refreshed workbook of site '%s' in background", self.name)
+                return
+        except Exception as e:
+            with self.lock:
+                self._refreshing = False
+                self._refresh_done.notify_all()
+            log.error("Background refresh of site '%s' failed", self.name, exc_info=e)
+
+    def _tables(self) -> list[BaseTable]:
+        tables = (getattr(self, name, None) for name in ("keys_accounting", "keys", "employees", "bookings"))
+        return [table for table in tables if table is not None]  # None, если вызвано еще из __init__
+
+    def _sync_tables(self, notify: bool = True):
+        for table in self._tables():
+            table._sync(notify)
+
+    def _install(self, workbook: Workbook, signature: tuple[int, int], loaded_at: float, notify: bool = True) -> bool:
+        """
+        Подменяет workbook перечитанным с диска, не останавливая чтение. Листы сверяются с кэшами таблиц,
+        а сводки и индексы обновляются по разнице без блокировки; под self.lock только ставятся готовые.
+        Вызывать под self.write_lock: запись в это время поменяла бы кэши. False - файл уже другой
+        """
+        with self.lock:
+            version = self.version
+        diffs = []
+        for table in self._tables():
+            sheet_rows = iter(()) if table.sheet_name not in workbook.sheetnames \
+                else workbook[table.sheet_name].iter_rows(values_only=True)
+            diff = table._diff_rows(sheet_rows)
+            if diff.changed and not diff.reset:
+                diff.prepared = table._prepare_rows(diff)
+            diffs.append((table, diff))
+        with self.lock:
+            if self._signature() != signature:
+                return False
+            self._loaded(workbook, signature, loaded_at)
+            self._refresh_done.notify_all()
+            if self.version != version + 1:
+                return True  # workbook успели перечитать в обход (check_reload): таблицы сверятся при чтении
+            for table, diff in diffs:
+                if table._row_hashes is diff.base:
+                    table._apply_rows(diff, self.version, notify)
+        return True
+
+    def _loaded(self, workbook: Workbook, signature: tuple[int, int], loaded_at: float):
+        self.workbook = workbook
+        if self.snapshot is not None:
+            self.snapshot.close()
+            self.snapshot = None
+        self.last_reload_time = loaded_at
+        self.file_signature = signature
+        self.version += 1
+        self._stale_since = None
+
+    def check_reload(self, force=False, verify=False) -> Workbook | None:
+        """
+        Возвращает workbook, перечитывая его при необходимости.
+        Устаревший workbook продолжает обслуживать чтение, пока фоновый refresh готовит новый,
+        но не дольше max_staleness секунд. force и verify (перед записью) сверяют файл на диске сразу.
+        None, пока после теплого старта данные отдаются из снимка и workbook еще не загружен
+        """
+        with self.lock:
+            if self.loaded and not (force or verify):
+                if self.watcher is None and (
+                        time.time() - self.last_reload_time > self.reload_interval or
+                        self._signature() != self.file_signature
+                ):
+                    self._mark_stale()
+                if self._stale_since is None or time.monotonic() - self._stale_since <= self.max_staleness:
+                    return self.workbook
+                log.warning("Workbook of site '%s' is stale for over %ss, reloading inline", self.name, self.max_staleness)
+
+            while (
+                    self.workbook is None and self.snapshot is not None and self._refreshing and
+                    self._write_thread != threading.get_ident()  # фоновое чтение само ждет окончания записи
+            ):
+                self._refresh_done.wait()  # workbook после теплого старта уже читается в фоне, не читаем второй раз
+            now = time.time()
+            signature = self._signature()
+            if (
+                force or
+                self.workbook is None or
+                self._stale_since is not None or
+                now - self.last_reload_time > self.reload_interval or
+                signature != self.file_signature
+            ):
+                self._loaded(load_workbook(self.file_path), signature, now)
+                log.debug("Reloaded workbook of site '%s' from file", self.name)
+            return self.workbook
+
+    def save(self, workbook: Workbook = None):
+        """
+        Атомарно сохраняет workbook: пишет временный файл рядом и подменяет им основной.
+        Временный файл пишется без self.lock (чтение в это время не ждет), поэтому workbook
+        во время сохранения никто не должен менять: вызывать под self.write_lock
+        """
+        workbook = workbook or self.workbook
+        directory, name = os.path.split(os.path.abspath(self.file_path))
+        temp_path = os.path.join(directory, f".{name}.{os.getpid()}.tmp")
+        try:
+            workbook.save(temp_path)
+            with self.lock:  # наблюдатель сверяет сигнатуру под той же блокировкой и не примет файл за чужой
+                os.replace(temp_path, self.file_path)
+                self.last_reload_time = time.time()
+                self.file_signature = self._signature()
+                if self.workbook is not workbook:
+                    self._mark_stale()  # пока сохраняли, в памяти оказалась другая книга: перечитать записанную
+            log.debug("Saved workbook of site '%s' to file", self.name)
+        except Exception as err:
+            log.error("Error saving workbook: %s", err)
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def write(self, operation: Callable[[], T], attempts: int = 3) -> T:
+        """
+        Применяет operation к workbook и сохраняет его под межпроцессной блокировкой файла.
+        operation должна быть логической операцией (искать строки заново, а не по старым номерам):
+        если файл поменяли в обход блокировки, workbook перечитывается и operation применяется повторно.
+        operation выполняется под self.lock, сохранение - только под self.write_lock.
+        Если сохранить не удалось, изменения operation в памяти отбрасываются
+        """
+        if self._batch_thread == threading.get_ident():
+            return operation()  # внутри пакета: сохранит и разрешит конфликты внешний write
+        with self.write_lock, file_lock(self.lock_path):
+            outer, self._write_thread = self._write_thread, threading.get_ident()
+            try:
+                return self._write(operation, attempts)
+            finally:
+                self._write_thread = outer
+
+    def _write(self, operation: Callable[[], T], attempts: int) -> T:
+        for attempt in range(attempts):
+            self._catch_up()
+            with self.lock:
+                version = self.version
+                self.check_reload(verify=True)
+                if self.version != version:
+                    # Чужие изменения попадают в кэши строк до операции, иначе ее собственные строки
+                    # при следующем чтении выглядели бы как внешние правки
+                    self._sync_tables()
+                result = operation()
+                workbook = self.workbook
+                conflict = self._signature() != self.file_signature
+            if not conflict:
+                try:
+                    self.save(workbook)
+                except Exception:
+                    self._rollback()
+                    raise
+                return result
+            log.warning("Workbook of site '%s' changed on disk during write, reapplying (%s)", self.name, attempt + 1)
+        raise WriteConflictError(f"Workbook of site '{self.name}' keeps changing, write abandoned")
+
+    def _catch_up(self):
+        """
+        Перед записью: если workbook не загружен или файл изменился, книга перечитывается через _install,
+        не останавливая чтение. Если файл меняется слишком часто, остается перечитывание в check_reload
+        """
+        for _ in range(3):
+            with self.lock:
+                if self.workbook is not None and self._stale_since is None:
+                    if self._signature() == self.file_signature:
+                        return
+                signature, started = self._signature(), time.time()
+            if self._install(load_workbook(self.file_path), signature, started):
+                return
+
+    def _rollback(self):
+        """
+        Сохранение не удалось: workbook с несохраненными изменениями отбрасывается, книга перечитывается
+        с диска, а кэши строк, сводки и индексы таблиц сверяются с ней (о расхождениях не сообщаем -
+        это наши же несостоявшиеся изменения)
+        """
+        try:
+            signature, started = self._signature(), time.time()
+            if self._install(load_workbook(self.file_path), signature, started, notify=False):
+                log.warning("Unsaved changes of site '%s' discarded, workbook reloaded from file", self.name)
+                return
+        except Exception as e:
+            log.error("Failed to reload workbook of site '%s' after a failed save", self.name, exc_info=e)
+        with self.lock:
+            self._mark_stale()  # изменения отбросит фоновое перечитывание или следующая запись
+
+    def emit(self, event_type: str, **data):
+        """Пишет событие в журнал событий; внутри пакета - только после сохранения пакета"""
+        if self._batch_thread == threading.get_ident():
+            self._batch_events.append((event_type, data))
+        else:
+            self.events.append(event_type, **data)
+
+    def _run_batch(self, batch: list[tuple[Callable, tuple, dict]]) -> list[tuple[bool, object]]:
+        """Применяет пакет изменений одним write (одно сохранение). Возвращает (успех, результат) на каждое"""
+        def apply_all():
+            self._batch_thread = threading.get_ident()
+            self._batch_events = []
+            try:
+                outcomes = []
+                for func, args, kwargs in batch:
+                    try:
+                        outcomes.append((True, func(*args, **kwargs)))
+                    except Exception as e:
+                        outcomes.append((False, e))
+                return outcomes
+            finally:
+                self._batch_thread = None
+
+        with self.write_lock:
+            try:
+                outcomes = self.write(apply_all)
+            finally:
+                batch_events, self._batch_events = self._batch_events, []
+        self.events.append_many(batch_events)  # события пакета - одной записью и одним fsync, как и сам пакет
+        return outcomes
+
+    @property
+    def is_writer(self) -> bool:
+        """Этот процесс сам пишет в книгу площадки (без кластера - всегда)"""
+        return self.write_router is None or self.write_router.is_leader
+
+    async def submit(self, func: Callable[..., T], *args, **kwargs) -> T:
+        """
+        Выполняет изменяющий метод таблицы через очередь единственного писателя площадки.
+        Изменения, пришедшие в течение commit_window, применяются пакетом и сохраняются одной записью
+        файла (group commit); ожидание завершается, когда пакет уже сохранен на диск.
+        В кластере изменение пересылается процессу-писателю
+        """
+        if not self.is_writer:
+            return await self.write_router.forward(self, func, args, kwargs)
+        if self._write_queue is None:
+            self._write_queue = asyncio.Queue()
+        future = asyncio.get_running_loop().create_future()
+        self._write_queue.put_nowait((func, args, kwargs, future))
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.create_task(self._write_loop())
+        return await future
+
+    @property
+    def writing(self) -> bool:
+        """Есть изменения в очереди писателя"""
+        return self._writer is not None and not self._writer.done()
+
+    async def _write_loop(self):
+        while not self._write_queue.empty():
+            if self.commit_window:
+                await asyncio.sleep(self.commit_window)
+            batch = []
+            while not self._write_queue.empty() and len(batch) < self.commit_max_ops:
+                batch.append(self._write_queue.get_nowait())
+            try:
+                outcomes = await asyncio.to_thread(self._run_batch, [(f, args, kwargs) for f, args, kwargs, _ in batch])
+            except Exception as e:
+                log.error("Failed to save %s changes of site '%s'", len(batch), self.name, exc_info=e)
+                outcomes = [(False, e)] * len(batch)
+            for (*_, future), (ok, value) in zip(batch, outcomes):
+                if future.done():
+                    continue
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(value)
+
+    def close(self):
+        """Освобождает кэш workbook"""
+        if self.watcher is not None:
+            self.watcher.stop()  # вне self.lock: поток наблюдателя может ждать ее в обработчике
+        with self.write_lock, self.lock:
+            if self.workbook is not None:
+                self._write_snapshot(self.workbook, self.file_signature)  # следующий старт будет теплым
+                self._write_summary()
+            self.workbook = None
+            if self.snapshot is not None:
+                self.snapshot.close()
+                self.snapshot = None
+            self.events.close()
+        log.info("Site '%s' unloaded", self.name)
+
+
+class UserSites:
+    """
+    Закрепление пользователей за площадками в JSON-файле процесса. Интерфейс асинхронный, как у
+    cluster.RedisHash, через который закрепление делят процессы кластера
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._sites: dict[str, str] = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self._sites = json.load(f)
+
+    def items(self) -> list[tuple[str, str]]:
+        return list(self._sites.items())
+
+    async def get(self, field: str, default: str = None) -> str | None:
+        return self._sites.get(field, default)
+
+    async def set(self, field: str, value: str):
+        self._sites[field] = value
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump(self._sites, f, ensure_ascii=False, indent=2)
+
+    async def setdefault(self, field: str, default: str) -> str:
+        if field not in self._sites:
+            await self.set(field, default)
+        return self._sites[field]
+
+
+class RegistryPool:
+    """
+    Набор реестров площадок одного процесса.
+    Реестры открываются при первом обращении и выгружаются по LRU или после простоя.
+    Из бота реестры открываются через open: загрузка книги и выгрузка со снимком идут в потоке
+    """
+
+    def __init__(
+            self,
+            sites: dict[str, dict],
+            default_site: str = None,
+            max_loaded: int = 8,
+            idle_timeout: float = 30 * 60,
+            user_sites_path: str = None
+    ):
+        if not sites:
+            raise ValueError("No sites configured")
+        self.sites = sites
+        self.default_site = default_site or next(iter(sites))
+        if self.default_site not in sites:
+            raise ValueError(f"Default site '{self.default_site}' is not configured")
+        self.max_loaded = max(1, max_loaded)
+        self.idle_timeout = idle_timeout
+        self.user_sites_path = user_sites_path or os.path.join(
+            os.path.dirname(os.path.abspath(sites[self.default_site]["excel_file_path"])), "user_sites.json")
+        self._loaded: OrderedDict[str, Registry] = OrderedDict()
+        self._loading: dict[str, Future] = {}  # площадка -> загрузка, которую ждут все ее первые запросы
+        self._closing: dict[str, Future] = {}  # площадка -> выгрузка; новая загрузка дожидается ее конца
+        self._lock = threading.RLock()
+        self.write_router = None  # см. Registry.write_router
+        self._user_sites = UserSites(self.user_sites_path)
+
+    @classmethod
+    def from_config(cls, path=tables_path) -> "RegistryPool":
+        """
+        Читает excel_tables.json. Поддерживаются старый формат (одна площадка)
+        и формат с ключом "sites": {"имя": {...}}, где общие параметры задаются на верхнем уровне
+        """
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        common = {k: v for k, v in data.items() if k != "sites"}
+        sites = {name: {**common, **site} for name, site in data.get("sites", {}).items()}
+        if not sites:
+            sites = {default_site_name: common}
+        return cls(
+            sites,
+            default_site=data.get("default_site"),
+            max_loaded=data.get("max_loaded_sites", 8),
+            idle_timeout=data.get("site_idle_timeout", 30 * 60),
+            user_sites_path=data.get("user_sites_path"),
+        )
+
+    def get(self, site: str = None) -> Registry:
+        """Возвращает реестр площадки, открывая его при необходимости. Блокирующий: для CLI и потоков"""
+        site, registry, future = self._acquire(site)
+        if registry is not None:
+            self._close(self._take_evicted())
+            return registry
+        if future is None:
+            future = self._loading[site]  # загружаем сами: в _acquire загрузка заведена на нас
+            self._close(self._load(site, future))
+        return future.result()
+
+    async def open(self, site: str = None) -> Registry:
+        """
+        Как get, но не останавливает цикл событий: книга загружается, а вытесненные реестры
+        выгружаются в потоке. Одновременные первые запросы к площадке ждут одну и ту же загрузку
+        """
+        site, registry, future = self._acquire(site)
+        if registry is not None:
+            evicted = self._take_evicted()
+            if evicted:
+                await asyncio.to_thread(self._close, evicted)
+            return registry
+        if future is None:
+            future = self._loading[site]
+            await asyncio.to_thread(lambda: self._close(self._load(site, future)))
+        return await asyncio.wrap_future(future)
+
+    def _acquire(self, site: str | None) -> tuple[str, Registry | None, Future | None]:
+        """
+        (площадка, открытый реестр, None), (площадка, None, загрузка другого запроса) или
+        (площадка, None, None) - загрузка заведена в self._loading, загружать вызывающему
+        """
+        site = site or self.default_site
+        if site not in self.sites:
+            raise KeyError(f"Unknown site '{site}'")
+        with self._lock:
+            registry = self._loaded.get(site)
+            if registry is not None:
+                self._loaded.move_to_end(site)
+                registry.last_used = time.monotonic()
+                return site, registry, None
+            future = self._loading.get(site)
+            if future is None:
+                self._loading[site] = Future()
+            return site, None, future
+
+    def _load(self, site: str, future: Future) -> list[tuple[str, Registry, Future]]:
+        """Открывает реестр площадки и завершает future. Возвращает вытесненные им реестры - их нужно выгрузить"""
+        try:
+            with self._lock:
+                closing = self._closing.get(site)
+            if closing is not None:
+                closing.result()  # снимок прежнего экземпляра должен быть записан до чтения книги
+            registry = Registry(site, self.sites[site])
+        except BaseException as e:
+            with self._lock:
+                del self._loading[site]
+            future.set_exception(e)
+            return []
+        with self._lock:
+            del self._loading[site]
+            registry.write_router = self.write_router
+            registry.last_used = time.monotonic()
+            self._loaded[site] = registry
+            evicted = self._take_evicted()
+        future.set_result(registry)
+        return evicted
+
+    def _take_evicted(self) -> list[tuple[str, Registry, Future]]:
+        """Убирает из пула реестры сверх max_loaded и простаивающие; выгружать их - вызывающему, вне блокировки"""
+        now = time.monotonic()
+        evicted = []
+        with self._lock:
+            for name, registry in list(self._loaded.items())[:-1]:  # самый свежий реестр не выгружаем
+                if registry.writing:
+                    continue
+                if len(self._loaded) > self.max_loaded or now - registry.last_used > self.idle_timeout:
+                    del self._loaded[name]
+                    closing = self._closing[name] = Future()
+                    evicted.append((name, registry, closing))
+        return evicted
+
+    def _close(self, evicted: list[tuple[str, Registry, Future]]):
+        for name, registry, closing in evicted:
+            try:
+                registry.close()
+            except Exception as e:
+                log.error("Failed to unload site '%s'", name, exc_info=e)
+            finally:
+                with self._lock:
+                    if self._closing.get(name) is closing:
+                        del self._closing[name]
+                closing.set_result(None)
+
+    def evict_idle(self):
+        """Выгружает простаивающие реестры. Блокирующий: из бота - через to_thread"""
+        self._close(self._take_evicted())
+
+    def peek(self, site: str) -> Registry | None:
+        """Открытый реестр площадки или None; в отличие от get не открывает его и не продлевает ему жизнь"""
+        with self._lock:
+            return self._loaded.get(site)
+
+    def close(self):
+        """Выгружает все реестры (перед выходом или перезапуском процесса)"""
+        with self._lock:
+            while self._loaded:
+                _, registry = self._loaded.popitem()
+                registry.close()
+
+    def summary(self, site: str) -> SiteSummary | None:
+        """Сводка выгруженной площадки (см. SiteSummary) или None - тогда площадку нужно открыть"""
+        return SiteSummary.read(self.sites[site])
+
+    def loaded(self) -> list[str]:
+        with self._lock:
+            return list(self._loaded)
+
+    def route_writes(self, router):
+        """Изменения всех площадок идут через router (cluster.Cluster) к единственному писателю"""
+        with self._lock:
+            self.write_router = router
+            for registry in self._loaded.values():
+                registry.write_router = router
+
+    async def share_user_sites(self, store):
+        """
+        Хранит закрепление пользователей за площадками в store (cluster.RedisHash), общем для процессов кластера.
+        Закрепления из файла процесса переносятся туда, если кластер о пользователе еще не знает
+        """
+        for user_id, site in self._user_sites.items():
+            await store.setdefault(user_id, site)
+        self._user_sites = store
+
+    async def site_of(self, user_id) -> str:
+        return await self._user_sites.get(str(user_id), self.default_site)
+
+    async def for_user(self, user_id) -> Registry:
+        return await self.open(await self.site_of(user_id))
+
+    async def assign(self, user_id, site: str):
+        """Закрепляет пользователя за площадкой"""
+        if site not in self.sites:
+            raise KeyError(f"Unknown site '{site}'")
+        await self._user_sites.set(str(user_id), site)
+
+
 # region Tests
 
 
 '''def main():
     """Test code"""
     # Инициализация таблиц
-    kat = KeysAccountingTable()
-    keys = KeysTable()
-    emps = EmployeesTable()
+    registry = RegistryPool.from_config().get()
+    kat = registry.keys_accounting
+    keys = registry.keys
+    emps = registry.employees
 
     kat.setup_table()
     keys.setup_table()
@@ -623,8 +2320,8 @@ if isFirstCreation:
         # print(f"\nОшибка при тестировании: {e}")
     finally:
         # Сохраняем изменения
-        workbook.save(tables_data["excel_file_path"])
-        print(f"\nДанные сохранены в файл: {tables_data['excel_file_path']}")
+        registry.save()
+        print(f"\nДанные сохранены в файл: {registry.file_path}")
 
 
 if __name__ == "__main__":
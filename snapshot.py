@@ -0,0 +1,207 @@
+from datetime import datetime, timedelta
+from typing import Iterator
+import numpy as np
+import hashlib
+import logging
+import struct
+import json
+import mmap
+import os
+
+log = logging.getLogger(__name__)
+
+# Снимок значений листов книги в бинарном столбцовом виде: быстрый теплый старт без разбора xlsx.
+# Формат: MAGIC, длина заголовка (uint32), JSON-заголовок, затем блоки с выравниванием по 8 байт:
+# строки (UTF-8, разделитель \0) и для каждого листа kinds uint8[столбцы, строки] и values int64[столбцы, строки]
+
+MAGIC = b"KSNAP001"
+_length = struct.Struct("<I")
+
+NONE, STR, INT, FLOAT, BOOL, DATETIME = range(6)
+_epoch = datetime(1970, 1, 1)
+_microsecond = timedelta(microseconds=1)
+_int64 = np.iinfo(np.int64)
+
+
+class UnsupportedValue(TypeError):
+    """Значение ячейки, которое снимок не умеет хранить без потерь"""
+
+
+def file_digest(path: str) -> str:
+    with open(path, "rb") as f:
+        return hashlib.file_digest(f, "blake2b").hexdigest()
+
+
+def _align(offset: int) -> int:
+    return (offset + 7) & ~7
+
+
+def _encode(value, strings: dict[str, int]) -> tuple[int, int]:
+    if value is None:
+        return NONE, 0
+    kind = type(value)
+    if kind is str:
+        return STR, strings.setdefault(value, len(strings))
+    if kind is bool:
+        return BOOL, int(value)
+    if kind is int and _int64.min <= value <= _int64.max:
+        return INT, value
+    if kind is float:
+        return FLOAT, struct.unpack("<q", struct.pack("<d", value))[0]
+    if kind is datetime and value.tzinfo is None:
+        return DATETIME, (value - _epoch) // _microsecond
+    raise UnsupportedValue(f"{kind.__name__} {value!r}")
+
+
+def write(path: str, sheets: dict[str, list[tuple]], signature: tuple[int, int], digest: str):
+    """
+    Записывает снимок листов. sheets: имя листа -> строки как из iter_rows(values_only=True), с заголовком.
+    Файл подменяется атомарно; UnsupportedValue, если в листах есть значения, которые нельзя сохранить без потерь
+    """
+    strings: dict[str, int] = {}
+    blocks = []
+    meta = []
+    for name, rows in sheets.items():
+        width = max(map(len, rows), default=0)
+        if any(len(row) != width for row in rows):
+            raise UnsupportedValue(f"rows of different width in sheet '{name}'")
+        kinds = np.zeros((width, len(rows)), dtype=np.uint8)
+        values = np.zeros((width, len(rows)), dtype=np.int64)
+        for j in range(width):
+            if rows:
+                kinds[j], values[j] = zip(*(_encode(row[j], strings) for row in rows))
+        meta.append({"name": name, "rows": len(rows), "cols": width})
+        blocks += [kinds, values]
+    blob = "\0".join(strings).encode("utf-8")
+
+    header = {"signature": list(signature), "digest": digest, "strings": [len(strings), len(blob)], "sheets": meta}
+    header_bytes = json.dumps(header, ensure_ascii=False).encode("utf-8")
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, "wb") as f:
+            f.write(MAGIC + _length.pack(len(header_bytes)) + header_bytes)
+            for block in [np.frombuffer(blob, dtype=np.uint8)] + blocks:
+                f.write(b"\0" * (_align(f.tell()) - f.tell()))
+                f.write(block.tobytes())
+        os.replace(temp_path, path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    log.debug("Snapshot written to %s: %s strings, %s bytes", path, len(strings), os.path.getsize(path))
+
+
+class Snapshot:
+    """Снимок, отображенный в память через mmap; строки листов восстанавливаются по столбцам"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if self._map[:len(MAGIC)] != MAGIC:
+                raise ValueError("not a snapshot file")
+            offset = len(MAGIC)
+            (length,) = _length.unpack_from(self._map, offset)
+            offset += _length.size
+            header = json.loads(self._map[offset:offset + length])
+            offset += length
+            self.signature = tuple(header["signature"])
+            self.digest = header["digest"]
+
+            self._string_count, size = header["strings"]
+            offset = _align(offset)
+            self._strings_at = (offset, size)
+            offset += size
+            self._sheets: dict[str, tuple[np.ndarray, np.ndarray]] = {}
+            for sheet in header["sheets"]:
+                shape = (sheet["cols"], sheet["rows"])
+                offset = _align(offset)
+                kinds = np.frombuffer(self._map, np.uint8, shape[0] * shape[1], offset).reshape(shape)
+                offset = _align(offset + kinds.nbytes)
+                values = np.frombuffer(self._map, np.int64, shape[0] * shape[1], offset).reshape(shape)
+                offset += values.nbytes
+                self._sheets[sheet["name"]] = (kinds, values)
+        except Exception:
+            self.close()
+            raise
+        self._strings: list[str] | None = None
+
+    @classmethod
+    def open(cls, path: str, signature: tuple[int, int], source_path: str) -> "Snapshot | None":
+        """Снимок для файла source_path с сигнатурой signature или None, если его нет или он устарел"""
+        if not os.path.exists(path):
+            return None
+        try:
+            snapshot = cls(path)
+        except (OSError, ValueError, KeyError) as e:
+            log.warning("Snapshot %s is unreadable, ignoring it: %s", path, e)
+            return None
+        if snapshot.signature != tuple(signature) or snapshot.digest != file_digest(source_path):
+            snapshot.close()
+            return None
+        return snapshot
+
+    @property
+    def sheetnames(self) -> list[str]:
+        return list(self._sheets)
+
+    def _string_table(self) -> list[str]:
+        if self._strings is None:
+            offset, size = self._strings_at
+            self._strings = bytes(self._map[offset:offset + size]).decode("utf-8").split("\0") \
+                if self._string_count else []
+        return self._strings
+
+    def _column(self, kinds: np.ndarray, values: np.ndarray) -> list:
+        column = [None] * len(kinds)
+        for kind in np.unique(kinds).tolist():
+            if kind == NONE:
+                continue
+            positions = np.flatnonzero(kinds == kind)
+            selected = values[positions]
+            if kind == STR:
+                table = self._string_table()
+                decoded = [table[i] for i in selected.tolist()]
+            elif kind == INT:
+                decoded = selected.tolist()
+            elif kind == FLOAT:
+                decoded = selected.view(np.float64).tolist()
+            elif kind == BOOL:
+                decoded = selected.astype(bool).tolist()
+            else:
+                decoded = [_epoch + timedelta(microseconds=v) for v in selected.tolist()]
+            for position, value in zip(positions.tolist(), decoded):
+                column[position] = value
+        return column
+
+    def rows(self, sheet_name: str, max_row: int = None) -> Iterator[tuple]:
+        """Строки листа (с заголовком) в том же виде, что iter_rows(values_only=True)"""
+        kinds, values = self._sheets[sheet_name]
+        kinds, values = kinds[:, :max_row], values[:, :max_row]
+        columns = [self._column(kinds[j], values[j]) for j in range(kinds.shape[0])]
+        return zip(*columns) if columns else iter(())
+
+    def close(self):
+        self._sheets = {}
+        try:
+            self._map.close()
+        except BufferError:
+            pass  # на отображение еще ссылаются массивы; закроется сборщиком мусора
+
+
+class MemorySnapshot:
+    """Значения листов, уже разобранные в память (xlsxparse.read_values); тот же интерфейс, что у Snapshot"""
+
+    def __init__(self, sheets: dict[str, list[tuple]]):
+        self._sheets = sheets
+
+    @property
+    def sheetnames(self) -> list[str]:
+        return list(self._sheets)
+
+    def rows(self, sheet_name: str, max_row: int = None) -> Iterator[tuple]:
+        return iter(self._sheets[sheet_name][:max_row])
+
+    def close(self):
+        self._sheets = {}
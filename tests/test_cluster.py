@@ -0,0 +1,156 @@
+from datetime import datetime, timedelta
+import tempfile
+import unittest
+import asyncio
+import json
+import os
+
+try:
+    from fakeredis import FakeAsyncRedis
+except ImportError:
+    FakeAsyncRedis = None
+
+import cluster
+import sheets
+
+
+@unittest.skipIf(FakeAsyncRedis is None, "fakeredis is not installed")
+class SharedStateTest(unittest.TestCase):
+    """Общее состояние кластера в Redis: хранилища асинхронные и не блокируют цикл событий"""
+
+    def run_async(self, coroutine):
+        async def run():
+            self.client = FakeAsyncRedis()
+            try:
+                return await coroutine()
+            finally:
+                await self.client.aclose()
+
+        return asyncio.run(run())
+
+    def test_payloads_and_pending(self):
+        async def run():
+            payloads = cluster.RedisPayloadStore(self.client, "test:callback")
+            pending = cluster.RedisPendingRequests(self.client, "test:pending")
+            token = await payloads.put({"key_name": "K1", "user_id": 1})
+            await pending.add_request("site", "K1", 1, ttl=60)
+            await pending.add_approval(token, "Запрос", [(10, 20)], ttl=60)
+            await payloads.restore(token, await payloads.pop(token))
+            return (
+                await payloads.get(token), await payloads.pop(token), await payloads.pop(token),
+                await pending.is_requested("site", "K1"), await pending.pop_request("site", "K1"),
+                await pending.is_requested("site", "K1"), await pending.pop_approval(token),
+            )
+
+        self.assertEqual(self.run_async(run), (
+            {"key_name": "K1", "user_id": 1}, {"key_name": "K1", "user_id": 1}, None,
+            True, 1, False, ("Запрос", [(10, 20)]),
+        ))
+
+    def test_idempotency(self):
+        async def run():
+            cache = cluster.RedisIdempotencyCache(self.client, "test:seen")
+            first = await cache.begin("press", ttl=60)
+            repeated = await cache.begin("press", ttl=60)
+            await cache.finish("press", "Ключ выдан", ttl=60)
+            finished = await cache.begin("press", ttl=60)
+            await cache.discard("press")
+            return first, repeated, finished, await cache.begin("press", ttl=60)
+
+        self.assertEqual(self.run_async(run), ((True, None), (False, ""), (False, "Ключ выдан"), (True, None)))
+
+    def test_user_sites_moved_to_cluster(self):
+        """Закрепления из файла процесса переносятся в общий хэш, не перезаписывая известные кластеру"""
+        with tempfile.TemporaryDirectory() as directory:
+            pool = sheets.RegistryPool({
+                name: {"excel_file_path": os.path.join(directory, f"{name}.xlsx")} for name in ("main", "north", "south")
+            })
+
+            async def run():
+                await pool.assign(1, "north")
+                await pool.assign(2, "north")
+                shared = cluster.RedisHash(self.client, "test:user_sites")
+                await shared.set("2", "south")
+                await pool.share_user_sites(shared)
+                await pool.assign(3, "south")
+                return [await pool.site_of(user_id) for user_id in (1, 2, 3, 4)], await shared.get("3")
+
+            self.assertEqual(self.run_async(run), (["north", "south", "south", "main"], "south"))
+
+
+@unittest.skipIf(FakeAsyncRedis is None, "fakeredis is not installed")
+class ForwardedWritesTest(unittest.TestCase):
+    """Изменения не-лидера выполняет лидер: запрос и ответ идут через Redis в JSON"""
+
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        config = {"main": {
+            "excel_file_path": os.path.join(self._directory.name, "keys.xlsx"),
+            "keys_accounting_wks": "Журнал", "keys_wks": "Ключи", "employees_wks": "Сотрудники",
+            "snapshot": False, "watch_file": False,
+        }}
+        self.leader_pool, self.follower_pool = sheets.RegistryPool(config), sheets.RegistryPool(config)
+
+    def tearDown(self):
+        self.follower_pool.close()
+        self.leader_pool.close()
+        self._directory.cleanup()
+
+    def run_cluster(self, scenario):
+        async def run():
+            client = FakeAsyncRedis()
+            leader, follower = cluster.Cluster("redis://unused"), cluster.Cluster("redis://unused")
+            for node, pool, is_leader in ((leader, self.leader_pool, True), (follower, self.follower_pool, False)):
+                await node.aredis.aclose()
+                node.aredis, node.is_leader = client, is_leader
+                node.attach(pool)
+            serving = asyncio.create_task(leader._serve_writes())
+            try:
+                return await scenario(client, follower, self.follower_pool.get("main"))
+            finally:
+                serving.cancel()
+                await client.aclose()
+
+        return asyncio.run(run())
+
+    def test_round_trip(self):
+        start = datetime.now().replace(microsecond=0) + timedelta(days=1)
+
+        async def scenario(client, follower, site):
+            await site.submit(site.keys.new_key, "K1", 1)
+            await site.submit(site.keys_accounting.new_entry, "K1", "Иван", "Петров", "79990000000", comment="для теста")
+            entry = self.leader_pool.get("main").keys_accounting.get_not_returned_keys()[0]
+            await site.submit(site.keys_accounting.set_return_time, entry, datetime(2030, 1, 2, 3, 4, 5))
+            booking = await site.submit(site.bookings.new_booking, "K1", "Иван", "Петров", 1, start, start + timedelta(hours=1))
+            with self.assertRaises(sheets.BookingConflictError) as conflict:
+                await site.submit(site.bookings.new_booking, "K1", "Анна", "С", 2, start, start + timedelta(hours=2))
+            cancelled = await site.submit(site.bookings.set_status, booking, sheets.BOOKING_CANCELLED)
+            with self.assertRaises(ValueError):
+                await site.submit(site.bookings.set_status, sheets.Booking("K9", "А", "Б", 1, start, start + timedelta(hours=1)),
+                                  sheets.BOOKING_CANCELLED)
+            return booking, conflict.exception.conflicts, cancelled
+
+        booking, conflicts, cancelled = self.run_cluster(scenario)
+        self.assertIsInstance(booking, sheets.Booking)
+        self.assertEqual((booking.start, booking.row), (start, 2))
+        self.assertEqual(conflicts, [booking])
+        self.assertEqual(cancelled.status, sheets.BOOKING_CANCELLED)
+        entry = self.leader_pool.get("main").keys_accounting.get_all_entries()[0]
+        self.assertEqual((entry.comment, entry.time_returned), ("для теста", datetime(2030, 1, 2, 3, 4, 5)))
+
+    def test_rejects_methods_outside_allow_list(self):
+        async def scenario(client, follower, site):
+            with self.assertRaises(TypeError):
+                await site.submit(site.keys_accounting.rebuild_aggregates)
+            # Запрос, положенный в очередь в обход forward, лидер тоже не выполнит
+            await client.lpush("keysbot:writes", json.dumps({
+                "job": "evil", "site": "main", "table": "keys_accounting", "method": "_sync_rows", "args": [], "kwargs": {}}))
+            await client.lpush("keysbot:writes", b"\x80\x04K\x01.")  # pickle
+            reply = await client.brpop(["keysbot:reply:evil"], timeout=5)
+            return json.loads(reply[1])
+
+        self.assertEqual(self.run_cluster(scenario)["error"]["type"], "TypeError")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,111 @@
+import tempfile
+import unittest
+import unittest.mock
+import asyncio
+import os
+
+import events
+from sheets import file_lock
+
+
+class SharedLogTest(unittest.TestCase):
+    """Два EventLog на одном файле - два процесса площадки, между которыми переходит лидерство"""
+
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._directory.name, "keys.events.jsonl")
+
+    def tearDown(self):
+        self._directory.cleanup()
+
+    def open_log(self) -> events.EventLog:
+        log = events.EventLog(self.path, shared_lock=lambda: file_lock(self.path + ".lock"), poll_interval=0.05)
+        self.addCleanup(log.close)
+        return log
+
+    def test_offsets_continue_after_failover(self):
+        """Новый писатель продолжает смещения из файла, а не со своего устаревшего next_offset"""
+        old_leader, new_leader = self.open_log(), self.open_log()
+        for number in range(3):
+            old_leader.append(events.KEY_ISSUED, key_name=f"K{number}")
+        new_leader.append(events.KEY_ISSUED, key_name="K3")
+        old_leader.append(events.KEY_ISSUED, key_name="K4")
+
+        offsets = [event.offset for event in self.open_log().read()]
+        self.assertEqual(offsets, list(range(5)))
+
+    def test_reader_reads_to_end_of_file(self):
+        """Процесс, который сам не пишет, видит события писателя, в том числе с середины через индекс"""
+        writer, reader = self.open_log(), self.open_log()
+        count = events.INDEX_STEP * 2 + 10
+        for number in range(count):
+            writer.append(events.KEY_ISSUED, key_name=f"K{number}")
+
+        self.assertEqual([event.data["key_name"] for event in reader.read(count - 2)], [f"K{count - 2}", f"K{count - 1}"])
+        self.assertEqual(len(list(reader.read())), count)
+        self.assertEqual(reader.next_offset, count)
+
+    def test_subscriber_sees_other_process(self):
+        """Подписчик получает события, записанные другим процессом, без локального будильника"""
+        writer, reader = self.open_log(), self.open_log()
+
+        async def run() -> list[str]:
+            received = []
+
+            async def consume():
+                async for event in reader.subscribe():
+                    received.append(event.data["key_name"])
+                    if len(received) == 2:
+                        return
+
+            task = asyncio.create_task(consume())
+            await asyncio.sleep(0.1)
+            writer.append(events.KEY_ISSUED, key_name="K1")
+            writer.append(events.KEY_ISSUED, key_name="K2")
+            await asyncio.wait_for(task, 5)
+            return received
+
+        self.assertEqual(asyncio.run(run()), ["K1", "K2"])
+
+    def test_incomplete_tail_is_truncated(self):
+        """Недописанная после сбоя строка не читается и отрезается следующей записью"""
+        log = self.open_log()
+        log.append(events.KEY_ISSUED, key_name="K1")
+        with open(self.path, "ab") as f:
+            f.write(b'{"offset": 1, "type": "key_iss')
+
+        log = self.open_log()
+        self.assertEqual([event.offset for event in log.read()], [0])
+        log.append(events.KEY_ISSUED, key_name="K2")
+        self.assertEqual([event.data["key_name"] for event in self.open_log().read()], ["K1", "K2"])
+
+    def test_append_many_syncs_once(self):
+        """События пакета пишутся одной записью с одним fsync и получают подряд идущие смещения"""
+        log = self.open_log()
+        log.append(events.KEY_ISSUED, key_name="K0")
+        count = events.INDEX_STEP + 5
+        with unittest.mock.patch.object(events.os, "fsync") as fsync:
+            written = log.append_many([(events.KEY_ISSUED, {"key_name": f"K{number}"}) for number in range(1, count)])
+        fsync.assert_called_once()
+        self.assertEqual([event.offset for event in written], list(range(1, count)))
+        self.assertEqual([event.data["key_name"] for event in self.open_log().read(count - 2)],
+                         [f"K{count - 2}", f"K{count - 1}"])
+
+    def test_subscriber_reads_in_batches(self):
+        """Подписчик с начала длинного журнала получает все события, читая файл порциями"""
+        log = self.open_log()
+        count = events.READ_BATCH * 2 + 3
+        log.append_many([(events.KEY_ISSUED, {"key_name": f"K{number}"}) for number in range(count)])
+
+        async def run() -> list[int]:
+            received = []
+            async for event in log.subscribe():
+                received.append(event.offset)
+                if len(received) == count:
+                    return received
+
+        self.assertEqual(asyncio.run(asyncio.wait_for(run(), 5)), list(range(count)))
+
+
+if __name__ == "__main__":
+    unittest.main()
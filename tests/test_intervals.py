@@ -0,0 +1,149 @@
+from datetime import datetime, timedelta
+import tempfile
+import unittest
+import asyncio
+import random
+
+from intervals import IntervalTree, max_depth
+import sheets
+
+from tests.test_writes import make_registry
+
+
+def check_max_end(node) -> int | None:
+    """Проверяет max_end во всем поддереве, возвращает его"""
+    if node is None:
+        return None
+    ends = [node.end] + [end for end in (check_max_end(node.left), check_max_end(node.right)) if end is not None]
+    assert node.max_end == max(ends), (node.start, node.end, node.max_end, ends)
+    return node.max_end
+
+
+class IntervalTreeTest(unittest.TestCase):
+    def test_remove_duplicate_bounds(self):
+        """Из одинаковых интервалов удаляется только тот, у которого совпадает значение"""
+        tree = IntervalTree([(1, 5, "a"), (1, 5, "b"), (1, 5, "c"), (0, 9, "d"), (2, 3, "e")])
+
+        self.assertTrue(tree.remove(1, 5, "b"))
+        self.assertFalse(tree.remove(1, 5, "b"))
+        self.assertFalse(tree.remove(1, 6, "a"))
+        self.assertEqual(len(tree), 4)
+        self.assertEqual(sorted(tree), [(0, 9, "d"), (1, 5, "a"), (1, 5, "c"), (2, 3, "e")])
+        check_max_end(tree.root)
+
+        self.assertTrue(tree.remove(0, 9, "d"))
+        check_max_end(tree.root)
+        self.assertEqual(tree.overlapping(6, 8), [])  # max_end пересчитан после удаления длинного интервала
+
+    def test_overlapping_half_open(self):
+        tree = IntervalTree([(1, 3, "a"), (3, 5, "b"), (0, 10, "c")])
+
+        self.assertEqual(tree.overlapping(3, 4), [(0, 10, "c"), (3, 5, "b")])
+        self.assertEqual(tree.overlapping(5, 6), [(0, 10, "c")])
+        self.assertEqual(tree.overlapping(10, 11), [])
+
+    def test_random_against_list(self):
+        """Случайные вставки и удаления, в том числе одинаковых интервалов, против простого списка"""
+        rng = random.Random(7)
+        tree, intervals = IntervalTree(), []
+        for step in range(2000):
+            if intervals and rng.random() < 0.4:
+                interval = rng.choice(intervals)
+                intervals.remove(interval)
+                self.assertTrue(tree.remove(*interval))
+            else:
+                start = rng.randrange(50)
+                interval = (start, start + rng.randrange(1, 10), rng.randrange(3))
+                intervals.append(interval)
+                tree.insert(*interval)
+            if step % 100 == 0:
+                check_max_end(tree.root)
+                low = rng.randrange(60)
+                high = low + rng.randrange(1, 10)
+                self.assertEqual(sorted(tree.overlapping(low, high)),
+                                 sorted(i for i in intervals if i[0] < high and i[1] > low))
+        self.assertEqual(len(tree), len(intervals))
+        self.assertEqual(sorted(tree), sorted(intervals))
+
+
+class MaxDepthTest(unittest.TestCase):
+    def test_touching_intervals(self):
+        """[a, b) и [b, c) не пересекаются"""
+        self.assertEqual(max_depth([(1, 2), (2, 3), (3, 4)]), 1)
+        self.assertEqual(max_depth([]), 0)
+
+    def test_duplicates_and_window(self):
+        intervals = [(1, 5, "a"), (1, 5, "b"), (4, 8, "c"), (7, 9, "d")]
+
+        self.assertEqual(max_depth(intervals), 3)
+        self.assertEqual(max_depth(intervals, 5, 10), 2)  # интервалы (1, 5) кончаются к началу окна
+        self.assertEqual(max_depth(intervals, 8, 9), 1)
+        self.assertEqual(max_depth(intervals, 9, 12), 0)
+
+
+class BookingConflictsTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self.registry = make_registry(self._directory.name)
+        self.bookings = self.registry.bookings
+        self.start = datetime.now().replace(microsecond=0) + timedelta(days=30)
+        asyncio.run(self.registry.submit(self.registry.keys.new_key, "K2", 2))
+
+    def tearDown(self):
+        self.registry.close()
+        self._directory.cleanup()
+
+    def book(self, key_name: str, hours: tuple[int, int], telegram: str = "1") -> sheets.Booking:
+        start, end = (self.start + timedelta(hours=hour) for hour in hours)
+        return asyncio.run(self.registry.submit(self.bookings.new_booking, key_name, "Иван", "Петров", telegram, start, end))
+
+    def conflicts(self, key_name: str, hours: tuple[int, int]) -> list:
+        start, end = (self.start + timedelta(hours=hour) for hour in hours)
+        return self.bookings.conflicts(key_name, start, end)
+
+    def test_capacity_one(self):
+        """Ключ без строки в "Ключи" выдается в одном экземпляре; соседние брони не конфликтуют"""
+        first = self.book("K1", (0, 2))
+        self.book("K1", (2, 3))
+
+        self.assertEqual(self.conflicts("K1", (1, 2)), [first])
+        with self.assertRaises(sheets.BookingConflictError) as raised:
+            self.book("K1", (1, 4))
+        self.assertEqual(len(raised.exception.conflicts), 2)
+
+    def test_capacity_two(self):
+        """Конфликт только там, где заняты оба экземпляра одновременно"""
+        first = self.book("K2", (0, 4))
+        second = self.book("K2", (2, 6), telegram="2")
+
+        self.assertEqual(self.bookings.capacity("K2"), 2)
+        self.assertEqual(self.conflicts("K2", (0, 2)), [])
+        self.assertEqual(self.conflicts("K2", (4, 8)), [])
+        self.assertEqual(self.conflicts("K2", (3, 5)), [first, second])
+        with self.assertRaises(sheets.BookingConflictError):
+            self.book("K2", (1, 3))
+        self.book("K2", (0, 2))  # с (0, 4) пересекается, с (2, 6) - нет
+
+    def test_cancelled_booking_frees_key(self):
+        booking = self.book("K1", (0, 2))
+        asyncio.run(self.registry.submit(self.bookings.set_status, booking, sheets.BOOKING_CANCELLED))
+
+        self.assertEqual(self.conflicts("K1", (0, 2)), [])
+        self.book("K1", (0, 2))
+
+    def test_open_entry_occupies_key(self):
+        """Невозвращенный ключ занимает экземпляр до ожидаемого возврата (по умолчанию сутки с выдачи)"""
+        asyncio.run(self.registry.submit(self.registry.keys_accounting.new_entry, "K2", "Иван", "Петров", "79990000000"))
+        soon = datetime.now().replace(microsecond=0) + timedelta(hours=1)
+        booking = asyncio.run(self.registry.submit(
+            self.bookings.new_booking, "K2", "Иван", "Петров", "1", soon, soon + timedelta(hours=1)))
+
+        conflicts = self.bookings.conflicts("K2", soon, soon + timedelta(hours=1))
+        self.assertEqual(len(conflicts), 2)
+        self.assertIn(booking, conflicts)
+        later = soon + timedelta(days=2)
+        self.assertEqual(self.bookings.occupied("K2", later, later + timedelta(hours=1)), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
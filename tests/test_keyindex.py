@@ -0,0 +1,97 @@
+import unittest
+
+from keyindex import KeyIndex, RadixTree, normalize, tokens
+
+
+def edges(node) -> dict:
+    """Дерево в виде вложенных словарей: метка ребра -> (значения, потомки)"""
+    return {child.label: (list(child.values or ()), edges(child)) for child in node.children.values()}
+
+
+class RadixTreeTest(unittest.TestCase):
+    def test_insert_splits_edge(self):
+        """Слово, расходящееся с ребром посередине, делит его; общий префикс становится отдельным узлом"""
+        tree = RadixTree()
+        tree.insert("бс-0123", "A")
+        tree.insert("бс-0456", "B")
+        tree.insert("бс", "C")
+        tree.insert("бс-0123", "D")
+
+        self.assertEqual(edges(tree.root), {
+            "бс": (["C"], {
+                "-0": ([], {
+                    "123": (["A", "D"], {}),
+                    "456": (["B"], {}),
+                }),
+            }),
+        })
+
+    def test_insert_prefix_of_edge(self):
+        """Слово короче ребра заканчивается в узле деления, а не теряется"""
+        tree = RadixTree()
+        tree.insert("ленина", "A")
+        tree.insert("лен", "B")
+
+        self.assertEqual(edges(tree.root), {"лен": (["B"], {"ина": (["A"], {})})})
+        self.assertEqual(tree.search("лени", 10), ["A"])
+        self.assertEqual(tree.search("лен", 10), ["B", "A"])
+
+    def test_search_order_limit_exclude(self):
+        """Значения идут в порядке строк, без повторов, не больше limit и без exclude"""
+        tree = RadixTree()
+        for word, value in [("b2", "X"), ("a1", "Y"), ("b1", "Z"), ("b", "X"), ("ab", "W")]:
+            tree.insert(word, value)
+
+        self.assertEqual(tree.search("", 10), ["Y", "W", "X", "Z"])
+        self.assertEqual(tree.search("b", 10), ["X", "Z"])
+        self.assertEqual(tree.search("b", 1), ["X"])
+        self.assertEqual(tree.search("b", 10, exclude={"X"}), ["Z"])
+        self.assertEqual(tree.search("b", 0), [])
+        self.assertEqual(tree.search("c", 10), [])
+        self.assertEqual(tree.search("b3", 10), [])
+
+
+class KeyIndexTest(unittest.TestCase):
+    def test_tokens(self):
+        self.assertEqual(normalize("  БС-0123   Ёлки "), "бс-0123 елки")
+        self.assertEqual(tokens("БС-0123 Ленина"), {"бс", "0123", "123", "ленина"})
+        self.assertEqual(tokens("Склад"), set())
+
+    def test_names_before_tokens(self):
+        """Совпадения с началом названия идут раньше совпадений со словами в нем"""
+        index = KeyIndex(["Ленина 5", "БС-0123 Ленина", "БС-0124"])
+
+        self.assertEqual(index.search("лен"), ["Ленина 5", "БС-0123 Ленина"])
+        self.assertEqual(index.search("бс-012"), ["БС-0123 Ленина", "БС-0124"])
+        self.assertEqual(index.search("123"), ["БС-0123 Ленина"])
+        self.assertEqual(index.search("12"), ["БС-0123 Ленина", "БС-0124"])
+
+    def test_cache_sentinel(self):
+        """Полный ответ кэшируется с None в конце и годится для большего limit; неполный - нет"""
+        index = KeyIndex([f"K{number}" for number in range(5)])
+
+        self.assertEqual(index.search("k", limit=2), ["K0", "K1"])
+        self.assertEqual(index._cache["k"], ["K0", "K1"])
+        self.assertEqual(index.search("k", limit=10), [f"K{number}" for number in range(5)])
+        self.assertEqual(index._cache["k"][-1], None)
+
+        index._names.search = index._tokens.search = None  # дальше ответы только из кэша
+        self.assertEqual(index.search("k", limit=3), ["K0", "K1", "K2"])
+        self.assertEqual(index.search("k", limit=100), [f"K{number}" for number in range(5)])
+        self.assertNotIn(None, index.search("k"))
+
+    def test_cache_reset_on_add(self):
+        index = KeyIndex(["K1"])
+        self.assertEqual(index.search("k"), ["K1"])
+        index.add("K2")
+        self.assertEqual(index.search("k"), ["K1", "K2"])
+
+    def test_cache_size(self):
+        index = KeyIndex(["A1", "A2", "B1"], cache_size=2)
+        for prefix in ("a", "b", "a1"):
+            index.search(prefix)
+        self.assertEqual(list(index._cache), ["b", "a1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,92 @@
+import tempfile
+import unittest
+import asyncio
+import os
+
+import payloads
+
+
+class PayloadStoreTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._directory.name, "callbacks.jsonl")
+
+    def tearDown(self):
+        self._directory.cleanup()
+
+    def lines(self) -> int:
+        with open(self.path, "rb") as f:
+            return sum(1 for _ in f)
+
+    def test_survives_restart(self):
+        async def run():
+            store = payloads.PayloadStore(self.path)
+            kept = await store.put({"key_name": "K1", "comment": "Комментарий \"в кавычках\"\nи перенос"})
+            popped = await store.put({"key_name": "K2"})
+            await store.pop(popped)
+            expired = await store.put({"key_name": "K3"}, ttl=-1)
+            store.close()
+            reopened = payloads.PayloadStore(self.path)
+            try:
+                return (await reopened.get(kept), await reopened.get(popped), await reopened.get(expired),
+                        await reopened.pop(popped))
+            finally:
+                reopened.close()
+
+        self.assertEqual(asyncio.run(run()), (
+            {"key_name": "K1", "comment": "Комментарий \"в кавычках\"\nи перенос"}, None, None, None))
+        self.assertEqual(self.lines(), 1)  # при открытии журнал сжат до живых токенов
+
+    def test_restore_after_pop(self):
+        """Возвращенный после неудачи токен снова действует, в том числе после перезапуска"""
+        async def run():
+            store = payloads.PayloadStore(self.path)
+            token = await store.put({"key_name": "K1"})
+            data = await store.pop(token)
+            await store.restore(token, data)
+            store.close()
+            reopened = payloads.PayloadStore(self.path)
+            try:
+                return await reopened.pop(token), await reopened.pop(token)
+            finally:
+                reopened.close()
+
+        self.assertEqual(asyncio.run(run()), ({"key_name": "K1"}, None))
+
+    def test_put_appends_instead_of_rewriting(self):
+        """Выдача кнопок дописывает по строке; файл переписывается, только когда мертвых строк больше живых"""
+        async def run():
+            store = payloads.PayloadStore(self.path)
+            tokens = [await store.put({"key_name": f"K{number}"}) for number in range(300)]
+            appended = self.lines()
+            for token in tokens:
+                await store.pop(token)
+            for number in range(payloads.COMPACT_MIN):
+                await store.pop(await store.put({"key_name": f"L{number}"}))
+            store.close()
+            return appended, tokens[-1]
+
+        appended, token = asyncio.run(run())
+        self.assertEqual(appended, 300)
+        self.assertLessEqual(self.lines(), payloads.COMPACT_MIN + 1)
+        reopened = payloads.PayloadStore(self.path)
+        self.assertIsNone(asyncio.run(reopened.get(token)))
+        reopened.close()
+
+    def test_incomplete_tail(self):
+        store = payloads.PayloadStore(self.path)
+        kept = asyncio.run(store.put({"key_name": "K0"}))
+        token = asyncio.run(store.put({"key_name": "K1"}))
+        store.close()
+        with open(self.path, "ab") as f:
+            f.write(b'{"put": "broken", "exp')
+
+        reopened = payloads.PayloadStore(self.path)
+        self.assertEqual(asyncio.run(reopened.get(kept)), {"key_name": "K0"})
+        self.assertEqual(asyncio.run(reopened.get(token)), {"key_name": "K1"})
+        reopened.close()
+        self.assertEqual(self.lines(), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,98 @@
+from datetime import datetime, timedelta
+import threading
+import tempfile
+import unittest
+import unittest.mock
+import asyncio
+import time
+import os
+
+from openpyxl import load_workbook
+
+import sheets
+
+
+class RegistryPoolTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self.pool = sheets.RegistryPool({
+            name: {
+                "excel_file_path": os.path.join(self._directory.name, f"{name}.xlsx"),
+                "keys_accounting_wks": "Журнал", "keys_wks": "Ключи", "employees_wks": "Сотрудники",
+                "snapshot": False, "watch_file": False,
+            } for name in ("main", "north")
+        }, max_loaded=1)
+
+    def tearDown(self):
+        self.pool.close()
+        self._directory.cleanup()
+
+    def test_open_off_event_loop(self):
+        """Холодная площадка грузится в потоке один раз на все одновременные запросы, цикл событий не стоит"""
+        created, closed = [], []
+        original_init, original_close = sheets.Registry.__init__, sheets.Registry.close
+
+        def slow_init(registry, *args, **kwargs):
+            time.sleep(0.3)
+            created.append(threading.current_thread())
+            original_init(registry, *args, **kwargs)
+
+        def close(registry):
+            closed.append((registry.name, threading.current_thread()))
+            original_close(registry)
+
+        async def run():
+            ticks = 0
+
+            async def ticker():
+                nonlocal ticks
+                while True:
+                    await asyncio.sleep(0.01)
+                    ticks += 1
+
+            task = asyncio.create_task(ticker())
+            first = await asyncio.gather(*(self.pool.open("main") for _ in range(5)))
+            second = await self.pool.open("north")  # вытесняет main: max_loaded=1
+            task.cancel()
+            return first, second, ticks
+
+        with unittest.mock.patch.object(sheets.Registry, "__init__", slow_init), \
+                unittest.mock.patch.object(sheets.Registry, "close", close):
+            first, second, ticks = asyncio.run(run())
+        self.assertEqual(len({id(registry) for registry in first}), 1)
+        self.assertEqual(len(created), 2)
+        self.assertGreater(ticks, 20)  # за две загрузки по 0.3 с цикл событий продолжал работать
+        self.assertNotIn(threading.main_thread(), created)
+        self.assertEqual([name for name, _ in closed], ["main"])
+        self.assertIsNot(closed[0][1], threading.main_thread())
+        self.assertEqual(self.pool.loaded(), ["north"])
+        self.assertIs(self.pool.get("north"), second)
+
+    def test_summary_of_unloaded_site(self):
+        """Сводка выгруженной площадки отвечает фоновым задачам без загрузки книги, пока файл книги не изменился"""
+        start = datetime.now().replace(microsecond=0) + timedelta(days=1)
+        site = self.pool.get("main")
+
+        async def fill():
+            await site.submit(site.keys_accounting.new_entry, "K1", "Иван", "Петров", "79990000000")
+            await site.submit(site.bookings.new_booking, "K2", "Иван", "Петров", 1, start, start + timedelta(hours=1))
+
+        asyncio.run(fill())
+        issued = site.keys_accounting.get_all_entries()[0].time_received
+        self.assertIsNone(self.pool.summary("north"))  # ни разу не открывалась
+        self.pool.get("north")  # вытесняет main: max_loaded=1
+
+        summary = self.pool.summary("main")
+        self.assertEqual((summary.next_booking, summary.oldest_open, summary.oldest_returned), (start, issued, None))
+        self.assertFalse(summary.needs_attention(datetime.now(), timedelta(days=3), None))
+        self.assertTrue(summary.needs_attention(issued + timedelta(days=4), timedelta(days=3), None))
+
+        workbook = load_workbook(site.file_path)
+        workbook["Ключи"].append(["K3", 1, "None", "None"])
+        time.sleep(0.01)
+        workbook.save(site.file_path)
+        self.assertIsNone(self.pool.summary("main"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,30 @@
+import tempfile
+import unittest
+import os
+
+import profiles
+
+
+class ProfileCacheTest(unittest.TestCase):
+    def test_update_is_flushed_later(self):
+        """update не пишет на диск; flush пишет только изменившийся кэш"""
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "profiles.json")
+            cache = profiles.ProfileCache(path)
+            cache.update(1, "user", "Иван", "Петров")
+            self.assertFalse(os.path.exists(path))
+
+            cache.flush()
+            self.assertEqual(profiles.ProfileCache(path).username(1), "user")
+            cache.update(1, "user", "Иван", "Петров")  # ничего не поменялось
+            os.remove(path)
+            cache.flush()
+            self.assertFalse(os.path.exists(path))
+
+            cache.update(1, "renamed", "Иван", "Петров")
+            cache.flush()
+            self.assertEqual(profiles.ProfileCache(path).username(1), "renamed")
+
+
+if __name__ == "__main__":
+    unittest.main()
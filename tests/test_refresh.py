@@ -0,0 +1,103 @@
+from datetime import datetime, timedelta
+import tempfile
+import unittest
+import asyncio
+import time
+
+from openpyxl import load_workbook
+
+from aggregates import JournalHistory
+from tests.test_writes import make_registry
+import events
+import sheets
+
+
+class RefreshTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self.registry = make_registry(self._directory.name, watch_interval=0.05)
+        journal, keys, employees, bookings = (
+            self.registry.keys_accounting, self.registry.keys, self.registry.employees, self.registry.bookings)
+        start = datetime.now() + timedelta(days=1)
+
+        async def fill():
+            for name in ("K1", "K2", "K3"):
+                await self.registry.submit(keys.new_key, name, 1)
+            await self.registry.submit(employees.new_employee, "Иван", "Петров", "7999", "1", ["security"])
+            await self.registry.submit(journal.new_entry, "K1", "Иван", "Петров", "7999")
+            await self.registry.submit(journal.new_entry, "K2", "Иван", "Петров", "7999")
+            await self.registry.submit(journal.set_return_time_by_key_name, "K1")
+            await self.registry.submit(bookings.new_booking, "K3", "Иван", "Петров", "1", start, start + timedelta(hours=1))
+
+        asyncio.run(fill())
+
+    def tearDown(self):
+        self.registry.close()
+        self._directory.cleanup()
+
+    def edit_externally(self):
+        """Правки в обход бота, как из Excel: новая выдача, возврат, новый ключ и сотрудник, отмена брони"""
+        workbook = load_workbook(self.registry.file_path)
+        journal = workbook["Журнал"]
+        for row in journal.iter_rows(min_row=2):
+            if row[0].value == "K2":
+                row[5].value = datetime.now().strftime(sheets.datetime_format)
+        journal.append(["K3", "Анна", "Смирнова", "7888", datetime.now().strftime(sheets.datetime_format), None, ""])
+        workbook["Ключи"].append(["K4", 1, "None", "None"])
+        workbook["Сотрудники"].append(["Анна", "Смирнова", "7888", "2", "security"])
+        workbook["Брони"]["G2"] = sheets.BOOKING_CANCELLED
+        time.sleep(0.01)  # другой mtime
+        workbook.save(self.registry.file_path)
+
+    def wait_refreshed(self, version: int):
+        deadline = time.monotonic() + 10
+        while self.registry.version == version or self.registry._refreshing:
+            self.assertLess(time.monotonic(), deadline, "workbook was not refreshed")
+            time.sleep(0.02)
+
+    def test_refresh_updates_only_touched_structures(self):
+        journal, keys = self.registry.keys_accounting, self.registry.keys
+        aggregates, history = journal.aggregates, journal.history
+        keys.get_by_name("K1")
+        self.registry.employees.with_role("security")
+        self.assertEqual(len(self.registry.bookings.of_user("1")), 1)
+        untouched = aggregates.key("K1")
+
+        version = self.registry.version
+        self.edit_externally()
+        self.wait_refreshed(version)
+
+        entries = journal.get_entries()
+        self.assertEqual(journal.aggregates.check(entries), [])
+        self.assertIs(journal.aggregates.key("K1"), untouched)  # сводка по незатронутому ключу не пересчитывалась
+        self.assertIsNot(journal.aggregates, aggregates)
+        expected = JournalHistory.from_entries(entries)
+        self.assertEqual(journal.history.keys, expected.keys)
+        self.assertEqual(journal.history.employees, expected.employees)
+        self.assertEqual(sorted(journal.holders()), ["K3"])
+        self.assertEqual(journal.aggregates.key("K2").returned_count, 1)
+
+        self.assertIsNotNone(keys.get_by_name("K4"))
+        self.assertEqual([key.key_name for key in keys.search("K")], ["K1", "K2", "K3", "K4"])
+        self.assertEqual([employee.telegram for employee in self.registry.employees.with_role("security")], ["1", "2"])
+        self.assertEqual(self.registry.bookings.of_user("1"), [])
+        self.assertIsNone(self.registry.bookings.next_start())
+
+        changed = [event.data["sheet"] for event in self.registry.events.read() if event.type == events.ROWS_CHANGED]
+        self.assertEqual(sorted(changed), ["Брони", "Журнал", "Ключи", "Сотрудники"])
+
+    def test_removed_key_rebuilds_index(self):
+        keys = self.registry.keys
+        self.assertIsNotNone(keys.get_by_name("K2"))
+        version = self.registry.version
+        workbook = load_workbook(self.registry.file_path)
+        workbook["Ключи"].delete_rows(3)
+        time.sleep(0.01)
+        workbook.save(self.registry.file_path)
+        self.wait_refreshed(version)
+        self.assertIsNone(keys.get_by_name("K2"))
+        self.assertEqual([key.key_name for key in keys.search("K")], ["K1", "K3"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,183 @@
+from datetime import datetime, timedelta
+import unittest
+
+import render
+import sheets
+
+# Эталон: f-строки bot.py до шаблонов render (без изменений, кроме того, что BotUtils и site стали параметрами)
+
+
+def escape_markdown(text):
+    escape_chars = ['_', '*', '[', '`']
+    for char in escape_chars:
+        text = text.replace(char, f'\\{char}')
+    return text
+
+
+def phone_format(phone):
+    phone = str(phone)
+    digits = ''.join(filter(str.isdigit, phone))
+    if digits.startswith('8'):
+        digits = '7' + digits[1:]
+    elif not digits.startswith('7'):
+        digits = '7' + digits
+    digits = digits[:11]
+    return f'+{digits}'
+
+
+def format_key_entry(entry, key, include_key_info=True):
+    base_info = (
+        f"*Ключ*: `{entry.key_name}`\n"
+        f"*  Состояние*: {'Не на месте' if entry.time_returned is None else 'Этот ключ сейчас на месте'}\n"
+    )
+
+    if key and include_key_info:
+        base_info += (
+            f"*  Количество ключей*: `{key.count}`\n"
+            f"*  Тип ключа*: `{key.key_type}`\n"
+            f"*  Тип аппаратный*: `{key.hardware_type}`\n\n"
+        )
+
+    if entry.time_returned is None:
+        status_info = (
+            f"*Ключ выдан:*\n"
+            f"  *Имя*: `{entry.emp_firstname} {entry.emp_lastname}`\n"
+            f"  *Выдан в*: `{entry.time_received.strftime('%H:%M (%d.%m.%Y)')}`\n"
+        )
+    else:
+        status_info = (
+            f"*Последний пользователь:*\n"
+            f"  *Имя*: `{entry.emp_firstname} {entry.emp_lastname}`\n"
+            f"  *Взял в*: `{entry.time_received.strftime('%H:%M (%d.%m.%Y)')}`\n"
+            f"  *Вернул в*: `{entry.time_returned.strftime('%H:%M (%d.%m.%Y)')}`\n"
+        )
+
+    additional_info = (
+        f"{f'  *Комментарии*: \"{escape_markdown(entry.comment)}\"\n' if entry.comment else ''}"
+        f"  *Контакт*: {phone_format(entry.emp_phone)}\n"
+    )
+
+    return base_info + status_info + additional_info
+
+
+def key_history(header, key_entries):
+    response_strs = [header]
+    for entry in key_entries:
+        if len(response_strs[-1]) > 2000:
+            response_strs.append("")
+        response_strs[-1] += (
+            f"*Имя*: `{entry.emp_firstname} {entry.emp_lastname}`\n"
+            f"| *Взял в*: `{entry.time_received.strftime('%H:%M (%d.%m.%Y)')}`\n"
+            f"{f"| *Вернул в*: `{entry.time_returned.strftime('%H:%M (%d.%m.%Y)')}`\n" if entry.time_returned else ""}"
+            f"| *Контакт*: {phone_format(entry.emp_phone)}\n"
+            f"{f"| *Комментарии*: \"{escape_markdown(entry.comment)}\"\n" if entry.comment else ""}"
+        )
+        response_strs[-1] += "\n"
+    return response_strs
+
+
+def emp_history(header, emp_entries):
+    response_strs = [header]
+    for entry in emp_entries:
+        if len(response_strs[-1]) > 2000:
+            response_strs.append("")
+        response_strs[-1] += (
+            f"*Ключ*: `{entry.key_name}`\n"
+            f"| *Взял в*: `{entry.time_received.strftime('%H:%M (%d.%m.%Y)')}`\n"
+            f"{f"| *Вернул в*: `{entry.time_returned.strftime('%H:%M (%d.%m.%Y)')}`\n" if entry.time_returned else ""}"
+            f"{f"| *Комментарии*: \"{escape_markdown(entry.comment)}\"\n" if entry.comment else ""}"
+        )
+        response_strs[-1] += "\n"
+    return response_strs
+
+
+def my_key(entry, key_data):
+    msg = (
+        f"*Ключ*: `{entry.key_name}`\n"
+        f"| *Взял в*: `{entry.time_received.strftime('%H:%M (%d.%m.%Y)')}`\n"
+    )
+    if key_data:
+        msg += (
+            f"| *Количество ключей*: `{key_data.count}`\n"
+            f"| *Тип ключа*: `{key_data.key_type}`\n"
+            f"| *Тип аппаратный*: `{key_data.hardware_type}`\n"
+        )
+    if entry.comment:
+        msg += f"| *Комментарии*: \"{escape_markdown(entry.comment)}\"\n"
+    return msg
+
+
+COMMENTS = [
+    "",
+    "Для работ в серверной",
+    "a_b*c[d]`e` <b>&amp;</b> \"кавычки\" 'апостроф' \\ обратный слэш",
+    "многострочный\nкомментарий_с_*разметкой*",
+    "x" * 700,
+]
+PHONES = ["79990000000", "89991112233", "+7 (999) 111-22-33", "9991112233", "123", 79990000000]
+
+
+def entries(count: int) -> list[sheets.Entry]:
+    started = datetime(2024, 12, 31, 23, 5)
+    result = []
+    for number in range(count):
+        received = started + timedelta(hours=number * 7, minutes=number)
+        returned = None if number % 4 == 0 else received + timedelta(minutes=45 + number)
+        result.append(sheets.Entry(
+            f"БС_{number % 5}*[{number}]", f"Иван_{number % 3}", "Петров`<i>", PHONES[number % len(PHONES)],
+            received, returned, COMMENTS[number % len(COMMENTS)]))
+    return result
+
+
+KEYS = [None, sheets.Key("БС_1", 2, "Механический", "None"), sheets.Key("K*<&>", 1, "Электронный_", "Тип `A`")]
+
+
+class GoldenTest(unittest.TestCase):
+    """Шаблоны render дают те же байты, что прежние f-строки"""
+
+    def assertSameBytes(self, rendered, expected):
+        if isinstance(rendered, list):
+            self.assertEqual([text.encode("utf-8") for text in rendered], [text.encode("utf-8") for text in expected])
+        else:
+            self.assertEqual(rendered.encode("utf-8"), expected.encode("utf-8"))
+
+    def test_key_card(self):
+        for entry in entries(24):
+            for key in KEYS:
+                with self.subTest(entry=entry.key_name, key=key):
+                    self.assertSameBytes(render.key_card(entry, key), format_key_entry(entry, key))
+
+    def test_my_key(self):
+        for entry in entries(24):
+            for key in KEYS:
+                with self.subTest(entry=entry.key_name, key=key):
+                    self.assertSameBytes(render.my_key(entry, key), my_key(entry, key))
+
+    def test_key_history_chunks(self):
+        header = "*Ключ*: `БС_1`\n*Этот ключ брали*: 120 раз(а)\n\n"
+        history = entries(120)
+        expected = key_history(header, history)
+        self.assertGreater(len(expected), 3)  # история разбита на несколько сообщений
+        self.assertSameBytes(render.chunks(header, map(render.key_history_entry, history)), expected)
+        # второй проход идет из кэша фрагментов
+        self.assertSameBytes(render.chunks(header, map(render.key_history_entry, history)), expected)
+
+    def test_emp_history_chunks(self):
+        header = "*Имя*: `Иван_1 Петров`\n*Этот сотрудник брал ключи*: 120 раз(а)\n\n"
+        history = entries(120)
+        expected = emp_history(header, history)
+        self.assertGreater(len(expected), 3)
+        self.assertSameBytes(render.chunks(header, map(render.emp_history_entry, history)), expected)
+
+    def test_fragment_follows_return(self):
+        """Возврат ключа меняет запись на месте: фрагмент из кэша перерисовывается"""
+        entry = entries(1)[0]
+        self.assertSameBytes(render.key_card(entry), format_key_entry(entry, None))
+        entry.time_returned = entry.time_received + timedelta(hours=1)
+        entry.comment = "после_возврата"
+        self.assertSameBytes(render.key_card(entry), format_key_entry(entry, None))
+        self.assertSameBytes(render.key_history_entry(entry), key_history("", [entry])[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
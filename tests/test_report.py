@@ -0,0 +1,56 @@
+import tempfile
+import unittest
+import unittest.mock
+import asyncio
+
+import numpy as np
+
+from tests.test_writes import make_registry
+import report
+
+
+class JournalColumnsTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self.registry = make_registry(self._directory.name, snapshot=False, watch_file=False)
+        self.journal = self.registry.keys_accounting
+
+    def tearDown(self):
+        self.registry.close()
+        self._directory.cleanup()
+
+    def issue(self, *keys: tuple[str, str]):
+        async def run():
+            await asyncio.gather(*(
+                self.registry.submit(self.journal.new_entry, key_name, first_name, "Петров", "79990000000")
+                for key_name, first_name in keys))
+
+        asyncio.run(run())
+
+    def assertColumnsEqual(self, columns: report.JournalColumns, expected: report.JournalColumns):
+        self.assertEqual([columns.key_names[code] for code in columns.key],
+                         [expected.key_names[code] for code in expected.key])
+        self.assertEqual([columns.emp_names[code] for code in columns.emp],
+                         [expected.emp_names[code] for code in expected.emp])
+        np.testing.assert_array_equal(columns.received, expected.received)
+        np.testing.assert_array_equal(columns.returned, expected.returned)
+
+    def test_updated_after_append_and_return(self):
+        """После выдач и возврата столбцы дописываются, а не строятся заново, и совпадают с построенными с нуля"""
+        self.issue(*((f"K{number}", "Иван") for number in range(20)))
+        before = report.journal_columns(self.journal)
+
+        self.issue(("K20", "Анна"), ("K21", "Иван"))
+        asyncio.run(self.registry.submit(self.journal.set_return_time, self.journal.get_not_returned_keys()[3]))
+        with unittest.mock.patch.object(report.JournalColumns, "from_entries", side_effect=AssertionError):
+            columns = report.journal_columns(self.journal)
+
+        expected = report.JournalColumns.from_entries(self.journal.get_entries())
+        self.assertColumnsEqual(columns, expected)
+        self.assertEqual(len(before), 20)  # прежние столбцы не тронуты: по ним мог строиться отчет
+        self.assertEqual(int((~np.isnat(before.returned)).sum()), 0)
+        self.assertEqual(report.build_report(columns).tables, report.build_report(expected).tables)
+
+
+if __name__ == "__main__":
+    unittest.main()
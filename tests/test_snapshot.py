@@ -0,0 +1,106 @@
+from datetime import datetime, timezone
+import tempfile
+import unittest
+import struct
+import math
+import os
+
+import snapshot
+
+
+def bits(value: float) -> bytes:
+    """Побитовое представление: NaN и -0.0 сравниваются точно"""
+    return struct.pack("<d", value)
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._directory.name, "keys.snapshot")
+        self.source = os.path.join(self._directory.name, "keys.xlsx")
+        with open(self.source, "wb") as f:
+            f.write(b"workbook")
+
+    def tearDown(self):
+        self._directory.cleanup()
+
+    def open(self, signature=(1, 2)) -> snapshot.Snapshot | None:
+        opened = snapshot.Snapshot.open(self.path, signature, self.source)
+        if opened is not None:
+            self.addCleanup(opened.close)
+        return opened
+
+    def write(self, sheets: dict, signature=(1, 2)):
+        snapshot.write(self.path, sheets, signature, snapshot.file_digest(self.source))
+
+    def test_round_trip(self):
+        """Все виды значений восстанавливаются без потерь, в том числе NaN, -0.0 и микросекунды"""
+        rows = [
+            ("Ключ", "Количество", "Доля", "Флаг", "Выдан"),
+            ("БС-0123 Ленина", 2, 0.5, True, datetime(2024, 3, 1, 12, 30, 15, 123456)),
+            ("", -2 ** 63, float("nan"), False, datetime(1900, 1, 1)),
+            (None, 2 ** 63 - 1, float("-inf"), None, datetime(2100, 12, 31, 23, 59, 59)),
+            ("K1", 0, -0.0, False, None),
+            ("БС-0123 Ленина", None, 1e300, True, datetime(1970, 1, 1)),
+        ]
+        self.write({"Ключи": rows, "Пустой": [], "Журнал": [("K1",), (None,)]})
+        opened = self.open()
+
+        self.assertEqual(opened.sheetnames, ["Ключи", "Пустой", "Журнал"])
+        restored = list(opened.rows("Ключи"))
+        self.assertEqual(len(restored), len(rows))
+        for expected, actual in zip(rows, restored):
+            for left, right in zip(expected, actual):
+                self.assertIs(type(left), type(right))
+                if isinstance(left, float):
+                    self.assertEqual(bits(left), bits(right))
+                else:
+                    self.assertEqual(left, right)
+        self.assertTrue(math.isnan(restored[2][2]))
+        self.assertEqual(list(opened.rows("Пустой")), [])
+        self.assertEqual(list(opened.rows("Журнал")), [("K1",), (None,)])
+        self.assertEqual(list(opened.rows("Ключи", max_row=2)), restored[:2])
+
+    def test_only_empty_strings(self):
+        self.write({"Лист": [("", None)]})
+        self.assertEqual(list(self.open().rows("Лист")), [("", None)])
+
+    def test_unsupported_values(self):
+        for rows in (
+            [(datetime(2024, 1, 1, tzinfo=timezone.utc),)],
+            [(2 ** 63,)],
+            [(b"bytes",)],
+            [("a", "b"), ("c",)],
+        ):
+            with self.subTest(rows=rows), self.assertRaises(snapshot.UnsupportedValue):
+                self.write({"Лист": rows})
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(os.listdir(self._directory.name), ["keys.xlsx"])  # временные файлы удалены
+
+    def test_stale_snapshot(self):
+        """Снимок не годится, если у книги другая сигнатура или другое содержимое"""
+        self.assertIsNone(self.open())
+        self.write({"Лист": [("K1",)]})
+
+        self.assertIsNotNone(self.open())
+        self.assertIsNone(self.open(signature=(1, 3)))
+        with open(self.source, "ab") as f:
+            f.write(b"changed")
+        self.assertIsNone(self.open())
+
+    def test_unreadable_snapshot(self):
+        with open(self.path, "wb") as f:
+            f.write(b"not a snapshot at all")
+        with self.assertLogs("snapshot", "WARNING"):
+            self.assertIsNone(self.open())
+
+    def test_memory_snapshot(self):
+        rows = [("Ключ",), ("K1",), ("K2",)]
+        memory = snapshot.MemorySnapshot({"Ключи": rows})
+
+        self.assertEqual(memory.sheetnames, ["Ключи"])
+        self.assertEqual(list(memory.rows("Ключи", max_row=2)), rows[:2])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,203 @@
+from datetime import datetime
+import multiprocessing
+import threading
+import tempfile
+import unittest
+import unittest.mock
+import asyncio
+import time
+import os
+
+from openpyxl import load_workbook
+from openpyxl.styles import Font
+
+from aggregates import JournalHistory
+import events
+import sheets
+
+
+def make_registry(directory: str, **config) -> sheets.Registry:
+    return sheets.Registry("test", {
+        "excel_file_path": os.path.join(directory, "keys.xlsx"),
+        "keys_accounting_wks": "Журнал",
+        "keys_wks": "Ключи",
+        "employees_wks": "Сотрудники",
+        **config,
+    })
+
+
+def _issue_and_return(directory: str, process: int, count: int, barrier):
+    """Процесс стресс-теста: выдает count ключей и возвращает четные, параллельно с другими процессами"""
+    registry = make_registry(directory, snapshot=False)
+    journal = registry.keys_accounting
+
+    async def run():
+        barrier.wait()
+        await asyncio.gather(*(
+            registry.submit(journal.new_entry, f"P{process}-K{number}", "Иван", "Петров", "79990000000")
+            for number in range(count)))
+        await asyncio.gather(*(
+            registry.submit(journal.set_return_time, entry) for entry in journal.get_not_returned_keys()
+            if entry.key_name.startswith(f"P{process}-") and int(entry.key_name.split("K")[1]) % 2 == 0))
+
+    try:
+        asyncio.run(run())
+    finally:
+        registry.close()
+
+
+class WriterTest(unittest.TestCase):
+    def setUp(self):
+        self._directory = tempfile.TemporaryDirectory()
+        self.registry = make_registry(self._directory.name)
+        self.journal = self.registry.keys_accounting
+
+    def tearDown(self):
+        self.registry.close()
+        self._directory.cleanup()
+
+    def issue(self, key_name: str):
+        return asyncio.run(self.registry.submit(self.journal.new_entry, key_name, "Иван", "Петров", "79990000000"))
+
+    def saved_keys(self) -> list[str]:
+        workbook = load_workbook(self.registry.file_path)
+        return [row[0] for row in workbook["Журнал"].iter_rows(min_row=2, values_only=True) if any(row)]
+
+    def test_reads_not_blocked_by_save(self):
+        """Пока писатель сохраняет файл, чтение таблиц отвечает из кэша, не дожидаясь конца сохранения"""
+        self.issue("K1")
+        workbook = self.registry.workbook
+        save, saving = workbook.save, threading.Event()
+
+        def slow_save(path):
+            saving.set()
+            time.sleep(1)
+            save(path)
+
+        workbook.save = slow_save
+        writer = threading.Thread(target=self.issue, args=("K2",))
+        writer.start()
+        self.assertTrue(saving.wait(5))
+        started = time.perf_counter()
+        self.registry.keys.search("K")
+        self.journal.get_not_returned_keys()
+        self.journal.aggregates.key("K1")
+        self.journal.key_history("K1")
+        self.journal.holders()
+        self.registry.bookings.due()
+        self.registry.employees.with_role("security")
+        elapsed = time.perf_counter() - started
+        writer.join()
+        self.assertLess(elapsed, 0.5)
+        self.assertEqual(self.saved_keys(), ["K1", "K2"])
+
+    def test_failed_save_is_rolled_back(self):
+        """Несохраненная запись не остается ни в workbook, ни в кэшах и не попадает на диск со следующей"""
+        self.journal.aggregates  # сводки и история построены до записи и обновляются ею
+        self.journal.history
+
+        def failing_save(path):
+            raise PermissionError(path)
+
+        self.registry.workbook.save = failing_save
+        with self.assertRaises(PermissionError):
+            self.issue("K1")
+        self.assertEqual(self.journal.aggregates.key("K1").count, 0)
+        self.assertEqual(self.journal.key_history("K1"), [])
+        self.assertEqual(self.journal.get_all_entries(), [])
+        self.assertNotIn("K1", self.journal.holders())
+
+        self.issue("K2")
+        self.assertEqual(self.saved_keys(), ["K2"])
+        issued = [event.data["key_name"] for event in self.registry.events.read() if event.type == events.KEY_ISSUED]
+        self.assertEqual(issued, ["K2"])
+
+    def test_archive_deletes_rows_in_place(self):
+        """Архивирование удаляет только перенесенные строки: у оставшихся сохраняется оформление"""
+        for number in range(6):
+            self.issue(f"K{number}")
+        for entry in self.journal.get_not_returned_keys():
+            if entry.key_name in ("K1", "K2", "K4"):
+                asyncio.run(self.registry.submit(self.journal.set_return_time, entry))
+        self.assertEqual(self.journal.archive_closed_entries(), 0)  # archive_after_days не задан
+
+        def mark_kept():
+            for row in self.journal.ws.iter_rows(min_row=2):
+                if row[0].value in ("K0", "K3", "K5"):
+                    row[0].font = Font(bold=True)
+
+        self.registry.write(mark_kept)
+        self.assertEqual(self.journal.archive_closed_entries(older_than_days=-1), 3)
+
+        sheet = load_workbook(self.registry.file_path)["Журнал"]
+        self.assertEqual([(row[0].value, row[0].font.bold) for row in sheet.iter_rows(min_row=2)],
+                         [("K0", True), ("K3", True), ("K5", True)])
+        self.assertEqual(sorted(entry.key_name for entry in self.journal.archive.get_entries()), ["K1", "K2", "K4"])
+
+    def test_history_reads_only_requested_months(self):
+        """История за узкий период читает только пересекающиеся с ним архивные месяцы"""
+        headers = tuple(self.journal.keys_headers.values())
+        for month in (1, 2, 3):
+            self.journal.archive.append(f"2024-{month:02}", headers, [
+                (f"K{number}", "Иван", "Петров", "79990000000", f"2024-{month:02}-{day:02} 10:00:00",
+                 f"2024-{month:02}-{day:02} 11:00:00", "")
+                for number in (1, 2) for day in (3, 17)])
+        self.issue("K1")
+
+        with unittest.mock.patch.object(self.journal.archive, "read", wraps=self.journal.archive.read) as read:
+            entries = self.journal.key_history("K1", datetime(2024, 2, 10), datetime(2024, 2, 20))
+        self.assertEqual([call.args[0] for call in read.call_args_list], ["2024-02"])
+        self.assertEqual([entry.time_received for entry in entries], [datetime(2024, 2, 17, 10)])
+
+        expected = JournalHistory.from_entries(self.journal.get_entries())
+        self.assertEqual(self.journal.key_history("K1"), expected.key("K1"))
+        self.assertEqual(self.journal.emp_history("Иван", "Петров", datetime(2024, 3, 1)),
+                         expected.employee("Иван", "Петров", datetime(2024, 3, 1)))
+
+    def test_concurrent_issue_and_return(self):
+        """Стресс: много одновременных выдач и возвратов через очередь писателя, ни одна запись не теряется"""
+        count = 200
+
+        async def run():
+            await asyncio.gather(*(
+                self.registry.submit(self.journal.new_entry, f"K{number}", "Иван", "Петров", "79990000000")
+                for number in range(count)))
+            await asyncio.gather(*(
+                self.registry.submit(self.journal.set_return_time, entry)
+                for entry in self.journal.get_not_returned_keys() if int(entry.key_name[1:]) % 2 == 0))
+
+        asyncio.run(run())
+        self.assertEqual(sorted(self.saved_keys()), sorted(f"K{number}" for number in range(count)))
+        reopened = make_registry(self._directory.name, snapshot=False, watch_file=False)
+        try:
+            open_keys = {entry.key_name for entry in reopened.keys_accounting.get_not_returned_keys()}
+        finally:
+            reopened.close()
+        self.assertEqual(open_keys, {f"K{number}" for number in range(count) if number % 2})
+
+    def test_processes_issue_and_return(self):
+        """Стресс: три процесса одновременно выдают по 40 ключей и возвращают половину, файл общий"""
+        processes, count = 3, 40
+        context = multiprocessing.get_context("spawn")
+        barrier = context.Barrier(processes)
+        workers = [
+            context.Process(target=_issue_and_return, args=(self._directory.name, process, count, barrier))
+            for process in range(processes)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join(120)
+        self.assertEqual([worker.exitcode for worker in workers], [0] * processes)
+
+        issued = {f"P{process}-K{number}" for process in range(processes) for number in range(count)}
+        self.assertEqual(sorted(self.saved_keys()), sorted(issued))
+        reopened = make_registry(self._directory.name, snapshot=False, watch_file=False)
+        try:
+            open_keys = {entry.key_name for entry in reopened.keys_accounting.get_not_returned_keys()}
+        finally:
+            reopened.close()
+        self.assertEqual(open_keys, {key for key in issued if int(key.split("K")[1]) % 2})
+
+
+if __name__ == "__main__":
+    unittest.main()
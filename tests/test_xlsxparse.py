@@ -0,0 +1,136 @@
+from datetime import datetime, timedelta
+import unittest.mock
+import tempfile
+import unittest
+import zipfile
+import os
+
+from openpyxl import Workbook, load_workbook
+
+import xlsxparse
+
+
+def sheet_xml(rows: list[bytes], prefix: bytes = b"") -> bytes:
+    return (b'<worksheet><dimension ref="A1"/><' + prefix + b'sheetData>' + b"".join(rows)
+            + b"</" + prefix + b"sheetData><rowBreaks/></worksheet>")
+
+
+def data(xml: bytes) -> bytes:
+    """Содержимое sheetData"""
+    start = xml.index(b"sheetData>") + len(b"sheetData>")
+    return xml[start:xml.index(b"sheetData>", start)].rsplit(b"</", 1)[0]
+
+
+class ChunkTest(unittest.TestCase):
+    def test_chunks_cover_sheet(self):
+        """При любом числе кусков они стыкуются без пропусков и повторов и режут только по началу <row>"""
+        rows = [b'<row r="%d" spans="1:2"><c r="A%d"><v>%d</v></c></row>' % (n, n, n * 7919) for n in range(1, 40)]
+        rows[5] = b'<row r="6"/>'
+        for prefix in (b"", b"x:"):
+            xml = sheet_xml([row.replace(b"<row", b"<" + prefix + b"row").replace(b"</row", b"</" + prefix + b"row")
+                             for row in rows], prefix)
+            for count in (1, 2, 3, 7, 39, 80):
+                with self.subTest(prefix=prefix, count=count):
+                    chunks = [xlsxparse._chunk(xml, index, count) for index in range(count)]
+                    present = [chunk for chunk in chunks if chunk is not None]
+                    self.assertEqual(b"".join(map(data, present)), data(xml))
+                    for chunk in present:
+                        self.assertTrue(chunk.startswith(xml[:xml.index(b"sheetData>") + len(b"sheetData>")]))
+                        self.assertTrue(chunk.endswith(b"</" + prefix + b"sheetData><rowBreaks/></worksheet>"))
+                        if data(chunk):
+                            self.assertTrue(data(chunk).startswith(b"<" + prefix + b'row r="'))
+                    if count > len(rows):
+                        self.assertIn(None, chunks)
+
+    def test_empty_sheet(self):
+        xml = b"<worksheet><sheetData/></worksheet>"
+        self.assertEqual(xlsxparse._chunk(xml, 0, 3), xml)
+        self.assertIsNone(xlsxparse._chunk(xml, 1, 3))
+
+    def test_splittable(self):
+        self.assertTrue(xlsxparse._splittable(sheet_xml([b'<row r="1"><c r="A1"><v>1</v></c></row>'])))
+        self.assertTrue(xlsxparse._splittable(sheet_xml([])))  # <rowBreaks> после sheetData - не строка
+        self.assertTrue(xlsxparse._splittable(b"<worksheet><sheetData/><rowBreaks/></worksheet>"))
+        self.assertFalse(xlsxparse._splittable(sheet_xml([b'<row><c><v>1</v></c></row>'])))
+        self.assertFalse(xlsxparse._splittable(sheet_xml([
+            b'<row r="1"><c r="A1"><f t="shared" ref="A1:A2" si="0">B1</f></c></row>'])))
+
+
+class AssembleTest(unittest.TestCase):
+    def test_gaps_and_width(self):
+        """Пропущенные строки (и до первой, и между кусками) заполняются пустыми, ширина выравнивается"""
+        chunks = [[(2, ("a",))], [], [(3, ("b", None, "c"))], [(6, (None, "d"))]]
+        self.assertEqual(xlsxparse._assemble(chunks), [
+            (None, None, None),
+            ("a", None, None),
+            ("b", None, "c"),
+            (None, None, None),
+            (None, None, None),
+            (None, "d", None),
+        ])
+
+    def test_empty(self):
+        self.assertEqual(xlsxparse._assemble([]), [])
+        self.assertEqual(xlsxparse._assemble([[], []]), [])
+
+
+class ReadValuesTest(unittest.TestCase):
+    """Значения совпадают с iter_rows(values_only=True) после load_workbook, в том числе при разборе кусками"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls._directory = tempfile.TemporaryDirectory()
+        cls.path = os.path.join(cls._directory.name, "keys.xlsx")
+        wb = Workbook()
+        journal = wb.active
+        journal.title = "Журнал"
+        journal.append(["Ключ", "Имя", "Фамилия", "Телефон", "Выдан", "Возвращен"])
+        start = datetime(2024, 1, 1, 8, 0)
+        for number in range(3000):
+            journal.append([f"БС-{number % 97:04d}", "Иван", "Петров", "79990000000",
+                            start + timedelta(minutes=17 * number), None if number % 5 else start + timedelta(days=1)])
+        journal.cell(row=3010, column=8, value=1.5)  # строки-пропуски и ячейка правее заголовка
+        journal.cell(row=3012, column=1, value=True)
+        keys = wb.create_sheet("Ключи")
+        keys.cell(row=3, column=2, value="K1")  # лист начинается не с первой строки
+        wb.create_sheet("Пустой")
+        wb.save(cls.path)
+        workbook = load_workbook(cls.path)
+        cls.expected = {ws.title: list(ws.iter_rows(values_only=True)) for ws in workbook.worksheets}
+        workbook.close()
+        with zipfile.ZipFile(cls.path) as archive:
+            cls.journal_part = next(name for name in archive.namelist() if name.endswith("sheet1.xml"))
+            cls.strings_part = next((name for name in archive.namelist() if name.endswith("sharedStrings.xml")), None)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._directory.cleanup()
+
+    def test_unsplit(self):
+        values = xlsxparse.read_values(self.path)
+        self.assertEqual(values, self.expected)
+
+    def test_split_in_process(self):
+        """Журнал, разобранный кусками, совпадает с разбором целиком"""
+        wb = load_workbook(self.path, read_only=True)
+        formats = (wb.epoch, wb._date_formats, wb._timedelta_formats)
+        wb.close()
+        xlsxparse._load_strings(self.path, self.strings_part)
+        try:
+            for count in (2, 5, 16):
+                with self.subTest(count=count):
+                    chunks = [xlsxparse._parse_part(self.path, self.journal_part, index, count, *formats)
+                              for index in range(count)]
+                    self.assertTrue(all(chunks))  # каждому куску достались строки
+                    self.assertEqual(xlsxparse._assemble(chunks), self.expected["Журнал"])
+        finally:
+            xlsxparse._load_strings(self.path, None)
+
+    def test_split_in_workers(self):
+        with unittest.mock.patch.object(xlsxparse, "CHUNK_BYTES", 16 * 1024):
+            values = xlsxparse.read_values(self.path, workers=3)
+        self.assertEqual(values, self.expected)
+
+
+if __name__ == "__main__":
+    unittest.main()
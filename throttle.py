@@ -0,0 +1,74 @@
+import time
+
+
+class RateLimiter:
+    """
+    Token bucket на пользователя: burst событий подряд, дальше не чаще rate в секунду.
+    Корзины живут в памяти процесса; в кластере каждый процесс ограничивает свою долю обновлений
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._buckets: dict[str, list] = {}  # user_id -> [токены, time.monotonic() пересчета, предупрежден ли]
+        self._checks = 0
+
+    def take(self, user_id) -> bool:
+        """Тратит токен пользователя; False - лимит исчерпан, событие нужно отбросить"""
+        now = time.monotonic()
+        bucket = self._buckets.get(str(user_id))
+        if bucket is None:
+            bucket = self._buckets[str(user_id)] = [float(self.burst), now, False]
+        bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        self._checks += 1
+        if self._checks % 1000 == 0:
+            self._purge(now)
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        bucket[2] = False
+        return True
+
+    def should_warn(self, user_id) -> bool:
+        """True один раз за серию отказов: о лимите пользователю сообщается однажды, а не на каждое событие"""
+        bucket = self._buckets.get(str(user_id))
+        if bucket is None or bucket[2]:
+            return False
+        bucket[2] = True
+        return True
+
+    def _purge(self, now: float):
+        """Убирает корзины, которые уже наполнились бы до краев: они ничем не отличаются от новых"""
+        full_after = self.burst / self.rate
+        self._buckets = {user: bucket for user, bucket in self._buckets.items() if now - bucket[1] < full_after}
+
+
+class IdempotencyCache:
+    """
+    Недавно обработанные нажатия кнопок: ключ идемпотентности -> результат обработчика.
+    Пока первое нажатие обрабатывается, результат - пустая строка. Для кластера -
+    cluster.RedisIdempotencyCache с тем же (асинхронным) интерфейсом
+    """
+
+    def __init__(self):
+        self._results: dict[str, tuple[float, str]] = {}  # ключ -> (time.monotonic() истечения, результат)
+
+    async def begin(self, key: str, ttl: float) -> tuple[bool, str | None]:
+        """Занимает ключ. (True, None) - нажатие первое; (False, результат или "") - повтор"""
+        now = time.monotonic()
+        if len(self._results) > 1000:
+            self._results = {k: record for k, record in self._results.items() if record[0] > now}
+        record = self._results.get(key)
+        if record is not None and record[0] > now:
+            return False, record[1]
+        self._results[key] = (now + ttl, "")
+        return True, None
+
+    async def finish(self, key: str, result: str, ttl: float):
+        """Сохраняет результат первого нажатия: повторы в течение ttl получат его же"""
+        self._results[key] = (time.monotonic() + ttl, result)
+
+    async def discard(self, key: str):
+        """Освобождает ключ (обработчик упал или ничего не изменил): следующее нажатие выполнится заново"""
+        self._results.pop(key, None)
@@ -0,0 +1,146 @@
+from typing import Callable
+import threading
+import logging
+import ctypes
+import ctypes.util
+import select
+import struct
+import sys
+import os
+
+log = logging.getLogger(__name__)
+
+# Флаги inotify(7)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+_event_header = struct.Struct("iIII")  # wd, mask, cookie, len
+
+
+def _inotify():
+    """libc с функциями inotify или None (не Linux, нет libc)"""
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    except OSError:
+        return None
+    return libc if hasattr(libc, "inotify_init1") and hasattr(libc, "inotify_add_watch") else None
+
+
+class FileWatcher:
+    """
+    Фоновый поток, вызывающий on_change при изменении файла path.
+    На Linux использует inotify на каталоге файла (сохранение через os.replace меняет inode самого файла),
+    на остальных системах и при ошибке inotify - опрос os.stat раз в poll_interval секунд.
+    on_tick вызывается при каждом пробуждении потока, не реже раза в poll_interval
+    """
+
+    def __init__(
+            self,
+            path: str,
+            on_change: Callable[[], None],
+            on_tick: Callable[[], None] = None,
+            poll_interval: float = 1.0,
+            settle: float = 0.2,
+    ):
+        self.path = os.path.abspath(path)
+        self.on_change = on_change
+        self.on_tick = on_tick
+        self.poll_interval = poll_interval
+        self.settle = settle  # сколько ждать окончания серии событий одного сохранения
+        self.mode = None  # "inotify" или "polling", известен после start()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    def start(self) -> "FileWatcher":
+        fd = self._open_inotify()
+        self.mode = "polling" if fd is None else "inotify"
+        target = self._poll if fd is None else self._watch
+        self._thread = threading.Thread(
+            target=target, args=() if fd is None else (fd,), name=f"watch:{os.path.basename(self.path)}", daemon=True)
+        self._thread.start()
+        log.debug("Watching %s (%s)", self.path, self.mode)
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout=self.poll_interval + 1)
+
+    def _open_inotify(self) -> int | None:
+        libc = _inotify()
+        if libc is None:
+            return None
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0:
+            log.warning("inotify_init1 failed (errno %s), falling back to polling", ctypes.get_errno())
+            return None
+        directory = os.path.dirname(self.path)
+        if libc.inotify_add_watch(fd, os.fsencode(directory), WATCH_MASK) < 0:
+            log.warning("inotify_add_watch on %s failed (errno %s), falling back to polling",
+                        directory, ctypes.get_errno())
+            os.close(fd)
+            return None
+        return fd
+
+    def _read_events(self, fd: int) -> bool:
+        """Читает накопившиеся события, True если среди них есть события по нашему файлу"""
+        name = os.fsencode(os.path.basename(self.path))
+        matched = False
+        while True:
+            try:
+                data = os.read(fd, 64 * 1024)
+            except BlockingIOError:
+                return matched
+            offset = 0
+            while offset < len(data):
+                _, mask, _, length = _event_header.unpack_from(data, offset)
+                offset += _event_header.size
+                event_name = data[offset:offset + length].rstrip(b"\0")
+                offset += length
+                if mask & IN_Q_OVERFLOW or event_name == name:
+                    matched = True
+
+    def _watch(self, fd: int):
+        try:
+            while not self._stop.is_set():
+                ready, _, _ = select.select([fd], [], [], self.poll_interval)
+                if ready and self._read_events(fd):
+                    # Одно сохранение дает серию событий: ждем, пока она закончится, и сообщаем один раз
+                    while select.select([fd], [], [], self.settle)[0]:
+                        self._read_events(fd)
+                    self._notify(self.on_change)
+                self._notify(self.on_tick)
+        finally:
+            os.close(fd)
+
+    def _poll(self):
+        last = self._stat()
+        while not self._stop.wait(self.poll_interval):
+            current = self._stat()
+            if current != last:
+                last = current
+                self._notify(self.on_change)
+            self._notify(self.on_tick)
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    @staticmethod
+    def _notify(callback: Callable[[], None] | None):
+        if callback is None:
+            return
+        try:
+            callback()
+        except Exception as e:
+            log.error("File watcher callback failed", exc_info=e)
@@ -0,0 +1,165 @@
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
+import logging
+import zipfile
+import re
+import io
+
+from openpyxl.reader.excel import ExcelReader
+from openpyxl.reader.strings import read_string_table
+from openpyxl.styles.stylesheet import apply_stylesheet
+from openpyxl.worksheet._reader import WorkSheetParser
+from openpyxl.xml.constants import SHARED_STRINGS
+
+log = logging.getLogger(__name__)
+
+# Быстрое чтение значений листов xlsx без создания объектов openpyxl (ячеек, стилей, workbook).
+# XML каждого листа разбирается потоково тем же WorkSheetParser, что использует load_workbook,
+# поэтому значения совпадают с iter_rows(values_only=True). Большие листы режутся по границам <row>
+# на куски, которые разбираются параллельно в отдельных процессах
+
+CHUNK_BYTES = 4 * 1024 * 1024  # лист меньше этого размера (XML без сжатия) не режется на куски
+
+_sheet_data = re.compile(rb"<(\w+:)?sheetData\b[^>]*?(/?)>")
+_strings: list[str] = []  # общие строки книги, загружаются один раз на процесс
+
+
+def _load_strings(path: str, strings_path: str | None):
+    global _strings
+    if strings_path is None:
+        _strings = []
+        return
+    with zipfile.ZipFile(path) as archive, archive.open(strings_path) as source:
+        _strings = read_string_table(source)
+
+
+def _chunk(xml: bytes, index: int, count: int) -> bytes | None:
+    """
+    Кусок index из count: XML листа, в sheetData которого оставлены только строки этого куска.
+    Границы ищутся детерминированно, поэтому куски из разных процессов стыкуются без пропусков.
+    None - куску ничего не досталось
+    """
+    match = _sheet_data.search(xml)
+    if match is None or match.group(2):  # пустой лист: <sheetData/>
+        return xml if index == 0 else None
+    prefix = match.group(1) or b""
+    start = match.end()
+    end = xml.index(b"</" + prefix + b"sheetData>", start)
+    if count == 1:
+        return xml
+
+    row_tag = b"<" + prefix + b"row"
+
+    def boundary(position: int) -> int:
+        while True:
+            position = xml.find(row_tag, position, end)
+            if position < 0:
+                return end
+            if xml[position + len(row_tag):position + len(row_tag) + 1] in (b" ", b">", b"/"):
+                return position
+            position += len(row_tag)
+
+    size = end - start
+    lo = boundary(start + size * index // count) if index else start
+    hi = boundary(start + size * (index + 1) // count) if index < count - 1 else end
+    if lo >= hi:
+        return None
+    return xml[:start] + xml[lo:hi] + xml[end:]
+
+
+def _splittable(xml: bytes) -> bool:
+    """Куски можно разбирать независимо: у строк есть номера и нет общих формул, ссылающихся на другие строки"""
+    match = _sheet_data.search(xml)
+    if match is None or b't="shared"' in xml:
+        return False
+    if match.group(2):
+        return True
+    prefix = match.group(1) or b""
+    end = xml.index(b"</" + prefix + b"sheetData>", match.end())
+    first_row = re.compile(b"<" + re.escape(prefix) + rb"row[\s/>]").search(xml, match.end(), end)
+    return first_row is None or b' r="' in xml[first_row.start():xml.find(b">", first_row.start())]
+
+
+def _parse_part(path: str, part: str, index: int, count: int, epoch, date_formats, timedelta_formats) -> list:
+    """Строки куска листа: [(номер строки, значения с первого столбца до последней ячейки строки)]"""
+    with zipfile.ZipFile(path) as archive:
+        xml = archive.read(part)
+    if count > 1 and not _splittable(xml):
+        if index:
+            return []  # лист целиком разберет первый кусок
+        count = 1
+    source = _chunk(xml, index, count)
+    if source is None:
+        return []
+    del xml
+    parser = WorkSheetParser(io.BytesIO(source), _strings, epoch=epoch,
+                             date_formats=date_formats, timedelta_formats=timedelta_formats)
+    rows = []
+    for number, cells in parser.parse():
+        if not cells:
+            continue
+        values = [None] * max(cell["column"] for cell in cells)
+        for cell in cells:
+            values[cell["column"] - 1] = cell["value"]
+        rows.append((number, tuple(values)))
+    return rows
+
+
+def _assemble(chunks: list[list]) -> list[tuple]:
+    """Склеивает куски листа в строки как у iter_rows: с первой строки, одинаковой ширины"""
+    numbered = list(chain.from_iterable(chunks))
+    if not numbered:
+        return []
+    width = max(len(values) for _, values in numbered)
+    empty = (None,) * width
+    rows = []
+    for number, values in numbered:
+        if number > len(rows) + 1:
+            rows.extend([empty] * (number - len(rows) - 1))
+        rows.append(values if len(values) == width else values + (None,) * (width - len(values)))
+    return rows
+
+
+def read_values(path: str, workers: int = 1) -> dict[str, list[tuple]]:
+    """
+    Значения всех листов книги: имя листа -> строки (с заголовком), как iter_rows(values_only=True)
+    после load_workbook. workers > 1 - листы и куски больших листов разбираются в пуле процессов
+    """
+    reader = ExcelReader(path, read_only=True)
+    try:
+        reader.read_manifest()
+        reader.read_workbook()
+        apply_stylesheet(reader.archive, reader.wb)
+        strings = reader.package.find(SHARED_STRINGS)
+        strings_path = strings.PartName[1:] if strings is not None else None
+        sheets = [
+            (sheet.name, rel.target, reader.archive.getinfo(rel.target).file_size)
+            for sheet, rel in reader.parser.find_sheets()
+            if rel.target in reader.valid_files and "chartsheet" not in rel.Type
+        ]
+        wb = reader.wb
+        formats = (wb.epoch, wb._date_formats, wb._timedelta_formats)
+    finally:
+        reader.archive.close()
+
+    tasks = []  # (имя листа, аргументы _parse_part)
+    for name, part, size in sheets:
+        count = max(1, min(workers, size // CHUNK_BYTES)) if workers > 1 else 1
+        tasks += [(name, (path, part, index, count, *formats)) for index in range(count)]
+
+    if workers > 1:
+        with ProcessPoolExecutor(workers, initializer=_load_strings, initargs=(path, strings_path)) as pool:
+            futures = [(name, pool.submit(_parse_part, *args)) for name, args in tasks]
+            results = [(name, future.result()) for name, future in futures]
+    else:
+        _load_strings(path, strings_path)
+        try:
+            results = [(name, _parse_part(*args)) for name, args in tasks]
+        finally:
+            _load_strings(path, None)
+
+    chunks: dict[str, list[list]] = {name: [] for name, _, _ in sheets}
+    for name, rows in results:
+        chunks[name].append(rows)
+    log.debug("Parsed %s sheets of %s in %s tasks", len(sheets), path, len(tasks))
+    return {name: _assemble(parts) for name, parts in chunks.items()}